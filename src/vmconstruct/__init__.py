@@ -13,6 +13,7 @@ __all__ = []
 
 __all__.append("bootstrap")
 __all__.append("btrfs")
+__all__.append("check")
 
 __version__ = "0.0"
 
@@ -24,6 +25,10 @@ import yaml
 
 from . import bootstrap
 from . import btrfs
+from . import check
+from .bootstrap import executor
+from .bootstrap import templates
+from .exceptions import VMCCheckError
 from .silly import cowstatus
 
 
@@ -36,18 +41,25 @@ cfgdefs = {
 }
 
 
-def main():
+def main(argv=None):
     """\
     The main function which will start everything up...
+
+    :param argv: The command line arguments, sys.argv[1:] by default.
+    :type argv: list.
     """
 
     # Process the command line
     mainap = argparse.ArgumentParser(description="An Ubuntu virtual machine builder")
+    mainap.add_argument("action", metavar="ACTION", help="build the images or only check the configuration (build)",
+        nargs="?", choices=["build", "check"], default="build")
     # core options
     mainap.add_argument("-c", "--config", metavar="CONFIG FILE", help="configuration file ({d})".format(d=cfgdefs["config"]),
         action="store", dest="config", default=cfgdefs["config"])
     mainap.add_argument("-q", "--quick", metavar="QUICK_BOOTSTRAP", help="quick bootstrap",
         action="store_const", dest="quick", const=True, default=False)
+    mainap.add_argument("-n", "--nocheck", help="do not check the configuration before building",
+        action="store_const", dest="nocheck", const=True, default=False)
     # logging configuration
     mainap.add_argument("-l", "--log", metavar="LOG DIRECTORY", help="path to log file ({d})".format(d=cfgdefs["log"]),
         action="store", dest="log", default=cfgdefs["log"])
@@ -56,13 +68,13 @@ def main():
     mainap.add_argument("-L", "--logconfig", metavar="LOG CONFIG", help="logging configuration file ({d})".format(d=cfgdefs["logconfig"]),
         action="store", dest="logconfig", default=cfgdefs["logconfig"])
 
-    cmdline = mainap.parse_args()
+    cmdline = mainap.parse_args(argv)
 
 
     # Load the configuration file
     try:
         with open(cmdline.config, "rb") as ymlcfgfp:
-            ymlcfg = yaml.load(ymlcfgfp)
+            ymlcfg = yaml.safe_load(ymlcfgfp)
     except Exception:
         print("error: cannot load configuration file {f}".format(f=cmdline.config))
         exit(1)
@@ -82,22 +94,53 @@ def main():
     logger.addHandler(stderr_log_handler)
 
 
+    # Validate the configuration, vmdefs and templates before any build work
+    if cmdline.action == "check" or not cmdline.nocheck:
+        try:
+            check.check(ymlcfg)
+        except VMCCheckError:
+            logger.error("Configuration check failed")
+            logging.shutdown()
+            exit(1)
+
+        if cmdline.action == "check":
+            logging.shutdown()
+            exit(0)
+
+
+    # The workspace is btrfs subvolumes or, for tests and benchmarks of
+    # the orchestration, plain directories.  The build commands are run or
+    # only recorded.
+    backend = ymlcfg["workspace"].get("backend", "btrfs")
+
     # Do some prep work...
     try:
-        # do I have root privileges for chroot etc
-        # not checked yet
-
-        # check we have a mount point to work on
-        if not os.path.ismount(ymlcfg["workspace"]["rootpath"]):
-            raise Exception("Workspace root path is not a mount point")
-        logger.debug("workspace root path is on a mount point ({root})".format(root=ymlcfg["workspace"]["rootpath"]))
-
-        # and that it is btrfs
-        shellcmd = "echo -n $(df -T {root} | tail -n 1 | awk '{{print $2;}}')".format(root=ymlcfg["workspace"]["rootpath"])
-        fstype = subprocess.check_output(shellcmd, shell=True).decode(encoding="UTF-8")
-        if fstype != "btrfs":
-            raise Exception("Workspace root is not on a btrfs filesystem ({fstype})".format(fstype=fstype))
-        logger.debug("workspace filesystem is btrfs")
+        runnername = ymlcfg["workspace"].get("executor", "chroot")
+        if runnername not in executor.EXECUTORS:
+            raise Exception("Unknown executor {e}, expected one of {x}".format(e=runnername, x=executor.EXECUTORS))
+        if runnername == "recorder":
+            runner = executor.recorder(ymlcfg["workspace"].get("durations", None))
+        else:
+            runner = executor.chroot()
+
+        if backend == "directory":
+            os.makedirs(ymlcfg["workspace"]["rootpath"], exist_ok=True)
+            logger.debug("workspace is a directory tree ({root})".format(root=ymlcfg["workspace"]["rootpath"]))
+        else:
+            # do I have root privileges for chroot etc
+            # not checked yet
+
+            # check we have a mount point to work on
+            if not os.path.ismount(ymlcfg["workspace"]["rootpath"]):
+                raise Exception("Workspace root path is not a mount point")
+            logger.debug("workspace root path is on a mount point ({root})".format(root=ymlcfg["workspace"]["rootpath"]))
+
+            # and that it is btrfs
+            shellcmd = "echo -n $(df -T {root} | tail -n 1 | awk '{{print $2;}}')".format(root=ymlcfg["workspace"]["rootpath"])
+            fstype = subprocess.check_output(shellcmd, shell=True).decode(encoding="UTF-8")
+            if fstype != "btrfs":
+                raise Exception("Workspace root is not on a btrfs filesystem ({fstype})".format(fstype=fstype))
+            logger.debug("workspace filesystem is btrfs")
     except Exception:
         logger.exception("Failed to prepare environment")
         logging.shutdown()
@@ -109,7 +152,10 @@ def main():
     #logger.debug(yaml.dump(ymlcfg))
 
     # do the builds
-    wsroot = btrfs.subvolume(ymlcfg["workspace"]["rootpath"])
+    if backend == "directory":
+        wsroot = btrfs.directory(ymlcfg["workspace"]["rootpath"])
+    else:
+        wsroot = btrfs.subvolume(ymlcfg["workspace"]["rootpath"])
     for (dist, rels) in ymlcfg["build"]["basereleases"].items():
         distvol = wsroot.create(dist)
         if dist in ["ubuntu"]:
@@ -123,7 +169,7 @@ def main():
             for rel in rels:
                 cowstatus("bootstrap ubuntu {r}".format(r=rel))
                 relvol = distvol.create(rel)
-                base = bootstrap.debootstrap(relvol.create("_bootstrap"))
+                base = bootstrap.debootstrap(relvol.create("_bootstrap"), runner=runner)
                 base.bootstrap(rel, archive=archive, proxy=proxy)
 
                 cowstatus("update ubuntu {r}".format(r=rel))
@@ -133,11 +179,7 @@ def main():
                     "release": rel
                 }
 
-                tpldirs = []
-                tpldirs.extend([os.path.join(basetpl, dist, "_all", "_all") for basetpl in ymlcfg["build"]["basetemplates"]])
-                tpldirs.extend([os.path.join(basetpl, dist, "_all", "_update") for basetpl in ymlcfg["build"]["basetemplates"]])
-                tpldirs.extend([os.path.join(basetpl, dist, rel, "_all") for basetpl in ymlcfg["build"]["basetemplates"]])
-                tpldirs.extend([os.path.join(basetpl, dist, rel, "_update") for basetpl in ymlcfg["build"]["basetemplates"]])
+                tpldirs = templates.tpldirs(ymlcfg["build"]["basetemplates"], dist, rel, "_update")
 
                 payloads = []
                 try:
@@ -173,7 +215,7 @@ def main():
         logger.debug("Starting build of {v}".format(v=vmdef))
         cowstatus("building {v}".format(v=vmdef))
         with open(os.path.join(ymlcfg["global"]["paths"]["vmdefs"], vmdef+".yml"), "rb") as vmymlfp:
-            vmyml = yaml.load(vmymlfp)
+            vmyml = yaml.safe_load(vmymlfp)
 
         try:
             if vmyml["settings"]["pause"] == True:
@@ -183,14 +225,13 @@ def main():
             pass
 
         try:
-            logger.warning("TODO: as the yaml is parsed to a json compatible structure use a json schema to validate")
             onexist = vmyml["settings"]["onexist"].lower()
         except KeyError:
             onexist = "error"
 
         distvol = wsroot.create(vmyml["dist"])
         relvol = distvol.create(vmyml["release"])
-        base = bootstrap.ubuntu(relvol.create(vmyml.get("base", "_update")))
+        base = bootstrap.ubuntu(relvol.create(vmyml.get("base", "_update")), runner=runner)
         try:
             vm = base.clone(vmdef)
         except FileExistsError:
@@ -208,20 +249,24 @@ def main():
                 raise
 
         # Template dirs from global template paths and vm specific
-        tpldirs = []
-        tpldirs.extend([os.path.join(basetpl, vmyml["dist"], "_all", "_all") for basetpl in ymlcfg["build"]["basetemplates"]])
-        tpldirs.extend([os.path.join(basetpl, vmyml["dist"], "_all", vmdef) for basetpl in ymlcfg["build"]["basetemplates"]])
-        tpldirs.extend([os.path.join(basetpl, vmyml["dist"], vmyml["release"], "_all") for basetpl in ymlcfg["build"]["basetemplates"]])
-        tpldirs.extend([os.path.join(basetpl, vmyml["dist"], vmyml["release"], vmdef)for basetpl in ymlcfg["build"]["basetemplates"]])
+        tpldirs = templates.tpldirs(ymlcfg["build"]["basetemplates"], vmyml["dist"], vmyml["release"], vmdef)
         if isinstance(vmyml["settings"].get("templates", []), list):
             tpldirs.extend(vmyml["settings"].get("templates", []))
 
+        # Optionally snapshot each build step so a rebuild can resume
+        if ymlcfg["build"].get("layers", False):
+            vm.enableLayers()
+
         with vm.applytemplates(ymlcfg, vmyml, *tpldirs), vm.applypayloads(*vmyml["settings"].get("payloads", [])):
             if isinstance(vmyml.get("packages", []), list):
-                vm.install(*vmyml.get("packages", []))
+                vm.layer("install", vmyml.get("packages", []), vm.install, *vmyml.get("packages", []))
+        vm.finishLayers()
 
         if isinstance(vmyml.get("disks", {}), dict):
             vm.solidify(vmyml.get("disks", {}))
 
+    if isinstance(runner, executor.recorder):
+        logger.info("Recorded {n} commands, {s}s simulated".format(n=len(runner.commands), s=sum([c["duration"] for c in runner.commands])))
+
     # exit
     logging.shutdown()
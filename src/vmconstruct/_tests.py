@@ -3,11 +3,17 @@
 
 import unittest
 
+from .bootstrap._tests import suite as bootstrap_suite
+from .check._tests import suite as check_suite
 from .disks._tests import suite as disks_suite
+from .main_tests import suite as main_suite
 
 def suite():
     pkgTS = unittest.TestSuite()
+    pkgTS.addTest(bootstrap_suite())
+    pkgTS.addTest(check_suite())
     pkgTS.addTest(disks_suite())
+    pkgTS.addTest(main_suite())
 
     return(pkgTS)
 
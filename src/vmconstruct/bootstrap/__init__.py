@@ -13,11 +13,18 @@ import subprocess
 import time
 import uuid
 
+from .artifacts import artifactstore
+from .debpool import debpool
+from . import executor
+from .digests import digestcache
+from .layers import layers
 from .payloads import applyplds
+from . import sandbox
 from .templates import applydirs
 from .. import helpers
 from ..exceptions import *
 from ..disks import disks
+from ..disks import cache as diskcache
 
 # TODO:
 #  - make the architecture a parameter
@@ -27,9 +34,23 @@ DEFAULT_UBUNTU_ARCHIVE = "http://gb.archive.ubuntu.com/ubuntu/"
 
 
 class _imageBase(object, metaclass=abc.ABCMeta):
-    def __init__(self, subvol):
+    # The payload artifact store directory under the workspace root
+    artifactsdir = "_artifacts"
+
+    def __init__(self, subvol, runner=None):
+        """\
+        The constructor.
+
+        :param subvol: The subvolume of the image.
+        :type subvol: vmconstruct.btrfs.subvolume.
+        :param runner: The executor of the build commands, by default a
+                       vmconstruct.bootstrap.executor.chroot.
+        """
         self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
         self._subvol = subvol
+        self._runner = runner or executor.chroot()
+        self._layers = None
+        self._digests = None
 
         self._status = None
         self._loadStatus()
@@ -49,6 +70,29 @@ class _imageBase(object, metaclass=abc.ABCMeta):
         return(self._subvol.path)
 
 
+    @property
+    def artifacts(self):
+        """\
+        The workspace store of payload artifacts.
+        """
+        if getattr(self, "_artifacts", None) is None:
+            self._artifacts = artifactstore(os.path.join(self._subvol.rootpath, self.artifactsdir))
+
+        return(self._artifacts)
+
+
+    @property
+    def digests(self):
+        """\
+        The cache of file digests for the image, kept with the image so it
+        is inherited by a clone.
+        """
+        if self._digests is None:
+            self._digests = digestcache(os.path.join(self._subvol.path, "digests.json"), os.path.join(self._subvol.path, "origin"))
+
+        return(self._digests)
+
+
     def _loadStatus(self):
         if not self._status:
             self._logger.debug("Attempting to load status from {sf}".format(sf=os.path.join(self._subvol.path, "status.json")))
@@ -94,6 +138,36 @@ class _imageBase(object, metaclass=abc.ABCMeta):
           self._saveStatus()
 
 
+    def enableLayers(self):
+        """\
+        Snapshot the image after each build step run through layer() so a
+        rebuild can resume from the last good step.
+        """
+        store = self._subvol._parent.create("_layers").create(os.path.basename(self._subvol.path))
+        self._layers = layers(self, store)
+
+
+    def layer(self, step, inputs, fn, *args, **kw):
+        """\
+        Run fn(*args, **kw) as a build step.  If layers are enabled the step
+        is skipped when there is a layer for it with the same inputs.  Pass
+        a callable for inputs which are costly to compute, it is only called
+        if layers are enabled.
+        """
+        if self._layers is None:
+            return(fn(*args, **kw))
+
+        return(self._layers.run(step, inputs, fn, *args, **kw))
+
+
+    def finishLayers(self):
+        """\
+        Restore the image from the last layer if the final steps were skipped.
+        """
+        if self._layers is not None:
+            self._layers.finish()
+
+
     def solidify(self, disksyml):
         """\
         Finalise the image to disk volumes.
@@ -109,7 +183,7 @@ class _imageBase(object, metaclass=abc.ABCMeta):
                     "xz",
                     "-noappend"
                 ]
-                subprocess.check_call(cmd)
+                self._runner.run(cmd)
             elif dtype == "hdd":
                 self._logger.warning("TODO: unimplmented hdd solidify")
 
@@ -121,23 +195,87 @@ class _imageBase(object, metaclass=abc.ABCMeta):
                 # of bootloader installations etc.
                 payloads = dparam.pop("payloads", [])
 
-                d = disks(self._subvol.create(dname), dparam)
-                d.format()
-                try:
-                    mntpoint = d.mount()
-                    cmd = ["rsync", "-avHAX", "--delete", "--progress", os.path.join(self._subvol.path, "origin")+"/", mntpoint+"/"]
-                    print(subprocess.check_call(cmd))
-                    with self.applypayloads(*payloads, chrootpath=mntpoint): pass
-                    newfstab = helpers.fstab(os.path.join(mntpoint, "etc", "fstab"), d.fstab())
-                    self._logger.debug("Rewriting fstab as:\n{fstab}".format(fstab=newfstab))
-                    with open(os.path.join(mntpoint, "etc", "fstab"), "wb") as fp:
-                        fp.write(newfstab.encode("utf-8"))
-                finally:
-                    d.umount()
+                # The mount engine maps and mounts the disks, the rootdir
+                # engine builds the filesystems from a copy of the origin
+                # without loop devices.
+                engine = dparam.pop("engine", "mount")
+
+                # Optional export of the raw images to shippable formats
+                exportyml = dparam.pop("export", {})
+
+                # Formatted disks are cloned from the cache shared by all
+                # the images unless it is disabled
+                cachedir = os.path.join(self._subvol.rootpath, "_diskcache") if dparam.pop("cache", True) else None
+                if cachedir:
+                    diskcache.prune(cachedir)
+
+                if self._runner.mapper:
+                    dparam = dict([(k, dict(v, mapper=self._runner.mapper)) for (k, v) in dparam.items()])
+
+                dsubvol = self._subvol.create(dname)
+                # Partitions with an auto size are measured from the origin
+                d = disks(dsubvol, dparam, origin=os.path.join(self._subvol.path, "origin"), cachedir=cachedir)
+                if engine == "mount":
+                    d.format()
+                    tree = d.mounted()
+                    try:
+                        with tree as mntpoint:
+                            cmd = ["rsync", "-avHAX", "--delete", "--progress", os.path.join(self._subvol.path, "origin")+"/", mntpoint+"/"]
+                            self._runner.run(cmd)
+                            with self.applypayloads(*payloads, chrootpath=mntpoint): pass
+                            self._rewriteFstab(mntpoint, d)
+                    finally:
+                        self.logActivity("mount", tree.timings)
+                elif engine == "rootdir":
+                    self._solidifyRootdir(dsubvol, d, payloads)
+                else:
+                    raise Exception("unsupported hdd engine")
+
+                # Zeroed and trimmed space is not kept allocated in the images
+                self.logActivity("sparsify", d.sparsify())
+
+                if exportyml.get("formats", []):
+                    # Exports are kept outside the image so the previous
+                    # build is available as a backing file after a rebuild.
+                    destdir = os.path.join(self._subvol.rootpath, "_exports", os.path.basename(self._subvol.path), dname)
+                    exported = d.export(destdir, exportyml["formats"], backing=exportyml.get("backing", False))
+                    self.logActivity("export", exported)
             else:
                 raise Exception("unsupported disk type")
 
 
+    def _rewriteFstab(self, root, d):
+        """\
+        Merge the mounts of the disks in to the fstab under root.
+        """
+        newfstab = helpers.fstab(os.path.join(root, "etc", "fstab"), d.fstab())
+        self._logger.debug("Rewriting fstab as:\n{fstab}".format(fstab=newfstab))
+        with open(os.path.join(root, "etc", "fstab"), "wb") as fp:
+            fp.write(newfstab.encode("utf-8"))
+
+
+    def _solidifyRootdir(self, dsubvol, d, payloads):
+        """\
+        Populate the disks by building each filesystem image directly from a
+        staging copy of the origin.  The solidify payloads run against the
+        staging copy so they must not depend on mounted block devices.
+        """
+        if os.path.exists(os.path.join(dsubvol.path, "staging")):
+            dsubvol.create("staging").delete(recursive=True)
+        staging = dsubvol.create("staging")
+        try:
+            root = os.path.join(staging.path, "root")
+            cmd = ["cp", "-a", "--reflink=auto", os.path.join(self._subvol.path, "origin"), root]
+            self._logger.debug("Staging origin with command: {cmd}".format(cmd=cmd))
+            subprocess.check_call(cmd)
+            with self.applypayloads(*payloads, chrootpath=root): pass
+            d.assignUUIDs()
+            self._rewriteFstab(root, d)
+            d.populate(root, staging.path)
+        finally:
+            staging.delete(recursive=True)
+
+
     def open(self, name):
         """\
         Open a previously cloned image.
@@ -145,7 +283,7 @@ class _imageBase(object, metaclass=abc.ABCMeta):
         if self.getStatus() != "complete":
             raise VMCImageNotReadyError()
 
-        img = self._imagecls(self._subvol._parent.create(name))
+        img = self._imagecls(self._subvol._parent.create(name), runner=self._runner)
         if self._status["uuid"] == img._status["origin"]["uuid"]:
             return(img)
         else:
@@ -161,13 +299,13 @@ class _imageBase(object, metaclass=abc.ABCMeta):
 
         try:
             # Try to snapshot this volume to the given name
-            img = self._imagecls(self._subvol.snapshot(name))
+            img = self._imagecls(self._subvol.snapshot(name), runner=self._runner)
             img._status["origin"]["uuid"] = self._status["uuid"]
             img._saveStatus()
             return(img)
         except FileExistsError:
             # The path exists, assume it is already a snapshot of this vm so compare the origin uuid to confirm
-            img = self._imagecls(self._subvol._parent.create(name))
+            img = self._imagecls(self._subvol._parent.create(name), runner=self._runner)
             if self._status["uuid"] == img._status["origin"]["uuid"]:
                 return(img)
             else:
@@ -192,21 +330,30 @@ class _imageBase(object, metaclass=abc.ABCMeta):
         pass
 
 
-    def execChroot(self, *args, chrootpath=None):
+    def execChroot(self, *args, chrootpath=None, limits=None):
         """\
-        Execute the array of commands in the chroot environment.
+        Execute the array of commands in the chroot environment.  If limits
+        are given, see vmconstruct.bootstrap.sandbox, each command is run
+        with them and the resources it used are logged.
         """
         if chrootpath is None:
             chrootpath = os.path.join(self._subvol.path, "origin")
 
         try:
-            self._prepareChroot(chrootpath)
+            if self._runner.binds:
+                self._prepareChroot(chrootpath)
             for cmd in args:
                 self._logger.debug("Executing chroot command in {p}: {cmd}".format(p=chrootpath, cmd=cmd))
                 self.logActivity("chroot", cmd)
-                subprocess.check_call(["chroot", chrootpath] + cmd)
+                (returncode, usage) = self._runner.chroot(chrootpath, cmd, limits)
+                if usage is not None:
+                    usage.update({"cmd": cmd, "returncode": returncode})
+                    self.logActivity("usage", usage)
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, cmd)
         finally:
-            self._unprepareChroot(chrootpath)
+            if self._runner.binds:
+                self._unprepareChroot(chrootpath)
 
 
     def applytemplates(self, ymlcfg, vmyml, *dirs):
@@ -324,9 +471,9 @@ class debootstrap(_bootstrap):
         try:
             start = time.time()
             self.setStatus("building")
-            subprocess.check_call(cmdstg1)
+            self._runner.run(cmdstg1)
             # Additional work before packages installed here
-            subprocess.check_call(cmdstg2)
+            self._runner.run(cmdstg2)
             self.setStatus("complete")
         except (KeyboardInterrupt):
             self.setStatus("interrupted")
@@ -336,14 +483,17 @@ class debootstrap(_bootstrap):
             raise
         finally:
             # Make sure any potential mounts are cleaned up
-            subprocess.call(["umount", os.path.join(self._imagepath, "proc")])
-            subprocess.call(["umount", os.path.join(self._imagepath, "sys")])
+            if self._runner.binds:
+                subprocess.call(["umount", os.path.join(self._imagepath, "proc")])
+                subprocess.call(["umount", os.path.join(self._imagepath, "sys")])
             self._logger.info("Build ended after {s}s".format(s=time.time()-start))
 
 
 
 class ubuntu(_image):
     chroot_bind = ["dev", "dev/pts", "proc", "run", "sys"]
+    # The package pool directory under the workspace root, None to disable
+    debpooldir = "_debpool"
     policydsh = """\
 #!/bin/bash
 
@@ -378,10 +528,30 @@ done
         return(ubuntu)
 
 
+    @property
+    def pkgpool(self):
+        """\
+        The workspace package pool or None if it is disabled.
+        """
+        if not self.debpooldir:
+            return(None)
+
+        if getattr(self, "_pkgpool", None) is None:
+            self._pkgpool = debpool(os.path.join(self._subvol.rootpath, self.debpooldir))
+
+        return(self._pkgpool)
+
+
     def _prepareChroot(self, chrootpath):
         # Mounts for filesystems
         for mnt in self.chroot_bind:
             subprocess.check_call(["mount", "-o", "bind", os.path.join(os.sep, mnt), os.path.join(chrootpath, mnt)])
+        # Shared package pool as the apt archive directory, any packages
+        # already in the image are moved in to the pool first.
+        if self.pkgpool:
+            archives = os.path.join(chrootpath, "var", "cache", "apt", "archives")
+            self.pkgpool.ingest(archives, move=True)
+            subprocess.check_call(["mount", "-o", "bind", self.pkgpool.archives, archives])
         # Create a policy.d file to suppress service startup and +x
         with open(os.path.join(chrootpath, "usr", "sbin", "policy-rc.d"), "wb") as fp:
             fp.write(self.policydsh.encode("utf-8"))
@@ -391,6 +561,12 @@ done
 
 
     def _unprepareChroot(self, chrootpath):
+        # Package pool
+        if self.pkgpool:
+            archives = os.path.join(chrootpath, "var", "cache", "apt", "archives")
+            if os.path.ismount(archives):
+                subprocess.check_call(["umount", archives])
+            self.pkgpool.ingest()
         # /proc/mtab
         os.unlink(os.path.join(chrootpath, "etc", "mtab"))
         try:
@@ -428,8 +604,12 @@ done
 
     def solidify(self, disksyml):
         """\
-        Before an ubuntu image solidify clean out the .deb package cache.
+        Before an ubuntu image solidify clean out the .deb package cache,
+        moving anything found to the package pool.
         """
-        for deb in glob.glob(os.path.join(self._subvol.path, "origin", "var", "cache", "apt", "archives", "*.deb")):
+        archives = os.path.join(self._subvol.path, "origin", "var", "cache", "apt", "archives")
+        if self.pkgpool:
+            self.pkgpool.ingest(archives, move=True)
+        for deb in glob.glob(os.path.join(archives, "*.deb")):
             os.unlink(deb)
         super(ubuntu, self).solidify(disksyml)
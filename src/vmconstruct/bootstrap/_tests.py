@@ -0,0 +1,48 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 ${0}
+":"""
+
+import logging
+import unittest
+
+from vmconstruct.bootstrap.artifacts_tests import suite as artifacts_suite
+from vmconstruct.bootstrap.debpool_tests import suite as debpool_suite
+from vmconstruct.bootstrap.digests_tests import suite as digests_suite
+from vmconstruct.bootstrap.layers_tests import suite as layers_suite
+from vmconstruct.bootstrap.payloads_tests import suite as payloads_suite
+from vmconstruct.bootstrap.sandbox_tests import suite as sandbox_suite
+from vmconstruct.bootstrap.templates_tests import suite as templates_suite
+
+
+def suite():
+    pkgTS = unittest.TestSuite()
+
+    pkgTS.addTest(artifacts_suite())
+    pkgTS.addTest(debpool_suite())
+    pkgTS.addTest(digests_suite())
+    pkgTS.addTest(layers_suite())
+    pkgTS.addTest(payloads_suite())
+    pkgTS.addTest(sandbox_suite())
+    pkgTS.addTest(templates_suite())
+
+    return(pkgTS)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "DEBUG"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
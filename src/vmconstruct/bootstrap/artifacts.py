@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.artifacts
+    :platform: Unix
+    :synopsis: vmconstruct shared payload artifact store
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+This module manages a workspace level store of the files payloads
+download, such as application archives.  Each artifact is fetched once,
+verified against the sha256 declared in the payload manifest and kept
+under its digest so every image built with the payload shares it.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import urllib.request
+
+from ..exceptions import *
+
+
+
+class artifactstore(object):
+    """\
+    A content addressed store of artifacts.  The files are kept read-only
+    as <path>/sha256/<hex digest>.
+    """
+    def __init__(self, path):
+        """\
+        The constructor.
+
+        :param path: The directory holding the store, created if necessary.
+        :type path: str.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._path = path
+        self.store = os.path.join(path, "sha256")
+
+        try:
+            os.makedirs(self.store)
+        except FileExistsError:
+            if not os.path.isdir(self.store):
+                raise
+
+
+    @property
+    def path(self):
+        return(self._path)
+
+
+    def fetch(self, url, sha256):
+        """\
+        Return the path of the artifact with digest sha256, downloading it
+        from url if it is not in the store.  Any URL urllib can open may be
+        used, including file:// for a local directory.
+
+        :raises: VMCArtifactChecksumError if the download does not match.
+        """
+        sha256 = sha256.lower()
+        if not re.match("^[0-9a-f]{64}$", sha256):
+            raise Exception("Artifact {u} sha256 {s} is not a sha256 hex digest".format(u=url, s=sha256))
+
+        stored = os.path.join(self.store, sha256)
+        if os.path.isfile(stored):
+            self._logger.debug("Artifact {u} is in the store as {s}".format(u=url, s=sha256))
+            return(stored)
+
+        self._logger.info("Fetching artifact {u}".format(u=url))
+        tmpfile = "{s}.{pid}.tmp".format(s=stored, pid=os.getpid())
+        s256 = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(url) as src, open(tmpfile, "wb") as dst:
+                while True:
+                    data = src.read(16 * 65536)
+                    if not data:
+                        break
+                    s256.update(data)
+                    dst.write(data)
+
+            if s256.hexdigest() != sha256:
+                raise VMCArtifactChecksumError("{u} has sha256 {d}, expected {s}".format(u=url, d=s256.hexdigest(), s=sha256))
+
+            os.chmod(tmpfile, 0o444)
+            os.rename(tmpfile, stored)
+        finally:
+            if os.path.exists(tmpfile):
+                os.unlink(tmpfile)
+
+        return(stored)
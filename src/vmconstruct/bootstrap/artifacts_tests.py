@@ -0,0 +1,92 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct.bootstrap.artifacts import artifactstore
+from vmconstruct.exceptions import VMCArtifactChecksumError
+
+
+def suite():
+    artifactsTS = unittest.TestSuite()
+    artifactsTS.addTest(ArtifactsUT("fetch_file"))
+    artifactsTS.addTest(ArtifactsUT("fetch_once"))
+    artifactsTS.addTest(ArtifactsUT("fetch_checksum"))
+
+    return(artifactsTS)
+
+
+
+class ArtifactsUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.store = artifactstore(os.path.join(self.tdir, "artifacts"))
+        self.upstream = os.path.join(self.tdir, "upstream")
+        os.makedirs(self.upstream)
+        self.artifact = os.path.join(self.upstream, "application.zip")
+        with open(self.artifact, "wb") as fp:
+            fp.write(b"application")
+        self.url = "file://" + self.artifact
+        self.sha256 = hashlib.sha256(b"application").hexdigest()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def fetch_file(self):
+        self.logger.info("An artifact is fetched in to the store by its digest")
+
+        stored = self.store.fetch(self.url, self.sha256)
+        self.assertEqual(stored, os.path.join(self.store.store, self.sha256))
+        with open(stored, "rb") as fp:
+            self.assertEqual(fp.read(), b"application")
+
+
+    def fetch_once(self):
+        self.logger.info("An artifact in the store is not fetched again")
+
+        self.store.fetch(self.url, self.sha256)
+        os.unlink(self.artifact)
+        self.assertTrue(os.path.isfile(artifactstore(self.store.path).fetch(self.url, self.sha256)))
+
+
+    def fetch_checksum(self):
+        self.logger.info("An artifact which does not match its digest is not stored")
+
+        self.assertRaises(VMCArtifactChecksumError, self.store.fetch, self.url, "0" * 64)
+        self.assertEqual(os.listdir(self.store.store), [])
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
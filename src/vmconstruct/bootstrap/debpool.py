@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.debpool
+    :platform: Unix
+    :synopsis: vmconstruct shared .deb package pool
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+This module manages a workspace level pool of downloaded .deb packages.
+The pool archive directory is bind mounted as the apt archive directory
+of a chroot so packages fetched for one image are available to all the
+others and never become part of an image.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+
+
+
+class debpool(object):
+    """\
+    A pool of .deb files deduplicated by filename and sha256.  The archives
+    directory is laid out as apt expects for /var/cache/apt/archives and each
+    file in it is a hard link to a content addressed copy in the store.
+    """
+    def __init__(self, path):
+        """\
+        The constructor.
+
+        :param path: The directory holding the pool, created if necessary.
+        :type path: str.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._path = path
+        self.archives = os.path.join(path, "archives")
+        self._store = os.path.join(path, "sha256")
+
+        for d in [os.path.join(self.archives, "partial"), self._store]:
+            try:
+                os.makedirs(d)
+            except FileExistsError:
+                if not os.path.isdir(d):
+                    raise
+
+
+    @property
+    def path(self):
+        return(self._path)
+
+
+    def _digest(self, deb):
+        s256 = hashlib.sha256()
+        with open(deb, "rb") as fp:
+            while True:
+                data = fp.read(16 * 4096)
+                if not data:
+                    break
+                s256.update(data)
+
+        return(s256.hexdigest())
+
+
+    def _link(self, src, dst):
+        """\
+        Atomically replace dst with a hard link to src.
+        """
+        tmp = "{dst}.{pid}.tmp".format(dst=dst, pid=os.getpid())
+        os.link(src, tmp)
+        os.rename(tmp, dst)
+
+
+    def ingest(self, directory=None, move=False):
+        """\
+        Add the .deb files in directory (default the pool archives) to the
+        store.  Files from another directory are linked in to the pool
+        archives and removed from directory if move is set.
+
+        :returns: The number of files newly added to the store.
+        """
+        if directory is None:
+            directory = self.archives
+
+        added = 0
+        for deb in glob.glob(os.path.join(directory, "*.deb")):
+            dst = os.path.join(self.archives, os.path.basename(deb))
+            if os.stat(deb).st_nlink > 1 and os.path.exists(dst) and os.path.samefile(deb, dst) and directory == self.archives:
+                # Already linked in to the store
+                continue
+
+            digest = self._digest(deb)
+            stored = os.path.join(self._store, digest)
+            if not os.path.exists(stored):
+                self._logger.debug("Adding {deb} to package pool as {d}".format(deb=os.path.basename(deb), d=digest))
+                try:
+                    os.link(deb, stored)
+                except OSError:
+                    # A different filesystem, fall back to a copy
+                    with open(deb, "rb") as sfp, open(stored+".tmp", "wb") as dfp:
+                        while True:
+                            data = sfp.read(16 * 1048576)
+                            if not data:
+                                break
+                            dfp.write(data)
+                    os.rename(stored+".tmp", stored)
+                added += 1
+
+            if not (os.path.exists(dst) and os.path.samefile(stored, dst)):
+                self._link(stored, dst)
+
+            if move and directory != self.archives:
+                os.unlink(deb)
+
+        return(added)
@@ -0,0 +1,93 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct.bootstrap.debpool import debpool
+
+
+def suite():
+    debpoolTS = unittest.TestSuite()
+    debpoolTS.addTest(DebpoolUT("ingest_move"))
+    debpoolTS.addTest(DebpoolUT("ingest_dedup"))
+    debpoolTS.addTest(DebpoolUT("ingest_archives"))
+
+    return(debpoolTS)
+
+
+
+class DebpoolUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.pool = debpool(os.path.join(self.tdir, "pool"))
+        self.cache = os.path.join(self.tdir, "cache")
+        os.makedirs(self.cache)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _deb(self, directory, name, content):
+        with open(os.path.join(directory, name), "wb") as fp:
+            fp.write(content)
+
+
+    def ingest_move(self):
+        self.logger.info("Moving packages from an image cache to the pool")
+
+        self._deb(self.cache, "a_1.0_amd64.deb", b"a")
+        self.assertEqual(self.pool.ingest(self.cache, move=True), 1)
+        self.assertEqual(os.listdir(self.cache), [])
+        self.assertTrue(os.path.isfile(os.path.join(self.pool.archives, "a_1.0_amd64.deb")))
+
+
+    def ingest_dedup(self):
+        self.logger.info("Packages with the same content are stored once")
+
+        self._deb(self.cache, "a_1.0_amd64.deb", b"same")
+        self._deb(self.cache, "a_1%3a1.0_amd64.deb", b"same")
+        self.assertEqual(self.pool.ingest(self.cache, move=True), 1)
+        self.assertTrue(os.path.samefile(os.path.join(self.pool.archives, "a_1.0_amd64.deb"), os.path.join(self.pool.archives, "a_1%3a1.0_amd64.deb")))
+
+
+    def ingest_archives(self):
+        self.logger.info("Packages downloaded in to the pool archives are added to the store once")
+
+        self._deb(self.pool.archives, "b_2.0_amd64.deb", b"b")
+        self.assertEqual(self.pool.ingest(), 1)
+        self.assertEqual(self.pool.ingest(), 0)
+        self.assertEqual(os.stat(os.path.join(self.pool.archives, "b_2.0_amd64.deb")).st_nlink, 2)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.digests
+    :platform: Unix
+    :synopsis: vmconstruct cached file digests
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+This module keeps the sha256 of files in an image keyed by their inode
+so that the checksum of a template destination is only calculated when
+the file has changed.  The cache is saved in the image subvolume and so
+is inherited by a clone along with the files it describes.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from .. import helpers
+
+
+
+class digestcache(object):
+    """\
+    A cache of file sha256 digests keyed by (device, inode, size, mtime_ns,
+    ctime_ns).  A snapshot has a new device number but the same inodes as
+    the volume it was taken from, so the entries for the device of the
+    root when the cache was saved are moved to the device of the root when
+    it is loaded.
+    """
+    def __init__(self, path=None, root=None):
+        """\
+        The constructor.
+
+        :param path: The file the cache is saved in or None to only keep
+                     the cache in memory.
+        :type path: str.
+        :param root: The root directory of the files being cached.
+        :type root: str.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._path = path
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._dev = os.stat(root).st_dev if root else None
+        self.hits = 0
+        self.misses = 0
+
+        if path and os.path.isfile(path):
+            try:
+                with open(path, "rb") as fp:
+                    saved = json.loads(fp.read().decode(encoding="UTF-8"))
+            except ValueError:
+                self._logger.warning("Ignoring unreadable digest cache {p}".format(p=path))
+                saved = {}
+
+            for (key, digest) in saved.get("digests", {}).items():
+                (dev, rest) = key.split(":", 1)
+                if self._dev is not None and int(dev) == saved.get("dev", None):
+                    key = "{d}:{r}".format(d=self._dev, r=rest)
+                self._digests[key] = digest
+
+
+    def _key(self, st):
+        return("{d}:{i}:{s}:{m}:{c}".format(d=st.st_dev, i=st.st_ino, s=st.st_size, m=st.st_mtime_ns, c=st.st_ctime_ns))
+
+
+    def get(self, path):
+        """\
+        Return the sha256 hex digest of the file at path.
+        """
+        st = os.stat(path)
+        key = self._key(st)
+        with self._lock:
+            digest = self._digests.get(key, None)
+            if digest is not None:
+                self.hits += 1
+                return(digest)
+            self.misses += 1
+
+        digest = helpers.sha256file(path)
+        if self._key(os.stat(path)) == key:
+            # Only keep the digest if the file did not change while hashing
+            with self._lock:
+                self._digests[key] = digest
+
+        return(digest)
+
+
+    def set(self, path, digest):
+        """\
+        Record the digest of a file which has just been written.
+        """
+        key = self._key(os.stat(path))
+        with self._lock:
+            self._digests[key] = digest
+
+
+    def save(self):
+        """\
+        Write the cache to its file.
+        """
+        if not self._path:
+            return
+
+        self._logger.debug("Saving {n} digests ({h} hits, {m} misses)".format(n=len(self._digests), h=self.hits, m=self.misses))
+        with self._lock:
+            saved = {"dev": self._dev, "digests": dict(self._digests)}
+        tmpfile = "{p}.{pid}.tmp".format(p=self._path, pid=os.getpid())
+        with open(tmpfile, "wb") as fp:
+            fp.write(bytes(json.dumps(saved), "UTF-8"))
+        os.rename(tmpfile, self._path)
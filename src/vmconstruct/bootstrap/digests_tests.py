@@ -0,0 +1,125 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct.bootstrap.digests import digestcache
+
+
+def suite():
+    digestsTS = unittest.TestSuite()
+    digestsTS.addTest(DigestsUT("digest_cached"))
+    digestsTS.addTest(DigestsUT("digest_changed"))
+    digestsTS.addTest(DigestsUT("digest_empty"))
+    digestsTS.addTest(DigestsUT("digest_saved"))
+    digestsTS.addTest(DigestsUT("digest_device"))
+
+    return(digestsTS)
+
+
+
+class DigestsUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tdir, "origin")
+        os.makedirs(self.root)
+        self.saved = os.path.join(self.tdir, "digests.json")
+        self.file = os.path.join(self.root, "file")
+        with open(self.file, "wb") as fp:
+            fp.write(b"content")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def digest_cached(self):
+        self.logger.info("An unchanged file is only hashed once")
+
+        dc = digestcache(self.saved, self.root)
+        self.assertEqual(dc.get(self.file), hashlib.sha256(b"content").hexdigest())
+        self.assertEqual(dc.get(self.file), hashlib.sha256(b"content").hexdigest())
+        self.assertEqual((dc.hits, dc.misses), (1, 1))
+
+
+    def digest_changed(self):
+        self.logger.info("A changed file is hashed again")
+
+        dc = digestcache(self.saved, self.root)
+        dc.get(self.file)
+        with open(self.file, "ab") as fp:
+            fp.write(b" changed")
+        self.assertEqual(dc.get(self.file), hashlib.sha256(b"content changed").hexdigest())
+        self.assertEqual(dc.misses, 2)
+
+
+    def digest_empty(self):
+        self.logger.info("An empty file can be hashed")
+
+        open(self.file, "wb").close()
+        self.assertEqual(digestcache().get(self.file), hashlib.sha256(b"").hexdigest())
+
+
+    def digest_saved(self):
+        self.logger.info("Digests are loaded from the saved cache")
+
+        dc = digestcache(self.saved, self.root)
+        dc.set(self.file, "0" * 64)
+        dc.save()
+
+        dc = digestcache(self.saved, self.root)
+        self.assertEqual(dc.get(self.file), "0" * 64)
+        self.assertEqual(dc.hits, 1)
+
+
+    def digest_device(self):
+        self.logger.info("Digests saved for the device of another root are moved to this root")
+
+        dc = digestcache(self.saved, self.root)
+        dc.set(self.file, "0" * 64)
+        dc.save()
+
+        # As if the cache was saved in the volume this one is a snapshot of
+        dev = os.stat(self.root).st_dev
+        with open(self.saved, "rt") as fp:
+            saved = json.loads(fp.read().replace("\"{d}:".format(d=dev), "\"{d}:".format(d=dev + 1)))
+        saved["dev"] = dev + 1
+        with open(self.saved, "wt") as fp:
+            fp.write(json.dumps(saved))
+
+        self.assertEqual(digestcache(self.saved, self.root).get(self.file), "0" * 64)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
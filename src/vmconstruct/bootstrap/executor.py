@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.executor
+    :platform: Unix
+    :synopsis: vmconstruct build command executors
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+The commands an image build runs on the host and in the chroot go through
+an executor.  The chroot executor runs them.  The recorder only records
+them and sleeps for a simulated duration, with just enough effect on the
+image tree for the following steps, so the orchestration of a whole
+build plan can be tested and measured without root, debootstrap or a
+network:
+
+    workspace:
+        rootpath: /tmp/workspace
+        backend: directory
+        executor: recorder
+        # Seconds taken by the commands matching each regular expression
+        durations:
+            "apt-get -y install": 0.1
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+
+from . import sandbox
+
+
+_logger = logging.getLogger(__name__)
+
+EXECUTORS = ["chroot", "recorder"]
+
+
+
+class chroot(object):
+    """\
+    Run the commands.
+    """
+    # The chroot needs the bind mounts of /dev, /proc etc and payloads can
+    # be bind mounted
+    binds = True
+    # The mapper forced on every disk or None for the mapper of the vmdef
+    mapper = None
+
+    def __init__(self):
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+
+
+    def run(self, cmd):
+        """\
+        Run cmd on the host.
+        """
+        subprocess.check_call(cmd)
+
+
+    def chroot(self, chrootpath, cmd, limits=None):
+        """\
+        Run cmd in the chroot at chrootpath, with the sandbox limits if they
+        are given.
+
+        :returns: A tuple of the exit code and the resources used, or None
+                  if there were no limits.
+        """
+        if limits is None:
+            return((subprocess.call(["chroot", chrootpath] + cmd), None))
+
+        return(sandbox.run(["chroot", chrootpath] + cmd, limits))
+
+
+
+class recorder(chroot):
+    """\
+    Record the commands without running them.
+    """
+    binds = False
+    mapper = "fake"
+
+    # The directories debootstrap would leave in the image which the build
+    # steps after it rely on
+    SKELETON = ["dev", "etc", "proc", "run", "sys", "tmp", "usr/sbin", "var/cache/apt/archives"]
+    # The host commands which change the image tree
+    _EFFECTS = {
+        "debootstrap": "_debootstrap",
+        "rsync": "_rsync",
+        "mksquashfs": "_mksquashfs"
+    }
+
+    def __init__(self, durations=None):
+        """\
+        The constructor.
+
+        :param durations: A dictionary of regular expression to the seconds
+                          a command matching it takes.  The command is
+                          matched as a space separated string.
+        :type durations: dict.
+        """
+        chroot.__init__(self)
+        self._durations = [(re.compile(k), v) for (k, v) in (durations or {}).items()]
+        self._lock = threading.Lock()
+        self.commands = []
+
+
+    def _simulate(self, cmd, chrootpath=None):
+        duration = 0
+        for (regex, seconds) in self._durations:
+            if regex.search(" ".join(cmd)):
+                duration = seconds
+                break
+
+        self._logger.debug("Simulating {d}s command in {p}: {cmd}".format(d=duration, p=chrootpath, cmd=cmd))
+        time.sleep(duration)
+        with self._lock:
+            self.commands.append({"cmd": cmd, "chroot": chrootpath, "duration": duration})
+
+        return(duration)
+
+
+    def _debootstrap(self, cmd):
+        if "--foreign" not in cmd:
+            return
+        # debootstrap [options] release target archive
+        target = cmd[-2]
+        for d in self.SKELETON:
+            os.makedirs(os.path.join(target, d), exist_ok=True)
+        with open(os.path.join(target, "etc", "fstab"), "wt") as fp:
+            fp.write("# <file system> <mount point> <type> <options> <dump> <pass>\n")
+
+
+    def _rsync(self, cmd):
+        (src, dst) = cmd[-2:]
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+
+
+    def _mksquashfs(self, cmd):
+        open(cmd[2], "wb").close()
+
+
+    def run(self, cmd):
+        self._simulate(cmd)
+        effect = self._EFFECTS.get(os.path.basename(cmd[0]), None)
+        if effect is not None:
+            getattr(self, effect)(cmd)
+
+
+    def chroot(self, chrootpath, cmd, limits=None):
+        duration = self._simulate(cmd, chrootpath)
+        if limits is None:
+            return((0, None))
+
+        return((0, {"wall": duration, "user": 0, "sys": 0, "maxrss": 0, "read": 0, "written": 0}))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.layers
+    :platform: Unix
+    :synopsis: vmconstruct step level layer snapshots
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+This module records a read-only btrfs snapshot of an image after each
+major build step.  Each layer is keyed by a digest chained from the keys
+of the steps before it and the inputs of the step, so a rebuild with
+unchanged inputs can resume from the last good layer instead of starting
+again from the clone.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+
+class layers(object):
+    """\
+    Run the build steps of an image through run() to skip the steps which
+    have a matching layer and snapshot the image after each step which is
+    executed.  Skipped steps are only restored from their snapshot when the
+    next step needs to run or the build is finished.
+    """
+    def __init__(self, image, store):
+        """\
+        The constructor.
+
+        :param image: The image being built.
+        :type image: vmconstruct.bootstrap._image.
+        :param store: The subvolume where the layer snapshots are kept.
+        :type store: vmconstruct.btrfs.subvolume or vmconstruct.btrfs.directory.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._image = image
+        self._store = store
+        self._name = os.path.basename(image.path)
+
+        # The chain starts from the image this one was cloned from
+        self._key = self._digest(None, "origin", [image._status.get("origin", {}).get("uuid", None), self._name])
+        self._resuming = True
+        self._pending = None
+
+
+    def _digest(self, key, step, inputs):
+        s256 = hashlib.sha256()
+        s256.update(json.dumps([key, step, inputs], sort_keys=True, default=str).encode("utf-8"))
+        return(s256.hexdigest())
+
+
+    def run(self, step, inputs, fn, *args, **kw):
+        """\
+        Run fn(*args, **kw) as the build step unless a layer already exists
+        for the step with the same inputs on the same chain.  inputs may be
+        a callable returning them.
+        """
+        if callable(inputs):
+            inputs = inputs()
+        self._key = self._digest(self._key, step, inputs)
+
+        if self._resuming and os.path.isdir(os.path.join(self._store.path, self._key)):
+            self._logger.info("Layer for {step} is unchanged ({k}), skipping".format(step=step, k=self._key))
+            self._pending = self._key
+            return(None)
+
+        # Once a step has run all the following steps must run
+        self._resuming = False
+        self.restore()
+
+        result = fn(*args, **kw)
+        self.commit(step)
+
+        return(result)
+
+
+    def restore(self):
+        """\
+        Replace the image with the snapshot of the last skipped layer.
+        """
+        if not self._pending:
+            return
+
+        self._logger.info("Restoring {n} from layer {k}".format(n=self._name, k=self._pending))
+        parent = self._image._subvol._parent
+        self._image._subvol.delete(recursive=True)
+        # The layer is the same kind of subvolume as the store
+        snap = self._store.__class__(os.path.join(self._store.path, self._pending), self._store)
+        self._image._subvol = snap.snapshot(self._name, parent=parent)
+        self._image._status = None
+        self._image._loadStatus()
+        self._image._digests = None
+        self._pending = None
+
+
+    def commit(self, step):
+        """\
+        Record the layer in the image status and snapshot the image.
+        """
+        self._image._status.setdefault("layers", []).append({
+            "step": step,
+            "key": self._key,
+            "time": time.time()
+        })
+        self._image._saveStatus()
+        self._image._subvol.snapshot(self._key, parent=self._store, readonly=True)
+        self._prune()
+
+
+    def _prune(self):
+        """\
+        Delete the layers which are not on the chain of the current image.
+        """
+        keep = [l["key"] for l in self._image._status.get("layers", [])]
+        for snap in self._store.list():
+            if os.path.basename(snap.path) not in keep:
+                self._logger.debug("Deleting stale layer {s}".format(s=snap.path))
+                snap.delete()
+
+
+    def finish(self):
+        """\
+        At the end of the build make sure the image reflects the last layer.
+        """
+        self.restore()
@@ -0,0 +1,188 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct import bootstrap, btrfs
+from vmconstruct.bootstrap import executor
+
+
+def suite():
+    layersTS = unittest.TestSuite()
+    layersTS.addTest(LayersUT("disabled"))
+    layersTS.addTest(LayersUT("skip"))
+    layersTS.addTest(LayersUT("restore"))
+    layersTS.addTest(LayersUT("finish"))
+    layersTS.addTest(LayersUT("prune"))
+
+    return(layersTS)
+
+
+
+class LayersUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.relvol = btrfs.directory(self.tdir).create("ubuntu").create("focal")
+        self.base = bootstrap.ubuntu(self.relvol.create("_update"), runner=executor.recorder())
+        # As a bootstrap leaves it
+        os.makedirs(os.path.join(self.base.path, "origin"))
+        self.base._status["origin"] = {}
+        self.base.setStatus("complete")
+        self.ran = []
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _vm(self, layers=True):
+        """\
+        Clone a fresh vm from the base as a rebuild would.
+        """
+        self.relvol.create("vm").delete(recursive=True)
+        vm = self.base.clone("vm")
+        if layers:
+            vm.enableLayers()
+
+        return(vm)
+
+
+    def _step(self, vm, name, content):
+        """\
+        A build step which writes content to a file named after it.
+        """
+        self.ran.append(name)
+        with open(os.path.join(vm.path, "origin", name), "wt") as fp:
+            fp.write(content)
+
+
+    def _build(self, vm, steps):
+        for (name, inputs) in steps:
+            vm.layer(name, inputs, self._step, vm, name, str(inputs))
+        vm.finishLayers()
+
+
+    def _read(self, vm, name):
+        with open(os.path.join(vm.path, "origin", name), "rt") as fp:
+            return(fp.read())
+
+
+    def _store(self, vm):
+        return(sorted([os.path.basename(snap.path) for snap in vm._layers._store.list()]))
+
+
+    def disabled(self):
+        self.logger.info("Without layers every step runs and the inputs are not computed")
+
+        vm = self._vm(layers=False)
+
+        def inputs():
+            raise AssertionError("inputs computed with layers disabled")
+        vm.layer("one", inputs, self._step, vm, "one", "1")
+        vm.finishLayers()
+        self.assertEqual(self.ran, ["one"])
+        self.assertNotIn("layers", vm._status)
+        self.assertFalse(os.path.exists(os.path.join(self.relvol.path, "_layers")))
+
+
+    def skip(self):
+        self.logger.info("A rebuild with unchanged inputs skips every step")
+
+        steps = [("one", [1]), ("two", [2])]
+        vm = self._vm()
+        self._build(vm, steps)
+        self.assertEqual(self.ran, ["one", "two"])
+        self.assertEqual([l["step"] for l in vm._status["layers"]], ["one", "two"])
+
+        # Callable inputs are only computed once layers ask for them
+        vm = self._vm()
+        self._build(vm, [("one", lambda: [1]), ("two", lambda: [2])])
+        self.assertEqual(self.ran, ["one", "two"])
+        self.assertEqual(self._read(vm, "two"), "[2]")
+
+
+    def restore(self):
+        self.logger.info("A changed step runs on the image restored from the layer before it")
+
+        vm = self._vm()
+        self._build(vm, [("one", [1]), ("two", [2])])
+
+        vm = self._vm()
+        self.assertFalse(os.path.exists(os.path.join(vm.path, "origin", "one")))
+        self._build(vm, [("one", [1]), ("two", [3])])
+        self.assertEqual(self.ran, ["one", "two", "two"])
+        self.assertEqual((self._read(vm, "one"), self._read(vm, "two")), ("[1]", "[3]"))
+        self.assertEqual(vm.path, os.path.join(self.relvol.path, "vm"))
+        self.assertEqual([l["step"] for l in vm._status["layers"]], ["one", "two"])
+
+
+    def finish(self):
+        self.logger.info("Finishing restores the last skipped layer and nothing more")
+
+        vm = self._vm()
+        self._build(vm, [("one", [1])])
+        # Nothing was skipped so there is nothing to restore
+        vm._layers.finish()
+        self.assertEqual(self._read(vm, "one"), "[1]")
+
+        vm = self._vm()
+        vm.layer("one", [1], self._step, vm, "one", "[1]")
+        self.assertFalse(os.path.exists(os.path.join(vm.path, "origin", "one")))
+        vm.finishLayers()
+        self.assertEqual(self._read(vm, "one"), "[1]")
+        self.assertIsNone(vm._layers._pending)
+        vm.finishLayers()
+        self.assertEqual(self.ran, ["one"])
+
+
+    def prune(self):
+        self.logger.info("Layers which are not on the chain of the image are deleted")
+
+        vm = self._vm()
+        self._build(vm, [("one", [1]), ("two", [2])])
+        first = self._store(vm)
+        self.assertEqual(first, sorted([l["key"] for l in vm._status["layers"]]))
+
+        vm = self._vm()
+        self._build(vm, [("one", [1]), ("two", [3])])
+        second = self._store(vm)
+        self.assertEqual(second, sorted([l["key"] for l in vm._status["layers"]]))
+        self.assertEqual(len(set(first) & set(second)), 1)
+
+        # A changed first step leaves nothing of the old chain
+        vm = self._vm()
+        self._build(vm, [("one", [4])])
+        self.assertEqual(self._store(vm), [vm._status["layers"][0]["key"]])
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
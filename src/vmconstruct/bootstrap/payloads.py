@@ -8,15 +8,44 @@
 
 This module manages the execution of payload scripts in a
 chroot path.
+
+A payload directory may contain a payload.yml manifest:
+
+    # How the payload is made available in the chroot [ *copy | bind ]
+    # copy: a reflink copy (or plain copy across filesystems) the
+    #       scripts may write in
+    # bind: a read-only bind mount of the payload directory
+    staging: bind
+
+    # Files the scripts need, fetched once in to the workspace artifact
+    # store and linked in the staged payload by the url basename (copy
+    # staging only)
+    artifacts:
+        - url: http://example.com/application.zip
+          sha256: <hex digest>
+
+    # Run the payload again in an image derived from one it was already
+    # applied to [ true | *false ]
+    rerun: false
+
+    # Limit each script, see vmconstruct.bootstrap.sandbox.  The scripts
+    # always run through the sandbox so their resource usage is logged.
+    limits:
+        timeout: 3600
+        memory: 4G
 """
 
 import contextlib
+import hashlib
 import logging
 import os
 import shutil
 import subprocess
-import tempfile
+import time
+import urllib.parse
+import yaml
 
+from .. import helpers
 from ..exceptions import *
 
 
@@ -33,19 +62,69 @@ class applyplds(object):
         self._image = image
         if chrootpath is None:
             self._chrootpath = os.path.join(image._subvol._path, "origin")
+            # Only the build of the image itself is a layered step
+            self._layered = True
         else:
             self._chrootpath = chrootpath
+            self._layered = False
         self._plds = plds
-        self._appliers = [apply(self._image, p, self._chrootpath) for p in self._plds]
+        # Only the image itself records the payloads applied to it
+        self._appliers = [apply(self._image, p, self._chrootpath, record=self._layered) for p in self._plds]
+
+
+    def _step(self, step, applier, fn):
+        if self._layered:
+            self._image.layer("payload {s} {p}".format(s=step, p=applier.payload), applier.inputs, fn)
+        else:
+            fn()
 
 
     @contextlib.contextmanager
     def apply(self):
-        with contextlib.ExitStack() as stack:
-            [stack.enter_context(applier) for applier in self._appliers]
-            # TODO: Reverse the order of the items on the stack so the exit
-            # is in the same order as the entry.
+        try:
+            for applier in self._appliers:
+                self._step("pre", applier, applier.pre)
             yield
+            # TODO: Reverse the order so the post scripts run in the same
+            # order as the pre scripts.
+            for applier in reversed(self._appliers):
+                self._step("post", applier, applier.post)
+        except Exception:
+            # Don't leave payloads mounted in the image
+            for applier in self._appliers:
+                applier.unstage(keep=True)
+            raise
+
+
+
+MANIFEST = "payload.yml"
+
+STAGING = ["copy", "bind"]
+
+
+def manifest(payload):
+    """\
+    Return the manifest of the payload, an empty manifest if it has none.
+    """
+    try:
+        with open(os.path.join(payload, MANIFEST), "rb") as fp:
+            pldyml = yaml.safe_load(fp) or {}
+    except FileNotFoundError:
+        pldyml = {}
+
+    if pldyml.get("staging", "copy") not in STAGING:
+        raise Exception("Payload {p} has unknown staging {s}".format(p=payload, s=pldyml["staging"]))
+
+    for artifact in pldyml.get("artifacts", None) or []:
+        if not isinstance(artifact, dict) or not isinstance(artifact.get("url", None), str) or not isinstance(artifact.get("sha256", None), str):
+            raise Exception("Payload {p} artifacts need a url and sha256".format(p=payload))
+    if pldyml.get("artifacts", None) and pldyml.get("staging", "copy") != "copy":
+        raise Exception("Payload {p} artifacts need copy staging".format(p=payload))
+
+    if not isinstance(pldyml.get("limits", None) or {}, dict):
+        raise Exception("Payload {p} limits must be a mapping".format(p=payload))
+
+    return(pldyml)
 
 
 
@@ -55,7 +134,7 @@ class apply(object):
     pre script if it exists on entry, and the post script on exit.
     """
     # TODO: test the payload path exists
-    def __init__(self, image, payload, chrootpath):
+    def __init__(self, image, payload, chrootpath, record=False):
         """\
         The constructor.
 
@@ -65,11 +144,203 @@ class apply(object):
         :type payload: str.
         :param chroot: The directory where the chroot image is mounted.
         :type chroot: str.
+        :param record: Record the payload in the image status and skip it if
+                       it was already applied to the image.
+        :type record: bool.
         """
         self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__+":"+payload)
         self._image = image
         self._payload = payload
         self._chrootpath = chrootpath
+        self._manifest = manifest(payload)
+        # The staging directory name is stable so a payload staged before a
+        # layer snapshot is found again when the layer is restored.
+        self._tdir = os.path.join(self._chrootpath, "tmp", "vmc-payload-{h}".format(h=hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]))
+        self._adir = self._tdir + ".artifacts"
+
+        self._record = record
+        self._key = os.path.abspath(payload)
+        self._digest = None
+        self._applied = record and self.applied()
+
+
+    @property
+    def payload(self):
+        return(self._payload)
+
+
+    @property
+    def digest(self):
+        """\
+        The digest of the payload tree, only computed when it is needed.
+        """
+        if self._digest is None:
+            self._digest = helpers.treedigest(self._key)
+
+        return(self._digest)
+
+
+    @property
+    def staging(self):
+        # An executor which does not bind mount only gets copies
+        if not self._image._runner.binds:
+            return("copy")
+
+        return(self._manifest.get("staging", "copy"))
+
+
+    def inputs(self):
+        """\
+        The inputs which identify this payload for layering.
+        """
+        return([self._payload, self.digest])
+
+
+    def applied(self):
+        """\
+        Return True if the payload with the same content was completely
+        applied to this image, or the image it was cloned from, and does not
+        ask to be run again.
+        """
+        if self._manifest.get("rerun", False):
+            return(False)
+
+        state = self._image._status.get("payloads", {}).get(self._key, {})
+        return(state.get("digest", None) == self.digest and state.get("complete", False))
+
+
+    def _state(self, **kw):
+        """\
+        Update the record of the payload in the image status.
+        """
+        if not self._record:
+            return
+
+        self._image._status.setdefault("payloads", {}).setdefault(self._key, {}).update(kw)
+        self._image._saveStatus()
+
+
+    def _run(self, script):
+        if os.path.exists(os.path.join(self._tdir, script)):
+            try:
+                self._image.execChroot(["sh", "-c", "cd {tdir} && exec ./{s}".format(tdir=os.path.join(*self._tdir.split(os.sep)[-2:]), s=script)], chrootpath=self._chrootpath, limits=self._manifest.get("limits", None) or {})
+            except subprocess.CalledProcessError as e:
+                self._state(**{script: e.returncode})
+                raise
+            except VMCTimeoutError:
+                self._state(**{script: "timeout"})
+                raise
+            self._state(**{script: 0})
+
+
+    @property
+    def artifacts(self):
+        return(self._manifest.get("artifacts", None) or [])
+
+
+    def _bindArtifacts(self):
+        """\
+        Make the artifact store available read-only in the chroot.
+        """
+        if not self.artifacts or not self._image._runner.binds or helpers.ismount(self._adir):
+            return
+
+        try:
+            os.makedirs(self._adir)
+        except FileExistsError:
+            pass
+        subprocess.check_call(["mount", "-o", "bind", self._image.artifacts.store, self._adir])
+        subprocess.check_call(["mount", "-o", "remount,bind,ro", self._adir])
+
+
+    def _linkArtifacts(self):
+        """\
+        Fetch the artifacts and link them in the staged payload by the
+        basename of their url.
+        """
+        for artifact in self.artifacts:
+            stored = self._image.artifacts.fetch(artifact["url"], artifact["sha256"])
+            link = os.path.join(self._tdir, os.path.basename(urllib.parse.urlparse(artifact["url"]).path))
+            if os.path.lexists(link):
+                os.unlink(link)
+            # The link target is the path inside the chroot
+            os.symlink(os.path.join(os.sep, os.path.relpath(self._adir, self._chrootpath), os.path.basename(stored)), link)
+        self._bindArtifacts()
+
+
+    def stage(self):
+        """\
+        Make the payload available in the chroot.  A bind mount costs the
+        same whatever the size of the payload, a copy is a reflink clone
+        when the payload is on the same btrfs filesystem as the image.
+        """
+        if self.staging == "bind":
+            if helpers.ismount(self._tdir):
+                return
+            try:
+                os.makedirs(self._tdir)
+            except FileExistsError:
+                pass
+            self._logger.debug("Binding payload at {tdir}".format(tdir=self._tdir))
+            subprocess.check_call(["mount", "-o", "bind", self._payload, self._tdir])
+            subprocess.check_call(["mount", "-o", "remount,bind,ro", self._tdir])
+        else:
+            if os.path.exists(self._tdir):
+                shutil.rmtree(self._tdir)
+            try:
+                os.makedirs(os.path.dirname(self._tdir))
+            except FileExistsError:
+                pass
+            self._logger.debug("Copying payload to {tdir}".format(tdir=self._tdir))
+            subprocess.check_call(["cp", "-a", "--reflink=auto", self._payload, self._tdir])
+            self._linkArtifacts()
+
+
+    def unstage(self, keep=False):
+        """\
+        Remove the payload from the chroot.  If keep is set a copied payload
+        is left in place to investigate a failure.
+        """
+        if helpers.ismount(self._adir):
+            subprocess.check_call(["umount", self._adir])
+            os.rmdir(self._adir)
+        if helpers.ismount(self._tdir):
+            subprocess.check_call(["umount", self._tdir])
+            os.rmdir(self._tdir)
+        elif os.path.isdir(self._tdir) and not keep:
+            shutil.rmtree(self._tdir)
+
+
+    def pre(self):
+        """\
+        Stage the payload in the chroot and run the pre script.
+        """
+        if self._applied:
+            self._logger.info("Payload is unchanged since it was applied, skipping")
+            self._image.logActivity("payload", {"payload": self._payload, "skipped": True})
+            return
+
+        self._logger.debug("Applying payload")
+        if self._record:
+            self._state(digest=self.digest, pre=None, post=None, complete=False, time=time.time())
+        self.stage()
+        self._run("pre")
+
+
+    def post(self):
+        """\
+        Run the post script and remove the staged payload.
+        """
+        if self._applied:
+            return
+
+        # The mounts are not part of a layer snapshot
+        if self.staging == "bind":
+            self.stage()
+        self._bindArtifacts()
+        self._run("post")
+        self.unstage()
+        self._state(complete=True)
 
 
     def __enter__(self):
@@ -77,17 +348,7 @@ class apply(object):
         Enter using the context manager, apply pre script.
         """
         self._logger.debug("__enter__()")
-        self._logger.debug("Applying payload")
-        self._tdir = tempfile.mkdtemp(dir=os.path.join(self._chrootpath, "tmp"))
-        rsync = [
-            "rsync",
-            "-avHAX",
-            self._payload + "/",
-            self._tdir
-        ]
-        subprocess.check_call(rsync)
-        if os.path.exists(os.path.join(self._tdir, "pre")):
-            self._image.execChroot(["sh", "-c", "cd {tdir} && exec ./pre".format(tdir=os.path.join(*self._tdir.split(os.sep)[-2:]))], chrootpath=self._chrootpath)
+        self.pre()
 
 
     def __exit__(self, *exc_info):
@@ -98,8 +359,7 @@ class apply(object):
         """
         self._logger.debug("__exit__()")
         if any(exc_info):
+            self.unstage(keep=True)
             return(False)
 
-        if os.path.exists(os.path.join(self._tdir, "post")):
-            self._image.execChroot(["sh", "-c", "cd {tdir} && exec ./post".format(tdir=os.path.join(*self._tdir.split(os.sep)[-2:]))], chrootpath=self._chrootpath)
-        shutil.rmtree(self._tdir)
+        self.post()
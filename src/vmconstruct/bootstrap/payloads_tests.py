@@ -0,0 +1,295 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from vmconstruct import helpers
+from vmconstruct.bootstrap import executor
+from vmconstruct.bootstrap.artifacts import artifactstore
+from vmconstruct.bootstrap.payloads import apply, applyplds
+
+
+class _image(object):
+    """\
+    The parts of an image used when applying payloads, the chroot
+    commands are recorded with the staged payload content.
+    """
+    def __init__(self, artifacts=None):
+        self.executed = []
+        self.artifacts = artifactstore(artifacts) if artifacts else None
+        self.fail = None
+        self._status = {}
+        self.activity = []
+        self._runner = executor.chroot()
+
+
+    def _saveStatus(self):
+        pass
+
+
+    def logActivity(self, activity, data):
+        self.activity.append((activity, data))
+
+
+    def execChroot(self, *args, chrootpath=None, limits=None):
+        for cmd in args:
+            tdir = os.path.join(chrootpath, cmd[2].split()[1])
+            self.executed.append((cmd[2].split()[-1], sorted(os.listdir(tdir))))
+            if cmd[2].split()[-1] == self.fail:
+                raise subprocess.CalledProcessError(2, cmd)
+
+
+
+def suite():
+    payloadsTS = unittest.TestSuite()
+    payloadsTS.addTest(PayloadsUT("stage_copy"))
+    payloadsTS.addTest(PayloadsUT("stage_bind"))
+    payloadsTS.addTest(PayloadsUT("stage_rebind"))
+    payloadsTS.addTest(PayloadsUT("post_failed"))
+    payloadsTS.addTest(PayloadsUT("stage_artifacts"))
+    payloadsTS.addTest(PayloadsUT("manifest_invalid"))
+    payloadsTS.addTest(PayloadsUT("record_skip"))
+    payloadsTS.addTest(PayloadsUT("record_changed"))
+    payloadsTS.addTest(PayloadsUT("record_rerun"))
+    payloadsTS.addTest(PayloadsUT("record_failed"))
+    payloadsTS.addTest(PayloadsUT("digest_lazy"))
+
+    return(payloadsTS)
+
+
+
+class PayloadsUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.chroot = os.path.join(self.tdir, "origin")
+        os.makedirs(os.path.join(self.chroot, "tmp"))
+        self.payload = os.path.join(self.tdir, "payload")
+        os.makedirs(self.payload)
+        for script in ["pre", "post"]:
+            with open(os.path.join(self.payload, script), "wt") as fp:
+                fp.write("#!/bin/sh\n")
+            os.chmod(os.path.join(self.payload, script), 0o755)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _manifest(self, content):
+        with open(os.path.join(self.payload, "payload.yml"), "wt") as fp:
+            fp.write(content)
+
+
+    def stage_copy(self):
+        self.logger.info("A copied payload can be written to and is removed after post")
+
+        image = _image()
+        applier = apply(image, self.payload, self.chroot)
+        applier.pre()
+        with open(os.path.join(applier._tdir, "marker"), "wt") as fp:
+            fp.write("written by pre")
+        applier.post()
+        self.assertEqual(image.executed, [("./pre", ["post", "pre"]), ("./post", ["marker", "post", "pre"])])
+        self.assertEqual(os.listdir(os.path.join(self.chroot, "tmp")), [])
+
+
+    def stage_bind(self):
+        self.logger.info("A bound payload is read-only and unmounted after post")
+        if os.geteuid():
+            self.skipTest("bind mounts need root")
+
+        self._manifest("staging: bind\n")
+        image = _image()
+        applier = apply(image, self.payload, self.chroot)
+        applier.pre()
+        try:
+            self.assertTrue(helpers.ismount(applier._tdir))
+            self.assertRaises(OSError, open, os.path.join(applier._tdir, "marker"), "wt")
+        finally:
+            applier.post()
+        self.assertEqual(image.executed, [("./pre", ["payload.yml", "post", "pre"]), ("./post", ["payload.yml", "post", "pre"])])
+        self.assertEqual(os.listdir(os.path.join(self.chroot, "tmp")), [])
+
+
+    def stage_rebind(self):
+        self.logger.info("A bound payload missing after a layer restore is bound again for post")
+        if os.geteuid():
+            self.skipTest("bind mounts need root")
+
+        self._manifest("staging: bind\n")
+        image = _image()
+        applier = apply(image, self.payload, self.chroot)
+        applier.post()
+        self.assertEqual(image.executed, [("./post", ["payload.yml", "post", "pre"])])
+        self.assertFalse(helpers.ismount(applier._tdir))
+
+
+    def post_failed(self):
+        self.logger.info("A failed post script leaves no payload mounted")
+        if os.geteuid():
+            self.skipTest("bind mounts need root")
+
+        self._manifest("staging: bind\n")
+        other = os.path.join(self.tdir, "other")
+        shutil.copytree(self.payload, other)
+        image = _image()
+        image.fail = "./post"
+        plds = applyplds(image, self.payload, other, chrootpath=self.chroot)
+        with self.assertRaises(subprocess.CalledProcessError):
+            with plds.apply():
+                self.assertTrue(all([helpers.ismount(a._tdir) for a in plds._appliers]))
+
+        # Only the post of the last payload ran before the failure
+        self.assertEqual([e[0] for e in image.executed], ["./pre", "./pre", "./post"])
+        self.assertFalse([a for a in plds._appliers if helpers.ismount(a._tdir)])
+        self.assertEqual(os.listdir(os.path.join(self.chroot, "tmp")), [])
+
+
+    def stage_artifacts(self):
+        self.logger.info("Artifacts are linked in the staged payload from the read-only store")
+        if os.geteuid():
+            self.skipTest("bind mounts need root")
+
+        upstream = os.path.join(self.tdir, "upstream", "application.zip")
+        os.makedirs(os.path.dirname(upstream))
+        with open(upstream, "wb") as fp:
+            fp.write(b"application")
+        self._manifest("artifacts:\n    - url: file://{u}\n      sha256: {s}\n".format(u=upstream, s=hashlib.sha256(b"application").hexdigest()))
+
+        image = _image(os.path.join(self.tdir, "artifacts"))
+        applier = apply(image, self.payload, self.chroot)
+        applier.pre()
+        try:
+            link = os.path.join(applier._tdir, "application.zip")
+            self.assertTrue(os.path.islink(link))
+            self.assertTrue(helpers.ismount(applier._adir))
+            # Resolve the link as it would be inside the chroot
+            with open(os.path.join(self.chroot, os.readlink(link)[1:]), "rb") as fp:
+                self.assertEqual(fp.read(), b"application")
+        finally:
+            applier.post()
+        self.assertEqual(os.listdir(os.path.join(self.chroot, "tmp")), [])
+
+
+    def manifest_invalid(self):
+        self.logger.info("An unknown staging method is an error")
+
+        self._manifest("staging: rsync\n")
+        self.assertRaises(Exception, apply, _image(), self.payload, self.chroot)
+        self._manifest("staging: bind\nartifacts:\n    - url: file:///dev/null\n      sha256: {s}\n".format(s="0" * 64))
+        self.assertRaises(Exception, apply, _image(), self.payload, self.chroot)
+
+
+
+    def _apply(self, image):
+        applier = apply(image, self.payload, self.chroot, record=True)
+        applier.pre()
+        applier.post()
+        return(applier)
+
+
+    def record_skip(self):
+        self.logger.info("A payload applied to the parent image is skipped")
+
+        image = _image()
+        self._apply(image)
+        self.assertEqual(len(image.executed), 2)
+        self.assertTrue(list(image._status["payloads"].values())[0]["complete"])
+
+        # A clone inherits the status of its parent
+        image.executed = []
+        self._apply(image)
+        self.assertEqual(image.executed, [])
+        self.assertEqual(image.activity, [("payload", {"payload": self.payload, "skipped": True})])
+
+
+    def record_changed(self):
+        self.logger.info("A payload which changed is applied again")
+
+        image = _image()
+        self._apply(image)
+        with open(os.path.join(self.payload, "data"), "wt") as fp:
+            fp.write("changed")
+        image.executed = []
+        self._apply(image)
+        self.assertEqual(len(image.executed), 2)
+
+
+    def record_rerun(self):
+        self.logger.info("A payload which must rerun is applied again")
+
+        self._manifest("rerun: true\n")
+        image = _image()
+        self._apply(image)
+        image.executed = []
+        self._apply(image)
+        self.assertEqual(len(image.executed), 2)
+
+
+    def record_failed(self):
+        self.logger.info("A payload which failed is not recorded as applied")
+
+        image = _image()
+        image.fail = "./post"
+        self.assertRaises(subprocess.CalledProcessError, self._apply, image)
+        state = list(image._status["payloads"].values())[0]
+        self.assertEqual((state["pre"], state["post"], state["complete"]), (0, 2, False))
+
+        image.fail = None
+        image.executed = []
+        self._apply(image)
+        self.assertEqual(len(image.executed), 2)
+
+
+    def digest_lazy(self):
+        self.logger.info("The payload tree is only hashed for a recorded payload, and only once")
+
+        image = _image()
+        applier = apply(image, self.payload, self.chroot)
+        applier.pre()
+        applier.post()
+        self.assertIsNone(applier._digest)
+        self.assertNotIn("payloads", image._status)
+
+        applier = apply(image, self.payload, self.chroot, record=True)
+        digest = applier._digest
+        self.assertEqual(digest, helpers.treedigest(os.path.abspath(self.payload)))
+        applier.pre()
+        applier.post()
+        self.assertIs(applier.inputs()[1], digest)
+        self.assertEqual(list(image._status["payloads"].values())[0]["digest"], digest)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.bootstrap.sandbox
+    :platform: Unix
+    :synopsis: vmconstruct timed and resource limited commands
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Run a command with an optional timeout and cgroup v2 cpu, memory and io
+limits and measure the resources it used.  The limits are given as a
+dictionary, usually from a payload manifest:
+
+    limits:
+        # Seconds before the command is killed
+        timeout: 3600
+        # Number of CPUs worth of time (cpu.max)
+        cpu: 2
+        # Bytes, or with a K, M, G or T suffix (memory.max)
+        memory: 4G
+        # Bytes per second for a block device (io.max)
+        io:
+            device: /dev/sda
+            rbps: 100M
+            wbps: 50M
+
+Limits which need a cgroup are ignored with a warning if the cgroup v2
+controllers are not available.
+"""
+
+import itertools
+import logging
+import os
+import re
+import signal
+import stat
+import subprocess
+import time
+
+from ..exceptions import *
+
+
+_logger = logging.getLogger(__name__)
+
+# The cgroup v2 hierarchy and the group commands are run in below it
+CGROUP = "/sys/fs/cgroup"
+CGROUP_PARENT = "vmconstruct"
+
+_groups = itertools.count()
+
+
+def size(value):
+    """\
+    Convert a size with an optional K, M, G or T suffix to bytes.
+    """
+    m = re.match("^([0-9]+)([KMGT]?)$", str(value).strip().upper())
+    if not m:
+        raise Exception("Invalid size {v}".format(v=value))
+
+    return(int(m.group(1)) * 1024 ** " KMGT".index(m.group(2) or " "))
+
+
+def _cgwrite(path, value):
+    with open(path, "wt") as fp:
+        fp.write(value)
+
+
+def _cgroup(limits):
+    """\
+    Create a cgroup with the cpu, memory and io limits.
+
+    :returns: The cgroup path or None if no cgroup is needed or the
+              controllers are not available.
+    """
+    controllers = [c for c in ["cpu", "memory", "io"] if limits.get(c, None)]
+    if not controllers:
+        return(None)
+
+    try:
+        with open(os.path.join(CGROUP, "cgroup.controllers"), "rt") as fp:
+            available = fp.read().split()
+        missing = [c for c in controllers if c not in available]
+        if missing:
+            raise Exception("controllers {m} are not available".format(m=missing))
+
+        parent = os.path.join(CGROUP, CGROUP_PARENT)
+        try:
+            os.mkdir(parent)
+        except FileExistsError:
+            pass
+        for path in [CGROUP, parent]:
+            _cgwrite(os.path.join(path, "cgroup.subtree_control"), " ".join(["+"+c for c in controllers]))
+
+        cgroup = os.path.join(parent, "{pid}-{n}".format(pid=os.getpid(), n=next(_groups)))
+        os.mkdir(cgroup)
+    except Exception as e:
+        _logger.warning("Running without cgroup limits {l}: {e}".format(l=controllers, e=e))
+        return(None)
+
+    try:
+        if limits.get("cpu", None):
+            _cgwrite(os.path.join(cgroup, "cpu.max"), "{q} 100000".format(q=int(float(limits["cpu"]) * 100000)))
+        if limits.get("memory", None):
+            _cgwrite(os.path.join(cgroup, "memory.max"), str(size(limits["memory"])))
+        if limits.get("io", None):
+            st = os.stat(limits["io"]["device"])
+            if not stat.S_ISBLK(st.st_mode):
+                raise Exception("{d} is not a block device".format(d=limits["io"]["device"]))
+            rates = ["{k}={v}".format(k=k, v=size(limits["io"][k])) for k in ["rbps", "wbps", "riops", "wiops"] if k in limits["io"]]
+            _cgwrite(os.path.join(cgroup, "io.max"), "{ma}:{mi} {r}".format(ma=os.major(st.st_rdev), mi=os.minor(st.st_rdev), r=" ".join(rates)))
+    except Exception:
+        _cgremove(cgroup)
+        raise
+
+    return(cgroup)
+
+
+def _cgusage(cgroup, usage):
+    """\
+    Replace the rusage figures with those of the whole cgroup, which also
+    counts processes that were not waited for.
+    """
+    try:
+        with open(os.path.join(cgroup, "cpu.stat"), "rt") as fp:
+            cpu = dict([l.split() for l in fp.read().splitlines()])
+        usage["user"] = int(cpu["user_usec"]) / 1000000
+        usage["sys"] = int(cpu["system_usec"]) / 1000000
+    except (OSError, KeyError, ValueError):
+        pass
+
+    try:
+        with open(os.path.join(cgroup, "memory.peak"), "rt") as fp:
+            usage["maxrss"] = int(fp.read())
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(os.path.join(cgroup, "io.stat"), "rt") as fp:
+            io = [dict([f.split("=") for f in l.split()[1:]]) for l in fp.read().splitlines()]
+        usage["read"] = sum([int(d.get("rbytes", 0)) for d in io])
+        usage["written"] = sum([int(d.get("wbytes", 0)) for d in io])
+    except (OSError, ValueError):
+        pass
+
+
+def _cgremove(cgroup):
+    """\
+    Kill anything left in the cgroup and remove it.
+    """
+    try:
+        _cgwrite(os.path.join(cgroup, "cgroup.kill"), "1")
+    except OSError:
+        pass
+
+    for i in range(50):
+        try:
+            os.rmdir(cgroup)
+            return
+        except OSError:
+            time.sleep(0.1)
+    _logger.warning("Failed to remove cgroup {c}".format(c=cgroup))
+
+
+def run(cmd, limits=None):
+    """\
+    Run cmd with the limits.
+
+    :returns: A tuple of the exit code and a dictionary of the resources
+              used, wall, user and sys time in seconds, maxrss, read and
+              written in bytes.
+    :raises: VMCTimeoutError if the command did not finish in time.
+    """
+    limits = limits or {}
+    timeout = limits.get("timeout", None)
+    cgroup = _cgroup(limits)
+
+    def _join():
+        if cgroup:
+            _cgwrite(os.path.join(cgroup, "cgroup.procs"), "0")
+
+    start = time.monotonic()
+    try:
+        # A new session so a timeout can kill everything the command started
+        proc = subprocess.Popen(cmd, preexec_fn=_join, start_new_session=True)
+        delay = 0.001
+        while True:
+            (pid, status, rusage) = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            if timeout is not None and time.monotonic() - start > timeout:
+                _logger.error("Killing {cmd} after {t}s".format(cmd=cmd, t=timeout))
+                os.killpg(proc.pid, signal.SIGKILL)
+                os.wait4(proc.pid, 0)
+                proc.returncode = -signal.SIGKILL
+                raise VMCTimeoutError("{cmd} did not finish in {t}s".format(cmd=cmd, t=timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        # wait4 reaped the child so Popen must not
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+        usage = {
+            "wall": time.monotonic() - start,
+            "user": rusage.ru_utime,
+            "sys": rusage.ru_stime,
+            "maxrss": rusage.ru_maxrss * 1024,
+            "read": rusage.ru_inblock * 512,
+            "written": rusage.ru_oublock * 512
+        }
+        if cgroup:
+            _cgusage(cgroup, usage)
+    finally:
+        if cgroup:
+            _cgremove(cgroup)
+
+    return((proc.returncode, usage))
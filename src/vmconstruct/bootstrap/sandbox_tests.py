@@ -0,0 +1,94 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import time
+import unittest
+
+from vmconstruct.bootstrap import sandbox
+from vmconstruct.exceptions import VMCTimeoutError
+
+
+def suite():
+    sandboxTS = unittest.TestSuite()
+    sandboxTS.addTest(SandboxUT("run_usage"))
+    sandboxTS.addTest(SandboxUT("run_returncode"))
+    sandboxTS.addTest(SandboxUT("run_timeout"))
+    sandboxTS.addTest(SandboxUT("run_cgroup"))
+    sandboxTS.addTest(SandboxUT("size"))
+
+    return(sandboxTS)
+
+
+
+class SandboxUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def run_usage(self):
+        self.logger.info("The resources used by a command are measured")
+
+        (returncode, usage) = sandbox.run(["sh", "-c", "i=0; while [ $i -lt 20000 ] ; do i=$((i+1)) ; done"])
+        self.assertEqual(returncode, 0)
+        self.assertEqual(sorted(usage.keys()), ["maxrss", "read", "sys", "user", "wall", "written"])
+        self.assertTrue(usage["user"] + usage["sys"] > 0)
+        self.assertTrue(usage["maxrss"] > 0)
+
+
+    def run_returncode(self):
+        self.logger.info("The exit code of a failed command is returned")
+
+        self.assertEqual(sandbox.run(["sh", "-c", "exit 3"])[0], 3)
+
+
+    def run_timeout(self):
+        self.logger.info("A command and its children are killed at the timeout")
+
+        start = time.monotonic()
+        self.assertRaises(VMCTimeoutError, sandbox.run, ["sh", "-c", "sleep 30 & sleep 30"], {"timeout": 0.2})
+        self.assertTrue(time.monotonic() - start < 5)
+
+
+    def run_cgroup(self):
+        self.logger.info("A memory limit is applied through a cgroup")
+        if not os.path.isfile(os.path.join(sandbox.CGROUP, "cgroup.controllers")):
+            self.skipTest("cgroup v2 is not mounted at {c}".format(c=sandbox.CGROUP))
+
+        (returncode, usage) = sandbox.run(["sh", "-c", "cat /proc/self/cgroup"], {"memory": "256M"})
+        self.assertEqual(returncode, 0)
+
+
+    def size(self):
+        self.logger.info("Sizes are converted to bytes")
+
+        self.assertEqual(sandbox.size(512), 512)
+        self.assertEqual(sandbox.size("4G"), 4 * 1024 ** 3)
+        self.assertEqual(sandbox.size("100m"), 100 * 1024 ** 2)
+        self.assertRaises(Exception, sandbox.size, "lots")
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -9,18 +9,235 @@
 This is a module to apply templates to a chroot environment.
 """
 
+import concurrent.futures
 import contextlib
 import hashlib
+import importlib.util
+import json
 import logging
 import os
 import stat
+from mako import codegen
 from mako.exceptions import CompileException
-from mako.template import Template
+from mako.template import ModuleTemplate, Template
 
+from .. import helpers
 from ..exceptions import *
 
 
 
+class templatecache(object):
+    """\
+    A cache of compiled templates keyed by the sha256 of the template
+    source, the compile options and the Mako code generator version.  The
+    compiled modules are held in memory and, if a module directory is
+    given, written there so later runs can load them without compiling.
+    """
+    # The options every template is compiled with
+    OPTIONS = {"strict_undefined": True}
+
+    def __init__(self, moddir=None):
+        """\
+        The constructor.
+
+        :param moddir: A directory to persist the compiled template modules.
+        :type moddir: str.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._moddir = moddir
+        self._templates = {}
+
+        if moddir:
+            try:
+                os.makedirs(moddir)
+            except FileExistsError:
+                if not os.path.isdir(moddir):
+                    raise
+
+
+    def _load(self, digest, text):
+        """\
+        Load a compiled module from the module directory.
+        """
+        modfile = os.path.join(self._moddir, "{d}.py".format(d=digest))
+        if not os.path.isfile(modfile):
+            return(None)
+
+        try:
+            spec = importlib.util.spec_from_file_location("_vmc_tpl_{d}".format(d=digest), modfile)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            if getattr(module, "_magic_number", None) != codegen.MAGIC_NUMBER:
+                # Generated for another version of the Mako runtime
+                self._logger.debug("Compiled template {m} is stale, recompiling".format(m=modfile))
+                return(None)
+            return(ModuleTemplate(module, module_filename=modfile, template_source=text))
+        except Exception:
+            self._logger.warning("Failed to load compiled template {m}, recompiling".format(m=modfile), exc_info=True)
+            return(None)
+
+
+    def _store(self, digest, makot):
+        """\
+        Write the compiled module in to the module directory.
+        """
+        modfile = os.path.join(self._moddir, "{d}.py".format(d=digest))
+        tmpfile = "{m}.{pid}.tmp".format(m=modfile, pid=os.getpid())
+        with open(tmpfile, "wb") as fp:
+            fp.write(makot.code.encode("utf-8"))
+        os.rename(tmpfile, modfile)
+
+
+    def get(self, path):
+        """\
+        Return the compiled template for the template file at path.
+        """
+        with open(path, "rb") as tplfp:
+            text = tplfp.read()
+        s256 = hashlib.sha256()
+        s256.update(json.dumps([codegen.MAGIC_NUMBER, self.OPTIONS], sort_keys=True).encode("utf-8"))
+        s256.update(text)
+        digest = s256.hexdigest()
+
+        try:
+            return(self._templates[digest])
+        except KeyError:
+            pass
+
+        makot = self._load(digest, text) if self._moddir else None
+        if makot is None:
+            self._logger.debug("Compiling template {p} ({d})".format(p=path, d=digest))
+            makot = Template(text, uri=digest, **self.OPTIONS)
+            if self._moddir:
+                self._store(digest, makot)
+
+        self._templates[digest] = makot
+        return(makot)
+
+
+
+class templateindex(object):
+    """\
+    An index of the templates in each template directory with their
+    install metadata, grouped by phase.  A directory is only walked and
+    its install defs rendered the first time it is used in a run.
+    """
+    def __init__(self, tplcache):
+        """\
+        The constructor.
+
+        :param tplcache: The cache used to compile the templates.
+        :type tplcache: vmconstruct.bootstrap.templates.templatecache.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._cache = tplcache
+        self._dirs = {}
+
+
+    def _scan(self, tpldir):
+        """\
+        Walk tpldir and group its templates by phase.  Templates which do
+        not declare a phase are grouped under None.
+        """
+        phases = {}
+        if not os.path.isdir(tpldir):
+            return(phases)
+
+        self._logger.debug("Indexing templates in {td}".format(td=tpldir))
+        for (root, dirs, files) in os.walk(tpldir):
+            dirs.sort()
+            for tplfile in sorted([file for file in files if file.endswith(".tpl")]):
+                path = os.path.join(root, tplfile)
+                makot = self._cache.get(path)
+
+                install = {}
+                makot.get_def("install").render(i=install)
+                install["mode"] = int(install.get("mode", "0644"), 8)
+                if isinstance(install.get("phase", None), str):
+                    install["phase"] = [install["phase"]]
+
+                for phase in install.get("phase", [None]):
+                    phases.setdefault(phase, []).append((path, makot, install))
+
+        return(phases)
+
+
+    def templates(self, tpldir, phase):
+        """\
+        Return a list of (path, template, install) for the templates in
+        tpldir which apply in phase.
+        """
+        if tpldir not in self._dirs:
+            self._dirs[tpldir] = self._scan(tpldir)
+
+        phases = self._dirs[tpldir]
+        return(sorted(phases.get(None, []) + (phases.get(phase, []) if phase is not None else []), key=lambda x: x[0]))
+
+
+    def conflicts(self, dirs, phase):
+        """\
+        Return a dictionary of destination filename to the list of
+        directories in dirs which install it in phase, for destinations
+        installed from more than one directory.
+        """
+        dests = {}
+        for tpldir in dirs:
+            for (path, makot, install) in self.templates(tpldir, phase):
+                if tpldir not in dests.setdefault(install["filename"], []):
+                    dests[install["filename"]].append(tpldir)
+
+        return(dict([(f, d) for (f, d) in dests.items() if len(d) > 1]))
+
+
+
+_caches = {}
+
+def cache(moddir=None):
+    """\
+    Return the template cache for moddir, shared for the whole run.
+    """
+    if moddir not in _caches:
+        _caches[moddir] = templatecache(moddir)
+
+    return(_caches[moddir])
+
+
+_indexes = {}
+
+def index(moddir=None):
+    """\
+    Return the template index using the cache for moddir, shared for the
+    whole run.
+    """
+    if moddir not in _indexes:
+        _indexes[moddir] = templateindex(cache(moddir))
+
+    return(_indexes[moddir])
+
+
+def tpldirs(basetemplates, dist, release, name):
+    """\
+    Return the candidate template directories for the image name of
+    release, from the most to the least general.
+    """
+    dirs = []
+    for (r, n) in [("_all", "_all"), ("_all", name), (release, "_all"), (release, name)]:
+        dirs.extend([os.path.join(basetpl, dist, r, n) for basetpl in basetemplates])
+
+    return(dirs)
+
+
+def _moddir(ymlcfg):
+    """\
+    The compiled template directory from the configuration.
+    """
+    try:
+        return(ymlcfg["workspace"].get("templatecache", None))
+    except (KeyError, AttributeError, TypeError):
+        return(None)
+
+
+
 class applydirs(object):
     """\
     This class provides a context manager which can run over a list
@@ -32,15 +249,108 @@ class applydirs(object):
         self._image = image
         self._ymlcfg = ymlcfg
         self._vmyml = vmyml
-        self._dirs = dirs
+        # Most of the candidate directories will not exist
+        self._dirs = [d for d in dirs if os.path.isdir(d)]
+        self._logger.debug("Template directories {d} of {c}".format(d=self._dirs, c=dirs))
+        self._index = index(_moddir(ymlcfg))
         self._appliers = [apply(self._image, self._ymlcfg, self._vmyml, d) for d in self._dirs]
+        self._inputs = None
+
+        # Render templates concurrently with this many threads (0 = serial)
+        try:
+            self._workers = int(ymlcfg["build"].get("templateworkers", 0))
+        except (KeyError, AttributeError, TypeError):
+            self._workers = 0
+
+        # Report destinations written from more than one directory up front
+        for phase in ["PRE", "POST"]:
+            for (filename, tpldirs) in sorted(self._index.conflicts(self._dirs, phase).items()):
+                self._logger.info("{f} is installed in phase {p} from each of {d}".format(f=filename, p=phase, d=tpldirs))
+
+
+    def inputs(self):
+        """\
+        The inputs which identify the templates for layering.  The
+        directories are only hashed when layers ask for it.
+        """
+        if self._inputs is None:
+            self._inputs = [helpers.treedigest(*self._dirs), self._ymlcfg, self._vmyml]
+
+        return(self._inputs)
 
 
     @contextlib.contextmanager
     def apply(self):
-        with contextlib.ExitStack() as stack:
-            [stack.enter_context(applier) for applier in self._appliers]
-            yield
+        self._image.layer("templates PRE", self.inputs, self.install, "PRE")
+        yield
+        self._image.layer("templates POST", self.inputs, self.install, "POST")
+
+
+    def install(self, phase):
+        """\
+        Apply the templates for phase from all the directories.  The POST
+        phase runs in reverse directory order.
+        """
+        if phase == "POST":
+            appliers = reversed(self._appliers)
+        else:
+            appliers = self._appliers
+
+        written = 0
+        skipped = 0
+        if self._workers:
+            (written, skipped) = self._installParallel(phase, list(appliers))
+        else:
+            for applier in appliers:
+                (w, s) = applier.install(phase)
+                written += w
+                skipped += s
+
+        self._image.digests.save()
+        self._image.logActivity("templates", {"phase": phase, "written": written, "skipped": skipped})
+
+
+    def _installParallel(self, phase, appliers):
+        """\
+        Render the templates for phase concurrently and then write them in
+        directory order.  A destination installed from more than one
+        directory is rendered after the earlier directories have written it,
+        as its template may depend on the existing content.  Templates are
+        expected to read no other template destination.
+        """
+        conflicts = self._index.conflicts([a._tplpath for a in appliers], phase)
+        written = 0
+        skipped = 0
+
+        def _write(applier, result):
+            if result is None:
+                return((0, 0))
+            elif applier.write(result):
+                return((1, 0))
+            else:
+                return((0, 1))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            rendering = []
+            for applier in appliers:
+                for (path, makot, install) in applier.templates(phase):
+                    if install["filename"] not in conflicts:
+                        rendering.append((applier, executor.submit(applier.render, phase, makot, install)))
+
+            # Results are collected in order so the outcome is deterministic
+            for (applier, future) in rendering:
+                (w, s) = _write(applier, future.result())
+                written += w
+                skipped += s
+
+        for applier in appliers:
+            for (path, makot, install) in applier.templates(phase):
+                if install["filename"] in conflicts:
+                    (w, s) = _write(applier, applier.render(phase, makot, install))
+                    written += w
+                    skipped += s
+
+        return((written, skipped))
 
 
 
@@ -69,6 +379,7 @@ class apply(object):
         self._ymlcfg = ymlcfg
         self._vmyml = vmyml
         self._tplpath = tplpath
+        self._index = index(_moddir(ymlcfg))
 
 
     def __enter__(self):
@@ -91,99 +402,132 @@ class apply(object):
             return(False)
 
 
+    def templates(self, phase):
+        """\
+        Return a list of (path, template, install) for the templates in
+        tplpath which apply in phase.
+        """
+        return(self._index.templates(self._tplpath, phase))
+
+
+    def render(self, phase, makot, install):
+        """\
+        Render a template for phase.
+
+        :returns: A tuple of (install, rendered bytes, rendered sha256,
+                  existing sha256) or None if the template is not relevant
+                  to the phase.
+        """
+        install = dict(install)
+        install["dest"] = os.path.join(self._image.path, "origin", *install["filename"].split(os.sep))
+
+        self._logger.debug("Installing {filename} from template to {dest}".format(**install))
+
+        renderctx = {
+            "ymlcfg": self._ymlcfg,
+            "vmyml": self._vmyml,
+            "rootpath": os.path.join(self._image.path, "origin"),
+            "phase": phase
+        }
+
+        if os.path.isfile(install["dest"]):
+            # If there is an existing file at the location generate
+            # a checksum for it.  This can be used by a template to
+            # a) decide how to render content based on current source
+            # b) validate that the default file being replaced is the
+            #    the one template is relevant for, e.g. has upstream
+            #    made changes the template should account for.
+            renderctx["sha256"] = self._image.digests.get(install["dest"])
+            self._logger.debug("Existing {filename} checksum {s}".format(s=renderctx["sha256"], **install))
+        else:
+            renderctx["sha256"] = None
+
+        try:
+            rendered = makot.render(**renderctx)
+        except VMCPhaseError:
+            return(None)
+
+        rendered = rendered.encode("utf-8")
+        r256 = hashlib.sha256(rendered).hexdigest()
+
+        try:
+            # For some files we may be interested in the old
+            # content to ensure that our template replaces
+            # it with something compatible.
+            if renderctx["sha256"] not in install["sha256"]:
+                # The rendered file is not acceptable, check if
+                # we already applied this template by examinging
+                # the rendered digest before error.
+                if renderctx["sha256"] == r256:
+                    self._logger.warning("Template was already applied")
+                else:
+                    raise VMCTemplateChecksumError("unacceptable sha256: {c}".format(c=renderctx["sha256"]))
+        except KeyError:
+            pass
+
+        return((install, rendered, r256, renderctx["sha256"]))
+
+
+    def write(self, result):
+        """\
+        Write a rendered template from render() to its destination.
+
+        :returns: False if the file already had the rendered content.
+        """
+        (install, rendered, r256, e256) = result
+        written = False
+
+        if e256 == r256:
+            # The file already has the rendered content
+            self._logger.debug("{filename} is unchanged".format(**install))
+        else:
+            try:
+                # Create the installation path if it isn't already present
+                insdir = os.path.join(os.sep, *install["dest"].split(os.sep)[:-1])
+                self._logger.debug("Creating {insdir} if necessary".format(insdir=insdir))
+                os.makedirs(insdir)
+            except FileExistsError:
+                if not os.path.isdir(insdir):
+                    raise
+
+            with open(install["dest"], "wb") as tplout:
+                tplout.write(rendered)
+            written = True
+
+        dstat = os.stat(install["dest"])
+        dmode = stat.S_IMODE(dstat.st_mode)
+        if dmode != install["mode"]:
+            self._logger.debug("chmod {mode} {dest_oct}".format(dest_oct=oct(install["mode"]), **install))
+            os.chmod(install["dest"], install["mode"])
+        self._image.digests.set(install["dest"], r256)
+
+        return(written)
+
+
     def install(self, phase):
         """\
         Apply the templates in "phase" by searching in tplpath.
+
+        :returns: A tuple of the number of files (written, skipped) because
+                  the content was unchanged.
         """
         # TODO: installation file ownership
+        written = 0
+        skipped = 0
+
         if not os.path.isdir(self._tplpath):
             self._logger.warning("{td} is not a directory, ignoring for templating".format(td=self._tplpath))
-            return
+            return((written, skipped))
 
         self._logger.debug("Applying templates for phase {p}".format(p=phase))
 
-        for (root, dirs, files) in os.walk(self._tplpath):
-            for tplfile in [file for file in files if file.endswith(".tpl")]:
-                with open(os.path.join(root, tplfile), "rb") as tplfp:
-                    makot = Template(tplfp.read(), strict_undefined=True)
+        for (path, makot, install) in self.templates(phase):
+            result = self.render(phase, makot, install)
+            if result is None:
+                continue
+            if self.write(result):
+                written += 1
+            else:
+                skipped += 1
 
-                install = {}
-                makot.get_def("install").render(i=install)
-                install["dest"] = os.path.join(self._image.path, "origin", *install["filename"].split(os.sep))
-                install["mode"] = int(install.get("mode", "0644"), 8)
-
-                try:
-                    # Check the template is relevant to this phase of the build
-                    if phase not in install["phase"]:
-                        continue
-                except KeyError:
-                    pass
-
-                self._logger.debug("Installing {filename} from template to {dest}".format(**install))
-
-                renderctx = {
-                    "ymlcfg": self._ymlcfg,
-                    "vmyml": self._vmyml,
-                    "rootpath": os.path.join(self._image.path, "origin"),
-                    "phase": phase
-                }
-
-                if os.path.isfile(install["dest"]):
-                    # If there is an existing file at the location generate
-                    # a checksum for it.  This can be used by a template to
-                    # a) decide how to render content based on current source
-                    # b) validate that the default file being replaced is the
-                    #    the one template is relevant for, e.g. has upstream
-                    #    made changes the template should account for.
-                    s256 = hashlib.sha256()
-                    with open(install["dest"], "rb") as fp:
-                        while True:
-                            data = fp.read(16 * 4096)
-                            if not data:
-                                break
-                            s256.update(data)
-
-                    renderctx["sha256"] = s256.hexdigest()
-                    self._logger.debug("Existing {filename} checksum {s}".format(s=s256.hexdigest(), **install))
-                else:
-                    renderctx["sha256"] = None
-
-                try:
-                    rendered = makot.render(**renderctx)
-                except VMCPhaseError:
-                    continue
-
-                try:
-                    # For some files we may be interested in the old
-                    # content to ensure that our template replaces
-                    # it with something compatible.
-                    if renderctx["sha256"] not in install["sha256"]:
-                        # The rendered file is not acceptable, check if
-                        # we already applied this template by examinging
-                        # the rendered digest before error.
-                        r256 = hashlib.sha256()
-                        r256.update(rendered.encode("utf-8"))
-                        if renderctx["sha256"] == r256.hexdigest():
-                            self._logger.warning("Template was already applied")
-                        else:
-                            raise VMCTemplateChecksumError("unacceptable sha256: {c}".format(c=renderctx["sha256"]))
-                except KeyError:
-                    pass
-
-                try:
-                    # Create the installation path if it isn't already present
-                    insdir = os.path.join(os.sep, *install["dest"].split(os.sep)[:-1])
-                    self._logger.debug("Creating {insdir} if necessary".format(insdir=insdir))
-                    os.makedirs(insdir)
-                except FileExistsError:
-                    if not os.path.isdir(insdir):
-                        raise
-
-                with open(install["dest"], "wb") as tplout:
-                    tplout.write(rendered.encode("utf-8"))
-
-                dstat = os.stat(install["dest"])
-                dmode = stat.S_IMODE(dstat.st_mode)
-                if dmode != install["mode"]:
-                    self._logger.debug("chmod {mode} {dest_oct}".format(dest_oct=oct(install["mode"]), **install))
-                    os.chmod(install["dest"], install["mode"])
+        return((written, skipped))
@@ -0,0 +1,224 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from mako import codegen
+
+from vmconstruct.bootstrap.digests import digestcache
+from vmconstruct.bootstrap.templates import applydirs, apply, templatecache, templateindex
+
+
+TEMPLATE = """\\
+<%def name="install(i)"><%
+    i["filename"] = "/etc/hostname"
+%></%def>\\
+${vmyml["data"]["hostname"]}
+"""
+
+
+class _image(object):
+    """\
+    The parts of an image used when applying templates.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.activity = []
+        os.makedirs(os.path.join(path, "origin"))
+        self.digests = digestcache(os.path.join(path, "digests.json"), os.path.join(path, "origin"))
+
+
+    def logActivity(self, activity, data):
+        self.activity.append((activity, data))
+
+
+
+def suite():
+    templatesTS = unittest.TestSuite()
+    templatesTS.addTest(TemplatesUT("cache_memory"))
+    templatesTS.addTest(TemplatesUT("cache_content"))
+    templatesTS.addTest(TemplatesUT("cache_moddir"))
+    templatesTS.addTest(TemplatesUT("cache_stale"))
+    templatesTS.addTest(TemplatesUT("index_phase"))
+    templatesTS.addTest(TemplatesUT("index_conflicts"))
+    templatesTS.addTest(TemplatesUT("apply_unchanged"))
+    templatesTS.addTest(TemplatesUT("apply_parallel"))
+
+    return(templatesTS)
+
+
+
+class TemplatesUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.tpl = os.path.join(self.tdir, "hostname.tpl")
+        with open(self.tpl, "wt") as fp:
+            fp.write(TEMPLATE)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _template(self, tpldir, name, filename, phase=None, content="content"):
+        try:
+            os.makedirs(tpldir)
+        except FileExistsError:
+            pass
+        with open(os.path.join(tpldir, name), "wt") as fp:
+            fp.write("<%def name=\"install(i)\"><%\n")
+            fp.write("    i[\"filename\"] = \"{f}\"\n".format(f=filename))
+            if phase:
+                fp.write("    i[\"phase\"] = {p}\n".format(p=phase))
+            fp.write("%></%def>\\\n{c}\n".format(c=content))
+
+
+    def cache_memory(self):
+        self.logger.info("A template is only compiled once")
+
+        tc = templatecache()
+        self.assertIs(tc.get(self.tpl), tc.get(self.tpl))
+
+
+    def cache_content(self):
+        self.logger.info("A changed template is recompiled")
+
+        tc = templatecache()
+        makot = tc.get(self.tpl)
+        with open(self.tpl, "at") as fp:
+            fp.write("extra\n")
+        self.assertIsNot(makot, tc.get(self.tpl))
+
+
+    def cache_moddir(self):
+        self.logger.info("A compiled template is loaded from the module directory")
+
+        moddir = os.path.join(self.tdir, "modules")
+        templatecache(moddir).get(self.tpl)
+        self.assertEqual(len([m for m in os.listdir(moddir) if m.endswith(".py")]), 1)
+
+        makot = templatecache(moddir).get(self.tpl)
+        install = {}
+        makot.get_def("install").render(i=install)
+        self.assertEqual(install["filename"], "/etc/hostname")
+        self.assertEqual(makot.render(vmyml={"data": {"hostname": "dmukd0"}}), "dmukd0\n")
+        self.assertRaises(NameError, makot.render)
+
+
+    def cache_stale(self):
+        self.logger.info("A module generated for another Mako runtime is recompiled")
+
+        moddir = os.path.join(self.tdir, "modules")
+        templatecache(moddir).get(self.tpl)
+        modfile = os.path.join(moddir, [m for m in os.listdir(moddir) if m.endswith(".py")][0])
+        with open(modfile, "rt") as fp:
+            code = fp.read()
+        with open(modfile, "wt") as fp:
+            fp.write(code.replace("_magic_number = ", "_magic_number = -1 + "))
+
+        makot = templatecache(moddir).get(self.tpl)
+        self.assertEqual(makot.render(vmyml={"data": {"hostname": "dmukd0"}}), "dmukd0\n")
+        # and written again for this runtime
+        with open(modfile, "rt") as fp:
+            self.assertIn("_magic_number = {n}\n".format(n=codegen.MAGIC_NUMBER), fp.read())
+
+
+    def index_phase(self):
+        self.logger.info("The index only returns templates relevant to the phase")
+
+        tpldir = os.path.join(self.tdir, "a")
+        self._template(tpldir, "all.tpl", "/etc/all")
+        self._template(tpldir, "pre.tpl", "/etc/pre", ["PRE"])
+        self._template(tpldir, "post.tpl", "/etc/post", ["POST"])
+
+        ti = templateindex(templatecache())
+        self.assertEqual([i["filename"] for (p, m, i) in ti.templates(tpldir, "PRE")], ["/etc/all", "/etc/pre"])
+        self.assertEqual([i["filename"] for (p, m, i) in ti.templates(tpldir, "POST")], ["/etc/all", "/etc/post"])
+        self.assertEqual(ti.templates(os.path.join(self.tdir, "missing"), "PRE"), [])
+
+
+    def index_conflicts(self):
+        self.logger.info("Destinations installed from more than one directory are reported")
+
+        dira = os.path.join(self.tdir, "a")
+        dirb = os.path.join(self.tdir, "b")
+        self._template(dira, "hosts.tpl", "/etc/hosts")
+        self._template(dira, "motd.tpl", "/etc/motd", ["POST"])
+        self._template(dirb, "hosts.tpl", "/etc/hosts")
+        self._template(dirb, "motd.tpl", "/etc/motd", ["PRE"])
+
+        ti = templateindex(templatecache())
+        self.assertEqual(ti.conflicts([dira, dirb], "PRE"), {"/etc/hosts": [dira, dirb]})
+        self.assertEqual(ti.conflicts([dira, dirb], "POST"), {"/etc/hosts": [dira, dirb]})
+
+
+    def apply_unchanged(self):
+        self.logger.info("Re-applying a template does not rewrite the file")
+
+        tpldir = os.path.join(self.tdir, "a")
+        self._template(tpldir, "motd.tpl", "/etc/motd")
+        image = _image(os.path.join(self.tdir, "image"))
+
+        applier = apply(image, {}, {}, tpldir)
+        self.assertEqual(applier.install("PRE"), (1, 0))
+        mtime = os.stat(os.path.join(image.path, "origin", "etc", "motd")).st_mtime_ns
+        self.assertEqual(applier.install("POST"), (0, 1))
+        self.assertEqual(os.stat(os.path.join(image.path, "origin", "etc", "motd")).st_mtime_ns, mtime)
+        # The digest recorded on write is used instead of hashing the file
+        self.assertEqual((image.digests.hits, image.digests.misses), (1, 0))
+
+
+    def apply_parallel(self):
+        self.logger.info("Parallel rendering gives the same result as serial rendering")
+
+        dira = os.path.join(self.tdir, "a")
+        dirb = os.path.join(self.tdir, "b")
+        for n in range(16):
+            self._template(dira, "a{n}.tpl".format(n=n), "/etc/a{n}".format(n=n), content="a{n}".format(n=n))
+        self._template(dira, "hosts.tpl", "/etc/hosts", content="first")
+        # The later directory sees the content written by the earlier one
+        self._template(dirb, "hosts.tpl", "/etc/hosts", content="${sha256}")
+
+        results = []
+        for workers in [0, 4]:
+            image = _image(os.path.join(self.tdir, "image{w}".format(w=workers)))
+            applydirs(image, {"build": {"templateworkers": workers}}, {}, dira, dirb).install("PRE")
+            self.assertEqual(image.activity, [("templates", {"phase": "PRE", "written": 18, "skipped": 0})])
+            etc = os.path.join(image.path, "origin", "etc")
+            results.append(dict([(f, open(os.path.join(etc, f)).read()) for f in os.listdir(etc)]))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[1]["hosts"], hashlib.sha256(b"first\n").hexdigest() + "\n")
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -4,6 +4,7 @@ __all__ = []
 import errno
 import logging
 import os
+import shutil
 import subprocess
 
 
@@ -96,20 +97,27 @@ class subvolume(object):
         subprocess.check_call(cmd)
 
 
-    def snapshot(self, name):
+    def snapshot(self, name, parent=None, readonly=False):
+        """\
+        Snapshot this volume to name under parent (default: alongside this
+        volume).
+        """
         if os.sep in name:
             raise Exception("recursive creation not supported")
 
-        destpath = os.path.join(self._parent.path, name)
+        if parent is None:
+            parent = self._parent
+
+        destpath = os.path.join(parent.path, name)
 
         if os.path.exists(destpath):
                 raise OSError(errno.EEXIST, destpath)
 
-        cmd = ["btrfs", "subvolume", "snapshot", self._path, destpath]
+        cmd = ["btrfs", "subvolume", "snapshot"] + (["-r"] if readonly else []) + [self._path, destpath]
         self._logger.debug("Creating snapshot with command: {cmd}".format(cmd=cmd))
         subprocess.check_call(cmd)
 
-        return(subvolume(os.path.join(self._parent.path, name), self._parent))
+        return(subvolume(destpath, parent))
 
 
     def reset(self):
@@ -117,3 +125,94 @@ class subvolume(object):
         # this function should delete/recreate the snapshot not the volume
         self.delete()
         self._parent.create(self._path.split(os.sep).pop())
+
+
+
+class directory(subvolume):
+    """\
+    A subvolume stand in for a workspace on any filesystem, such as a
+    tmpfs for tests and benchmarks, which needs no root privileges.  A
+    subvolume is a directory with a marker file, a snapshot is a copy which
+    shares the extents where the filesystem supports reflinks.  As with
+    btrfs the subvolumes nested in a snapshot are left empty.
+    """
+    MARKER = ".vmc-subvolume"
+
+
+    def create(self, name, eexist=False):
+        """
+        Create a subvolume under this volume
+        """
+
+        if os.sep in name:
+            raise Exception("recursive creation not supported")
+
+        path = os.path.join(self._path, name)
+        if os.path.exists(os.path.join(path, self.MARKER)):
+            if eexist:
+                # An existing subvolume of this name and we asked for it to raise an error
+                raise OSError(errno.EEXIST, path)
+        elif os.path.exists(path):
+            # There is already a dirent of name in the path and it is not a subvolume
+            raise OSError(errno.EEXIST, path)
+        else:
+            self._logger.debug("Creating subvolume directory {p}".format(p=path))
+            os.makedirs(path)
+            open(os.path.join(path, self.MARKER), "wb").close()
+
+        return(directory(path, self))
+
+
+    def list(self):
+        """
+        List existing subvolumes in this subvolume (direct descendents)
+        """
+        subvols = []
+        for (dirpath, dirnames, filenames) in os.walk(self._path):
+            for d in list(dirnames):
+                if os.path.exists(os.path.join(dirpath, d, self.MARKER)):
+                    subvols.append(directory(os.path.join(dirpath, d), self))
+                    # Nested subvolumes belong to the child
+                    dirnames.remove(d)
+
+        return(subvols)
+
+
+    def delete(self, recursive=False):
+        """\
+        Delete a subvolume (recursively)
+        """
+        subvols = self.list()
+        if subvols and not recursive:
+            raise OSError(errno.ENOTEMPTY, self._path)
+
+        self._logger.debug("Deleting subvolume directory {p}".format(p=self._path))
+        shutil.rmtree(self._path)
+
+
+    def snapshot(self, name, parent=None, readonly=False):
+        """\
+        Snapshot this volume to name under parent (default: alongside this
+        volume).  readonly is not enforced.
+        """
+        if os.sep in name:
+            raise Exception("recursive creation not supported")
+
+        if parent is None:
+            parent = self._parent
+
+        destpath = os.path.join(parent.path, name)
+
+        if os.path.exists(destpath):
+                raise OSError(errno.EEXIST, destpath)
+
+        cmd = ["cp", "-a", "--reflink=auto", self._path, destpath]
+        self._logger.debug("Creating snapshot with command: {cmd}".format(cmd=cmd))
+        subprocess.check_call(cmd)
+
+        snapshot = directory(destpath, parent)
+        for subvol in snapshot.list():
+            shutil.rmtree(subvol.path)
+            os.mkdir(subvol.path)
+
+        return(snapshot)
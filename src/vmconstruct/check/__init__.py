@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.check
+    :platform: Unix
+    :synopsis: vmconstruct configuration and template validation
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Validate the configuration, the vmdefs and the templates before any
+build work is started so that a mistake is reported in seconds instead
+of after the bootstrap and package installation.  No root privileges or
+btrfs workspace are needed.
+"""
+
+import logging
+import os
+import re
+import tempfile
+
+import jsonschema
+import yaml
+
+from . import schema
+from ..bootstrap import payloads, templates
+from ..bootstrap.digests import digestcache
+from ..disks import partition, usage
+from ..exceptions import *
+
+
+
+class _image(object):
+    """\
+    A stand in for an image with an empty root so the templates can be
+    rendered without a workspace.
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, "origin"))
+        self.digests = digestcache()
+
+
+    def logActivity(self, activity, data):
+        pass
+
+
+
+class checker(object):
+    """\
+    Collect the errors and warnings for a configuration.  Errors will
+    make the build fail, warnings are for things which can only be
+    confirmed with the content of a real image.
+    """
+    def __init__(self, ymlcfg):
+        """\
+        The constructor.
+
+        :param ymlcfg: The loaded vmc.yml configuration.
+        :type ymlcfg: dict.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._ymlcfg = ymlcfg
+        self._index = templates.index(templates._moddir(ymlcfg))
+        self._checked = {}
+        self.errors = []
+        self.warnings = []
+
+
+    def _error(self, where, msg):
+        e = "{w}: {m}".format(w=where, m=msg)
+        if e not in self.errors:
+            self.errors.append(e)
+
+
+    def _warning(self, where, msg):
+        w = "{w}: {m}".format(w=where, m=msg)
+        if w not in self.warnings:
+            self.warnings.append(w)
+
+
+    def _validate(self, where, document, docschema):
+        """\
+        Validate document against docschema.
+
+        :returns: True if the document is valid.
+        """
+        valid = True
+        validator = jsonschema.Draft4Validator(docschema)
+        for error in sorted(validator.iter_errors(document), key=lambda e: [str(p) for p in e.path]):
+            for e in self._oneOf(error):
+                path = "/".join([str(p) for p in e.absolute_path])
+                self._error(where, "{p}: {m}".format(p=path or "(top)", m=e.message))
+            valid = False
+
+        return(valid)
+
+
+    def _oneOf(self, error):
+        """\
+        For an error from oneOf return the errors of the alternatives
+        whose type matched the document instead of the error for the whole
+        document.
+        """
+        if not error.context:
+            return([error])
+
+        branches = {}
+        for e in error.context:
+            branches.setdefault(e.schema_path[0], []).append(e)
+        matched = [b for b in branches.values() if not [e for e in b if list(e.relative_path) == ["type"]]]
+        if not matched:
+            return([jsonschema.exceptions.best_match(error.context)])
+
+        return([e for b in matched for e in b])
+
+
+    def _install(self, path, install):
+        """\
+        Check the install metadata of a template.
+        """
+        if not isinstance(install.get("filename", None), str) or not install["filename"].startswith(os.sep):
+            self._error(path, "install filename must be an absolute path")
+
+        try:
+            int(install.get("mode", "0644"), 8)
+        except (TypeError, ValueError):
+            self._error(path, "install mode {m!r} is not an octal string".format(m=install.get("mode")))
+
+        phase = install.get("phase", [])
+        if not isinstance(phase, (str, list)) or (isinstance(phase, list) and not all([isinstance(p, str) for p in phase])):
+            self._error(path, "install phase must be a string or a list of strings")
+
+        if "sha256" in install:
+            if not isinstance(install["sha256"], list):
+                self._error(path, "install sha256 must be a list")
+            else:
+                for s256 in install["sha256"]:
+                    if not isinstance(s256, str) or not re.match("^[0-9a-f]{64}$", s256):
+                        self._error(path, "install sha256 {s!r} is not a sha256 hex digest".format(s=s256))
+
+
+    def _compile(self, tpldir):
+        """\
+        Compile the templates in tpldir and check their install metadata.
+
+        :returns: True if every template in the directory is usable.
+        """
+        if tpldir in self._checked:
+            return(self._checked[tpldir])
+
+        usable = True
+        for (root, dirs, files) in os.walk(tpldir):
+            dirs.sort()
+            for tplfile in sorted([file for file in files if file.endswith(".tpl")]):
+                path = os.path.join(root, tplfile)
+                try:
+                    makot = self._index._cache.get(path)
+                except Exception as e:
+                    self._error(path, "does not compile: {e}".format(e=e))
+                    usable = False
+                    continue
+
+                install = {}
+                try:
+                    makot.get_def("install").render(i=install)
+                except Exception as e:
+                    self._error(path, "install def failed: {e!r}".format(e=e))
+                    usable = False
+                    continue
+
+                errors = len(self.errors)
+                self._install(path, install)
+                usable = usable and len(self.errors) == errors
+
+        self._checked[tpldir] = usable
+        return(usable)
+
+
+    def templates(self, where, tpldirs, vmyml):
+        """\
+        Compile the templates in tpldirs and render each of them for every
+        phase with vmyml against an empty root.
+        """
+        # Most of the candidate directories will not exist
+        dirs = [d for d in tpldirs if os.path.isdir(d)]
+        with tempfile.TemporaryDirectory(prefix="vmc-check-") as tmpdir:
+            image = _image(os.path.join(tmpdir, "image"))
+            for tpldir in [d for d in dirs if self._compile(d)]:
+                applier = templates.apply(image, self._ymlcfg, vmyml, tpldir)
+                for phase in ["PRE", "POST"]:
+                    for (path, makot, install) in applier.templates(phase):
+                        if [e for e in self.errors if e.startswith(path+":") and where in e]:
+                            # Only report the first phase which fails
+                            continue
+                        try:
+                            applier.render(phase, makot, install)
+                        except VMCTemplateChecksumError:
+                            # There is no existing file to match
+                            pass
+                        except OSError as e:
+                            self._warning(path, "needs image content to render for {w}: {e}".format(w=where, e=e))
+                        except Exception as e:
+                            self._error(path, "failed to render for {w} in phase {p}: {e!r}".format(w=where, p=phase, e=e))
+
+        for phase in ["PRE", "POST"]:
+            for (filename, cdirs) in sorted(self._index.conflicts([d for d in dirs if self._checked[d]], phase).items()):
+                self._warning(where, "{f} is installed in phase {p} from each of {d}".format(f=filename, p=phase, d=cdirs))
+
+
+    def payloads(self, where, plds):
+        """\
+        Check the payload directories exist and their manifests.
+        """
+        for payload in plds or []:
+            if not os.path.isdir(payload):
+                self._error(where, "payload {p} is not a directory".format(p=payload))
+                continue
+
+            try:
+                payloads.manifest(payload)
+            except Exception as e:
+                self._error(where, "payload manifest: {e}".format(e=e))
+
+
+    def disk(self, where, defn):
+        """\
+        Build the partition table of a hdd disk definition in memory to check
+        the geometry and that the partitions fit.
+        """
+        table = partition.mbr if defn.get("label", "gpt") == "mbr" else partition.gpt
+        try:
+            pt = table(sector_size=defn.get("sector_size", None), alignment=defn.get("alignment", partition.ALIGNMENT))
+            for (idx, part) in sorted((defn.get("partitions", None) or {}).items()):
+                # An auto size is only known when the origin is built
+                sizemb = 1 if usage.isauto(part["size"]) else part["size"]
+                pt.addPartition(idx, sizemb, part.get("partcode", part["filesystem"]), name=part.get("name", part.get("label", None)), flags=part.get("flags", []))
+        except Exception as e:
+            self._error(where, "invalid partition table: {e!r}".format(e=e))
+
+
+    def vmdef(self, vmdef):
+        """\
+        Check a vmdef and the templates and payloads it uses.
+        """
+        where = "vmdef {v}".format(v=vmdef)
+        try:
+            with open(os.path.join(self._ymlcfg["global"]["paths"]["vmdefs"], vmdef+".yml"), "rb") as vmymlfp:
+                vmyml = yaml.safe_load(vmymlfp)
+        except Exception as e:
+            self._error(where, "cannot load: {e}".format(e=e))
+            return
+
+        if isinstance(vmyml, dict) and isinstance(vmyml.get("settings", None), dict) and vmyml["settings"].get("pause", False) == True:
+            # Paused definitions are not built so may be incomplete
+            self._logger.debug("Not checking {v} due to pause flag".format(v=vmdef))
+            return
+
+        if not self._validate(where, vmyml, schema.VMDEF):
+            return
+
+        self.payloads(where, vmyml["settings"].get("payloads", []))
+        for (dname, d) in (vmyml.get("disks", None) or {}).items():
+            if d["type"] == "hdd":
+                self.payloads("{w} disk {d}".format(w=where, d=dname), d.get("payloads", []))
+                for (k, v) in d.items():
+                    if k not in schema.VMDEF_HDD_KEYS:
+                        self.disk("{w} disk {d}/{k}".format(w=where, d=dname, k=k), v)
+
+        tpldirs = templates.tpldirs(self._ymlcfg["build"]["basetemplates"] or [], vmyml["dist"], vmyml["release"], vmdef)
+        for tpldir in vmyml["settings"].get("templates", None) or []:
+            if not os.path.isdir(tpldir):
+                self._error(where, "template directory {d} does not exist".format(d=tpldir))
+            tpldirs.append(tpldir)
+        self.templates(where, tpldirs, vmyml)
+
+
+    def run(self):
+        """\
+        Check the configuration and every vmdef in it.
+
+        :returns: A tuple of the lists of (errors, warnings).
+        """
+        if not self._validate("config", self._ymlcfg, schema.CONFIG):
+            return((self.errors, self.warnings))
+
+        basetemplates = self._ymlcfg["build"]["basetemplates"] or []
+        updates = self._ymlcfg["build"].get("updates", None) or {}
+        for (dist, rels) in self._ymlcfg["build"]["basereleases"].items():
+            for rel in rels or []:
+                where = "update {d} {r}".format(d=dist, r=rel)
+                for r in ["_all", rel]:
+                    self.payloads(where, ((updates.get(dist, None) or {}).get(r, None) or {}).get("payloads", None))
+                self.templates(where, templates.tpldirs(basetemplates, dist, rel, "_update"), {"dist": dist, "release": rel})
+
+        for vmdef in self._ymlcfg["build"]["vmdefs"] or []:
+            self.vmdef(vmdef)
+
+        return((self.errors, self.warnings))
+
+
+
+def check(ymlcfg):
+    """\
+    Check the configuration, logging the warnings and errors found.
+
+    :raises: VMCCheckError if there are any errors.
+    """
+    logger = logging.getLogger(__name__)
+    (errors, warnings) = checker(ymlcfg).run()
+    for w in warnings:
+        logger.warning(w)
+    for e in errors:
+        logger.error(e)
+
+    if errors:
+        raise VMCCheckError("{n} error(s) found in the configuration".format(n=len(errors)))
+    logger.info("Configuration checked with {n} warning(s)".format(n=len(warnings)))
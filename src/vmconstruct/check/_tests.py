@@ -0,0 +1,265 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 ${0}
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct.check import check, checker
+from vmconstruct.exceptions import VMCCheckError
+
+
+VMDEF = """\
+dist: ubuntu
+release: trusty
+settings:
+    onexist: rebuild
+    pause: {pause}
+disks:
+    xvda:
+        type: squash
+        path: /
+data:
+    hostname: dmukd0
+"""
+
+
+def suite():
+    checkTS = unittest.TestSuite()
+    checkTS.addTest(CheckUT("config_valid"))
+    checkTS.addTest(CheckUT("config_invalid"))
+    checkTS.addTest(CheckUT("vmdef_invalid"))
+    checkTS.addTest(CheckUT("vmdef_paused"))
+    checkTS.addTest(CheckUT("vmdef_geometry"))
+    checkTS.addTest(CheckUT("vmdef_defaults"))
+    checkTS.addTest(CheckUT("vmdef_autosize"))
+    checkTS.addTest(CheckUT("vmdef_payloads"))
+    checkTS.addTest(CheckUT("template_undefined"))
+    checkTS.addTest(CheckUT("template_install"))
+    checkTS.addTest(CheckUT("template_content"))
+    checkTS.addTest(CheckUT("check_raises"))
+
+    return(checkTS)
+
+
+
+class CheckUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.tpldir = os.path.join(self.tdir, "tpl")
+        self.vmdefdir = os.path.join(self.tdir, "vmdefs")
+        os.makedirs(os.path.join(self.tpldir, "ubuntu", "_all", "_all"))
+        os.makedirs(self.vmdefdir)
+        self.ymlcfg = {
+            "workspace": {"rootpath": os.path.join(self.tdir, "workspace")},
+            "build": {
+                "basereleases": {"ubuntu": ["trusty"]},
+                "basetemplates": [self.tpldir],
+                "vmdefs": ["test"]
+            },
+            "global": {"paths": {"vmdefs": self.vmdefdir}}
+        }
+        self._vmdef("test")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _vmdef(self, name, content=VMDEF.format(pause="false")):
+        with open(os.path.join(self.vmdefdir, name+".yml"), "wt") as fp:
+            fp.write(content)
+
+
+    def _template(self, name, install, content="content"):
+        with open(os.path.join(self.tpldir, "ubuntu", "_all", "_all", name), "wt") as fp:
+            fp.write("<%def name=\"install(i)\"><%\n")
+            for (k, v) in install.items():
+                fp.write("    i[\"{k}\"] = {v!r}\n".format(k=k, v=v))
+            fp.write("%></%def>\\\n{c}\n".format(c=content))
+
+
+    def config_valid(self):
+        self.logger.info("A valid configuration has no errors")
+
+        self._template("hostname.tpl", {"filename": "/etc/hostname"}, "${vmyml.get('data', {}).get('hostname', 'ubuntu')}")
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, [])
+
+
+    def config_invalid(self):
+        self.logger.info("Configuration errors are reported with their path")
+
+        self.ymlcfg["build"]["templateworkers"] = "four"
+        del(self.ymlcfg["global"]["paths"]["vmdefs"])
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue([e for e in errors if e.startswith("config: build/templateworkers:")])
+        self.assertTrue([e for e in errors if e.startswith("config: global/paths:")])
+
+
+    def vmdef_invalid(self):
+        self.logger.info("A vmdef error is reported for the disk type it is")
+
+        self._vmdef("test", VMDEF.format(pause="false").replace("type: squash\n        path: /", "type: hdd\n        xvdb:\n            label: gpx"))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("vmdef test: disks/xvda/xvdb/label:"))
+
+
+    def vmdef_paused(self):
+        self.logger.info("A paused vmdef is not checked")
+
+        self._vmdef("test", VMDEF.format(pause="true") + "packages: ubuntu-desktop\n")
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+
+
+    def vmdef_geometry(self):
+        self.logger.info("Disk sector sizes and alignments are checked")
+
+        hdd = "type: hdd\n        xvdb:\n            label: {label}\n            sector_size: {ss}\n            alignment: {align}\n            partitions:\n                1:\n                    size: {size}\n                    filesystem: ext4"
+        vmdef = VMDEF.format(pause="false").replace("type: squash\n        path: /", hdd)
+
+        self._vmdef("test", vmdef.format(label="gpt", ss=4096, align=3145728, size=512))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+
+        self._vmdef("test", vmdef.format(label="gpt", ss=1024, align=1048576, size=512))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("vmdef test: disks/xvda/xvdb/sector_size:"))
+
+        self._vmdef("test", vmdef.format(label="gpt", ss=4096, align=512, size=512))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("vmdef test disk xvda/xvdb: invalid partition table: InvalidGeometry"))
+
+        self._vmdef("test", vmdef.format(label="mbr", ss=512, align=1048576, size=3*1024*1024))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue("PartitionTooLarge" in errors[0])
+
+
+    def vmdef_defaults(self):
+        self.logger.info("The disk label defaults to gpt and a partition needs a filesystem")
+
+        hdd = "type: hdd\n        xvdb:\n            partitions:\n                1:\n                    size: 64\n                    {fs}"
+        vmdef = VMDEF.format(pause="false").replace("type: squash\n        path: /", hdd)
+
+        self._vmdef("test", vmdef.format(fs="filesystem: ext4"))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+
+        self._vmdef("test", vmdef.format(fs="partcode: linux/filesystem"))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("vmdef test: disks/xvda/xvdb/partitions/1:"))
+        self.assertTrue("'filesystem' is a required property" in errors[0])
+
+
+    def vmdef_autosize(self):
+        self.logger.info("A partition size may be auto with optional headroom")
+
+        hdd = "type: hdd\n        xvdb:\n            label: gpt\n            partitions:\n                1:\n                    size: {size}\n                    mount: /\n                    filesystem: ext4"
+        vmdef = VMDEF.format(pause="false").replace("type: squash\n        path: /", hdd)
+
+        for size in ["auto", "auto+20%"]:
+            self._vmdef("test", vmdef.format(size=size))
+            (errors, warnings) = checker(self.ymlcfg).run()
+            self.assertEqual(errors, [])
+
+        self._vmdef("test", vmdef.format(size="auto-5%"))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 1)
+
+
+    def vmdef_payloads(self):
+        self.logger.info("The payloads of a vmdef and an update have valid manifests")
+
+        payload = os.path.join(self.tdir, "payload")
+        os.makedirs(payload)
+        with open(os.path.join(payload, "payload.yml"), "wt") as fp:
+            fp.write("staging: copy\nartifacts:\n    - url: https://example.com/a.tgz\n      sha256: \"{s}\"\nlimits:\n    timeout: 60\n".format(s="0" * 64))
+        self._vmdef("test", VMDEF.format(pause="false").replace("    onexist: rebuild\n", "    onexist: rebuild\n    payloads: [{p}]\n".format(p=payload)))
+        self.ymlcfg["build"]["updates"] = {"ubuntu": {"_all": {"payloads": [payload]}}}
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+
+        with open(os.path.join(payload, "payload.yml"), "wt") as fp:
+            fp.write("staging: bind\nartifacts:\n    - url: https://example.com/a.tgz\n      sha256: \"{s}\"\n".format(s="0" * 64))
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0].startswith("update ubuntu trusty: payload manifest: Payload {p} artifacts need copy staging".format(p=payload)))
+        self.assertTrue(errors[1].startswith("vmdef test: payload manifest:"))
+
+        shutil.rmtree(payload)
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[1].endswith("payload {p} is not a directory".format(p=payload)))
+
+
+    def template_undefined(self):
+        self.logger.info("A template using an undefined name fails to render")
+
+        self._template("hostname.tpl", {"filename": "/etc/hostname"}, "${hostname}")
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 2)
+        self.assertTrue("update ubuntu trusty" in errors[0])
+        self.assertTrue("vmdef test" in errors[1])
+
+
+    def template_install(self):
+        self.logger.info("Bad install metadata is reported")
+
+        self._template("hostname.tpl", {"filename": "etc/hostname", "mode": "rw", "sha256": ["abc"]})
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(len(errors), 3)
+
+
+    def template_content(self):
+        self.logger.info("A template which reads the image is only a warning")
+
+        self._template("modules.tpl", {"filename": "/etc/modules", "sha256": ["0" * 64]}, "${open(rootpath + '/etc/modules').read()}")
+        (errors, warnings) = checker(self.ymlcfg).run()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(warnings), 2)
+
+
+    def check_raises(self):
+        self.logger.info("Errors make the check fail")
+
+        self._template("hostname.tpl", {"filename": "/etc/hostname"}, "${hostname}")
+        self.assertRaises(VMCCheckError, check, self.ymlcfg)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
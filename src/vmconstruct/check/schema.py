@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.check.schema
+    :platform: Unix
+    :synopsis: JSON schemas for the vmconstruct configuration
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+The yaml configuration files are loaded to json compatible structures
+so they are described here with JSON schema.  Keys which are not known
+are allowed so that site specific data can be carried along for the
+templates.
+"""
+
+_strlist = {
+    "type": ["array", "null"],
+    "items": {"type": "string"}
+}
+
+_packages = {
+    "type": ["object", "null"],
+    "properties": {
+        "packages": _strlist,
+        "payloads": _strlist
+    }
+}
+
+
+CONFIG = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "vmc.yml",
+    "type": "object",
+    "required": ["workspace", "build", "global"],
+    "properties": {
+        "logging": {
+            "type": ["object", "null"],
+            "properties": {
+                "log": {"type": "string"},
+                "loglevel": {"type": "string"},
+                "logconfig": {"type": ["string", "null"]}
+            }
+        },
+        "workspace": {
+            "type": "object",
+            "required": ["rootpath"],
+            "properties": {
+                "rootpath": {"type": "string"},
+                "templatecache": {"type": ["string", "null"]},
+                "backend": {"enum": ["btrfs", "directory"]},
+                "executor": {"enum": ["chroot", "recorder"]},
+                "durations": {
+                    "type": ["object", "null"],
+                    "additionalProperties": {"type": "number", "minimum": 0}
+                }
+            }
+        },
+        "build": {
+            "type": "object",
+            "required": ["basereleases", "basetemplates", "vmdefs"],
+            "properties": {
+                "basereleases": {
+                    "type": "object",
+                    "additionalProperties": _strlist
+                },
+                "updates": {
+                    "type": ["object", "null"],
+                    "additionalProperties": {
+                        "type": ["object", "null"],
+                        "additionalProperties": _packages
+                    }
+                },
+                "layers": {"type": "boolean"},
+                "templateworkers": {"type": "integer", "minimum": 0},
+                "basetemplates": _strlist,
+                "vmdefs": _strlist
+            }
+        },
+        "global": {
+            "type": "object",
+            "required": ["paths"],
+            "properties": {
+                "paths": {
+                    "type": "object",
+                    "required": ["vmdefs"],
+                    "properties": {
+                        "vmdefs": {"type": "string"}
+                    }
+                }
+            }
+        },
+        "ubuntu": {
+            "type": ["object", "null"],
+            "properties": {
+                "archive": {"type": ["string", "null"]},
+                "proxy": {"type": ["string", "null"]}
+            }
+        }
+    }
+}
+
+
+_partition = {
+    "type": "object",
+    "required": ["size", "filesystem"],
+    "properties": {
+        "size": {
+            "oneOf": [
+                {"type": "integer", "minimum": 1},
+                {"type": "string", "pattern": "^auto(\\+[0-9]+%)?$"}
+            ]
+        },
+        "filesystem": {"type": "string"},
+        "mount": {"type": "string", "pattern": "^(/|swap$)"},
+        "label": {"type": "string"},
+        "name": {"type": "string"},
+        "partcode": {"type": ["string", "integer"]}
+    }
+}
+
+_disk = {
+    "type": "object",
+    "properties": {
+        "label": {"enum": ["mbr", "gpt"]},
+        "sector_size": {"enum": [512, 4096]},
+        "alignment": {"type": "integer", "minimum": 512, "multipleOf": 512},
+        "mapper": {"enum": ["kpartx", "loop", "partscan", "fake"]},
+        "partitions": {
+            "type": ["object", "null"],
+            "additionalProperties": _partition
+        }
+    }
+}
+
+_squash = {
+    "type": "object",
+    "required": ["type", "path"],
+    "properties": {
+        "type": {"enum": ["squash"]},
+        "path": {"type": "string", "pattern": "^/"}
+    }
+}
+
+_hdd = {
+    "type": "object",
+    "required": ["type"],
+    "properties": {
+        "type": {"enum": ["hdd"]},
+        "payloads": _strlist,
+        "engine": {"enum": ["mount", "rootdir"]},
+        "cache": {"type": "boolean"},
+        "export": {
+            "type": "object",
+            "properties": {
+                "formats": {
+                    "type": "array",
+                    "items": {"enum": ["qcow2", "zstd"]}
+                },
+                "backing": {"type": "boolean"}
+            }
+        }
+    },
+    "additionalProperties": _disk
+}
+
+# The keys of a hdd disk which are not disk definitions
+VMDEF_HDD_KEYS = list(_hdd["properties"])
+
+
+VMDEF = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "vmdef",
+    "type": "object",
+    "required": ["dist", "release", "settings"],
+    "properties": {
+        "dist": {"type": "string"},
+        "release": {"type": "string"},
+        "base": {"type": "string"},
+        "settings": {
+            "type": "object",
+            "properties": {
+                "onexist": {"enum": ["error", "pass", "upgrade", "dist-upgrade", "dist-ugrade", "rebuild"]},
+                "pause": {"type": "boolean"},
+                "payloads": {
+                    "type": "array",
+                    "items": {"type": "string"}
+                },
+                "templates": _strlist
+            }
+        },
+        "packages": _strlist,
+        "disks": {
+            "type": ["object", "null"],
+            "additionalProperties": {
+                "oneOf": [_squash, _hdd]
+            }
+        },
+        "data": {"type": ["object", "null"]}
+    }
+}
@@ -4,51 +4,193 @@ __all__ = [
     "disk"
 ]
 
+import concurrent.futures
+import contextlib
+import copy
 import logging
 import os
+import random
 import re
 import stat
 import subprocess
+import threading
+import uuid
 from sparse_list import SparseList
 
+from . import cache
+from . import export
+from . import loop
+from . import mounttree
 from . import partition
+from . import probe
+from . import reader
+from . import rootdir
+from . import usage
 
 
+MAPPERS = ["kpartx", "loop", "partscan", "fake"]
+
 class disks(object):
-    def __init__(self, subvol, disksyml):
+    def __init__(self, subvol, disksyml, origin=None, cachedir=None):
+        """\
+        The constructor.
+
+        :param origin: The tree the disks will be populated from which is
+                       measured to resolve partitions with an auto size.
+        :type origin: str.
+        :param cachedir: The directory of cached formatted disk images or
+                         None to always format the disks.
+        :type cachedir: str.
+        """
         self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
         self._subvol = subvol
         self._disks = {}
+        self._tree = None
 
+        disksyml = self._autosize(disksyml, origin)
         for (k, v) in disksyml.items():
-            self._disks[k] = disk(subvol, k, v)
+            self._disks[k] = disk(subvol, k, v, cachedir=cachedir)
 
 
-    def format(self):
+    def _autosize(self, disksyml, origin):
         """\
-        Format all disks.
+        Return a copy of disksyml with each auto partition size replaced by
+        the size in Mb the content of its mount point in origin needs.
         """
-        for (k, v) in self._disks.items():
-            v.format()
+        auto = [(k, idx, part) for (k, v) in disksyml.items() for (idx, part) in (v.get("partitions", None) or {}).items() if usage.isauto(part["size"])]
+        if not auto:
+            return(disksyml)
+
+        for (k, idx, part) in auto:
+            if not part.get("mount", None) or part["mount"] == "swap":
+                raise Exception("Disk {k} partition {i} has an auto size without a mount point".format(k=k, i=idx))
+        if not origin:
+            raise Exception("Auto sized partitions need the origin to measure")
+
+        mounts = [p["mount"] for v in disksyml.values() for p in (v.get("partitions", None) or {}).values() if p.get("mount", "swap") != "swap"]
+        used = usage.usage(origin, mounts)
+
+        disksyml = copy.deepcopy(disksyml)
+        for (k, idx, part) in auto:
+            resolved = disksyml[k]["partitions"][idx]
+            resolved["size"] = usage.size(part["size"], used[part["mount"]], part["filesystem"])
+            self._logger.info("Disk {k} partition {i} for {m} with {u} bytes is {s}Mb ({a})".format(k=k, i=idx, m=part["mount"], u=used[part["mount"]], s=resolved["size"], a=part["size"]))
+
+        return(disksyml)
+
+
+    def format(self, workers=None):
+        """\
+        Format all disks.  The disks in the cache are cloned from it, then
+        the partitions of every disk are mapped and formatted, or given new
+        UUIDs if cloned, in parallel.
+        """
+        cloned = dict([(disk.id, disk._clone()) for disk in self._disks.values()])
+        with contextlib.ExitStack() as stack:
+            for disk in self._disks.values():
+                stack.enter_context(disk._lo)
+                disk._preformat(cloned[disk.id])
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(disk._retag if cloned[disk.id] else disk._mkfs, k, mapper) for disk in self._disks.values() for (k, (mapper, loop)) in disk._lo.elements.items()]
+                [f.result() for f in futures]
+
+        for disk in self._disks.values():
+            disk._postformat(cloned[disk.id])
+
+
+    def mounted(self, workers=None):
+        """\
+        Return a mounttree context manager for the mount points of all disks
+        which is entered as the / of the mount path.
+
+            with d.mounted() as mntpoint:
+                ...
+        """
+        mounts = dict([(m, v) for v in self._disks.values() for m in v.mounts])
+        return(mounttree.mounttree(os.path.join(self._subvol.path, "mnt"), mounts, workers=workers))
 
 
-    def mount(self):
+    def mount(self, workers=None):
         """\
         Mount all disks and return the / of the mount path.
         """
-        self._logger.error("TODO: use context manager for mounting")
-        for (mount, disk) in sorted([(m, v) for (k, v) in self._disks.items() for m in v.mounts]):
-            disk.mount(mount)
+        self._tree = self.mounted(workers=workers)
+        return(self._tree.__enter__())
+
+
+    def assignUUIDs(self):
+        """\
+        Choose the filesystem UUIDs for all disks before they are built.
+        """
+        for disk in self._disks.values():
+            disk.assignUUIDs()
+
+
+    def populate(self, root, workdir, workers=None):
+        """\
+        Build the filesystems on all disks from the directory tree at root
+        without mapping or mounting anything.  The subtrees of nested mount
+        points are moved out of root to workdir (which must be on the same
+        filesystem) so each filesystem only receives its own content.  The
+        filesystems are independent so they are built in parallel.
+        """
+        trees = {}
+        # Deepest mount points first so their parents are still in place
+        for (mount, disk, k) in sorted([(p.mount, v, k) for v in self._disks.values() for (k, p) in v.partitions() if p.mount and p.mount != "swap"], key=lambda x: x[0], reverse=True):
+            if mount == "/":
+                trees[(disk, k)] = root
+                continue
+
+            src = os.path.join(root, mount[1:])
+            dst = os.path.join(workdir, "{id}-{k}".format(id=disk.id, k=k))
+            if os.path.isdir(src):
+                self._logger.debug("Moving {src} to {dst} for separate filesystem".format(src=src, dst=dst))
+                sstat = os.lstat(src)
+                os.rename(src, dst)
+                # Leave an empty mount point behind
+                os.mkdir(src)
+                os.chown(src, sstat.st_uid, sstat.st_gid)
+                os.chmod(src, stat.S_IMODE(sstat.st_mode))
+            else:
+                os.makedirs(dst)
+            trees[(disk, k)] = dst
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(disk.build, k, trees.get((disk, k), None)) for disk in self._disks.values() for (k, p) in disk.partitions()]
+            [f.result() for f in futures]
+
+
+    def export(self, destdir, formats, backing=False):
+        """\
+        Export all the disk images to destdir in the requested formats.
+        """
+        exported = {}
+        for (k, v) in self._disks.items():
+            exported[k] = v.export(destdir, formats, backing=backing)
 
-        return(os.path.join(self._subvol.path, "mnt"))
+        return(exported)
 
 
     def umount(self):
         """\
-        Umount all disks.
+        Umount all disks mounted by mount.
         """
-        for (mount, disk) in reversed(sorted([(m, v) for (k, v) in self._disks.items() for m in v.mounts])):
-            disk.umount(mount)
+        if self._tree is not None:
+            self._tree.__exit__(None, None, None)
+            self._tree = None
+
+
+    def sparsify(self):
+        """\
+        Punch holes in the all-zero regions of all the disk images.
+
+        :returns: A dictionary of disk to the disk.sparsify result.
+        """
+        sparsified = {}
+        for (k, v) in self._disks.items():
+            sparsified[k] = v.sparsify()
+
+        return(sparsified)
 
 
     def fstab(self):
@@ -95,46 +237,111 @@ class disk(object):
 
         def losetup(self):
             """\
-            Execute losetup to map the partitions in the image file to devices.
+            Map the partitions in the image file to devices with the mapper
+            of the disk:
+
+                kpartx: device-mapper devices made by kpartx
+                loop: a loop device for each partition limited to its extent
+                partscan: a loop device for the image with the partitions
+                          scanned by the kernel
+                fake: nothing is mapped, the partitions are not formatted
+                      and the filesystems are directories, for testing the
+                      build orchestration without root
             """
-            if not len(self):
+            if len(self):
+                return(False)
+
+            mapper = self._disk._mapper
+            ss = self._disk._pt.sector_size
+            if mapper == "fake":
+                for k in self._disk._pt.extents():
+                    self[k] = (self._disk.image, None)
+            elif mapper == "kpartx":
+                if ss != 512:
+                    raise Exception("kpartx can only map disks with 512 byte sectors, use a loop mapper or the rootdir engine")
                 cmd = ["kpartx", "-avs", self._disk.image]
                 self._logger.debug("Mapping image partitions: {cmd}".format(cmd=cmd))
                 loopre = re.compile("^loop([0-9]+)p([0-9]+)$")
                 for l in subprocess.check_output(cmd).decode(encoding="UTF-8").splitlines():
                     m = re.search("^loop[0-9]+p([0-9]+)$", l.split()[2])
                     self[int(m.group(1))] = ("/dev/mapper/"+l.split()[2], l.split()[7])
-
-                return(True)
             else:
-                return(False)
+                self._logger.debug("Attaching image partitions with {m} loop devices".format(m=mapper))
+                extents = self._disk._pt.extents()
+                try:
+                    if mapper == "loop":
+                        for (k, (offset, length)) in sorted(extents.items()):
+                            dev = loop.attach(self._disk.image, offset, length, block_size=ss)
+                            self[k] = (dev, dev)
+                    else:
+                        dev = loop.attach(self._disk.image, block_size=ss, partscan=True)
+                        try:
+                            pdevs = loop.partitions(dev, sorted(extents))
+                        except Exception:
+                            loop.detach(dev)
+                            raise
+                        for (k, pdev) in pdevs.items():
+                            self[k] = (pdev, dev)
+                except Exception:
+                    self.ulosetup()
+                    raise
+
+            return(True)
 
 
         def ulosetup(self):
             """\
             Unmap mapped partitions.
             """
-            if len(self):
+            if not len(self):
+                return
+
+            if self._disk._mapper == "fake":
+                pass
+            elif self._disk._mapper == "kpartx":
                 cmd = ["kpartx", "-dvs", self._disk.image]
                 self._logger.debug("Unmapping image partitions: {cmd}".format(cmd=cmd))
                 subprocess.check_output(cmd)
-                self.clear()
+            else:
+                for dev in sorted(set([lodev for (mapper, lodev) in self.elements.values()])):
+                    loop.detach(dev)
+            self.clear()
 
 
 
-    def __init__(self, subvol, id, defn):
+    def __init__(self, subvol, id, defn, cachedir=None):
         self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self.id = id
         self._parts = SparseList(0)
         self._lo = self._losetup(id, self)
         self._mounts = {}
         self._subvol = subvol
-
-        # mbr or gpt
+        # The image allocation before the filesystems were trimmed and the
+        # bytes trimmed from each mount point
+        self._allocated = None
+        self._trimmed = {}
+        self._cachedir = cachedir
+        # Serialise the mapping and mount bookkeeping of parallel mounts and
+        # count the mounts in progress which hold the mapping
+        self._lock = threading.Lock()
+        self._pending = 0
+
+        # How the partitions are mapped to devices for formatting and mounting
+        self._mapper = defn.get("mapper", "kpartx")
+        if self._mapper not in MAPPERS:
+            raise Exception("Unknown disk mapper {m}".format(m=self._mapper))
+
+        # mbr or gpt, optionally with 4K native sectors and partitions aligned
+        # for the storage the image will be written to
+        geometry = {
+            "sector_size": defn.get("sector_size", None),
+            "alignment": defn.get("alignment", partition.ALIGNMENT)
+        }
         label = defn.get("label", "gpt")
         if label == "mbr":
-            self._pt = partition.mbr()
+            self._pt = partition.mbr(**geometry)
         elif label == "gpt":
-            self._pt = partition.gpt()
+            self._pt = partition.gpt(**geometry)
         else:
             raise Exception("Unknown disk partition table type")
 
@@ -168,6 +375,17 @@ class disk(object):
         self.image = os.path.join(self._subvol.path, "disks", "{id}.img".format(id=id))
         self._pt.makeDisk(self.image)
 
+        errors = reader.reader(self.image, self._pt.sector_size).verify(self._pt.alignment)
+        if errors:
+            raise Exception("The partition table of {i} is not valid: {e}".format(i=self.image, e=errors))
+
+
+    def partitions(self):
+        """\
+        Return a list of (index, partition) for the partitions on this disk.
+        """
+        return(sorted(self._parts.elements.items()))
+
 
     def losetup(self):
         return(self._lo.losetup())
@@ -177,29 +395,185 @@ class disk(object):
         return(self._lo.ulosetup())
 
 
-    def format(self):
+    def format(self, workers=None):
         """\
-        Format the partitions for the requested filesystem.
+        Format the partitions for the requested filesystem in parallel, or
+        clone the disk from the cache and give the partitions new UUIDs.
         """
+        cloned = self._clone()
         with self._lo:
+            self._preformat(cloned)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._retag if cloned else self._mkfs, k, mapper) for (k, (mapper, loop)) in self._lo.elements.items()]
+                [f.result() for f in futures]
+
+        self._postformat(cloned)
+
+
+    def _preformat(self, cloned):
+        """\
+        Called once before the partitions are formatted by the workers.
+        """
+        if not cloned and self._mapper != "fake":
             self._logger.error("TODO: support aribtrary fs args")
-            for (k, (mapper, loop)) in self._lo.elements.items():
-                (size, filesystem, mount, label, _) = self._parts[k]
-                if filesystem == "esp":
-                    cmd = ["mkfs", "-t", "vfat", "-n", "EFI_SYSTEM", "-F", "32", mapper]
-                elif filesystem == "swap":
-                    cmd = ["mkswap", "-f", mapper]
-                else:
-                    cmd = ["mkfs", "-t", filesystem, mapper]
-                self._logger.debug("Formatting disk {size}Mb partition {k}: {cmd}".format(size=size, k=k, cmd=cmd))
-                print(subprocess.check_output(cmd).decode(encoding="UTF-8"))
-
-                # Learn the UUID of the formatted device
-                cmd = ["blkid", "-o", "export", mapper]
-                for line in subprocess.check_output(cmd).decode(encoding="UTF-8").splitlines():
-                    [var, val] = line.split("=")
-                    if var == "UUID":
-                        self._parts[k].flags[var] = val
+
+
+    def _postformat(self, cloned):
+        """\
+        Called once after the workers have formatted, or given new UUIDs to,
+        all the partitions.
+        """
+        if self._mapper == "fake":
+            # The UUIDs the fake filesystems would have been given
+            self.assignUUIDs()
+        if not cloned:
+            self._store()
+
+
+    def _mkfsCommand(self, k, mapper):
+        (size, filesystem, mount, label, _) = self._parts[k]
+        if filesystem == "esp":
+            return(["mkfs", "-t", "vfat", "-n", "EFI_SYSTEM", "-F", "32", mapper])
+        elif filesystem == "swap":
+            return(["mkswap", "-f", mapper])
+        else:
+            return(["mkfs", "-t", filesystem, mapper])
+
+
+    def _mkfs(self, k, mapper):
+        """\
+        Format partition k mapped at mapper and learn the UUID of the new
+        filesystem from its superblock.
+        """
+        if self._mapper == "fake":
+            # A new UUID is assigned once all the partitions are done
+            self._logger.debug("Not formatting fake disk partition {k}".format(k=k))
+            self._parts[k].flags.pop("UUID", None)
+            return
+
+        cmd = self._mkfsCommand(k, mapper)
+        self._logger.debug("Formatting disk {size}Mb partition {k}: {cmd}".format(size=self._parts[k].size, k=k, cmd=cmd))
+        # the output of parallel commands would be interleaved on stdout
+        self._logger.debug(subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(encoding="UTF-8"))
+
+        self._parts[k].flags["UUID"] = probe.probe(mapper)["UUID"]
+
+
+    def _cacheKey(self):
+        """\
+        Return the key of the formatted image in the cache or None if the
+        disk cannot be cached.
+        """
+        if self._cachedir is None or self._mapper == "fake":
+            return(None)
+        if [k for (k, p) in self.partitions() if p.filesystem not in cache.FILESYSTEMS]:
+            return(None)
+
+        return(cache.key(self._pt, dict([(k, self._mkfsCommand(k, None)[:-1]) for (k, p) in self.partitions()]), dict([(k, p.filesystem) for (k, p) in self.partitions()])))
+
+
+    def _clone(self):
+        """\
+        Replace the image with a clone of the cached formatted image, with
+        the partition table of this disk written over the cached one.
+
+        :returns: True if the image was cloned.
+        """
+        key = self._cacheKey()
+        cached = cache.lookup(self._cachedir, key) if key else None
+        if cached is None:
+            return(False)
+
+        self._logger.info("Cloning disk {id} from {c}".format(id=self.id, c=cached))
+        cache.clone(cached, self.image)
+        self._pt.write(self.image)
+
+        return(True)
+
+
+    def _retag(self, k, mapper):
+        """\
+        Give the filesystem of partition k, cloned from the cache, a new UUID.
+        """
+        cache.regenerate(mapper, self._parts[k].filesystem)
+        self._parts[k].flags["UUID"] = probe.probe(mapper)["UUID"]
+
+
+    def _store(self):
+        """\
+        Add the freshly formatted image to the cache.
+        """
+        key = self._cacheKey()
+        if key:
+            cache.store(self._cachedir, key, self.image)
+
+
+    def assignUUIDs(self):
+        """\
+        Choose a UUID for each partition filesystem that does not have one
+        so it is known before the filesystem is built.
+        """
+        for (k, p) in self.partitions():
+            if "UUID" in p.flags:
+                continue
+            if p.filesystem == "esp":
+                volid = random.getrandbits(32)
+                p.flags["UUID"] = "{h:04X}-{l:04X}".format(h=volid >> 16, l=volid & 0xffff)
+            else:
+                p.flags["UUID"] = str(uuid.uuid4())
+
+
+    def build(self, k, tree=None):
+        """\
+        Build the filesystem for partition k as a standalone image from the
+        directory tree and place it in the disk image at the partition offset.
+        """
+        (size, filesystem, mount, label, flags) = self._parts[k]
+        (offset, length) = self._pt.extents()[k]
+        fsimage = os.path.join(self._subvol.path, "disks", "{id}-{k}.img".format(id=self.id, k=k))
+
+        self._logger.debug("Building {size}Mb partition {k} from {tree}".format(size=size, k=k, tree=tree))
+        if self._mapper == "fake":
+            return
+
+        try:
+            rootdir.mkfs(fsimage, filesystem, length // 1048576, tree, flags.get("UUID", None))
+            rootdir.place(fsimage, self.image, offset)
+        finally:
+            try:
+                os.unlink(fsimage)
+            except FileNotFoundError:
+                pass
+
+
+    def sparsify(self):
+        """\
+        Punch holes in the all-zero regions of the disk image.
+
+        :returns: A dictionary of the bytes trimmed from each mount point
+                  when it was umounted, the bytes no longer allocated in
+                  the image since before the trim and the bytes still
+                  allocated.
+        """
+        (before, size) = export.allocation(self.image)
+        if self._allocated is not None:
+            before = max(before, self._allocated)
+        export.sparsify(self.image)
+        (after, size) = export.allocation(self.image)
+        self._allocated = None
+
+        return({
+            "trimmed": dict(self._trimmed),
+            "reclaimed": before - after,
+            "allocated": after
+        })
+
+
+    def export(self, destdir, formats, backing=False):
+        """\
+        Export the disk image to destdir in the requested formats.
+        """
+        return(export.export(self.image, destdir, self.id, formats, backing=backing))
 
 
     @property
@@ -215,31 +589,50 @@ class disk(object):
         Mount the filesytems at mnt under the disk subvolume
         """
 
-        self.losetup()
+        with self._lock:
+            self.losetup()
+            self._pending += 1
 
         if mounts:
             mounts = [mounts]
         else:
             mounts = self.mounts
 
-        for mount in mounts:
-            mnt = os.path.join(self._subvol.path, "mnt", mount[1:])
-            try:
-                os.makedirs(mnt)
-            except FileExistsError:
-                if not os.path.isdir(mnt):
-                    raise
-
-            k = [k for (k, (s, f, m, l, _)) in self._parts.elements.items() if m == mount].pop()
-            (mapper, loop) = self._lo[k]
-
-            cmd = ["mount", mapper, mnt]
-            self._logger.debug("Mounting filesystem: {cmd}".format(cmd=cmd))
-            subprocess.check_call(cmd)
-            self._mounts[mnt] = mapper
-
-
-    def umount(self, mounts=None):
+        try:
+            for mount in mounts:
+                mnt = os.path.join(self._subvol.path, "mnt", mount[1:])
+                k = [k for (k, (s, f, m, l, _)) in self._parts.elements.items() if m == mount].pop()
+                (mapper, loop) = self._lo[k]
+
+                cmd = ["mount", mapper, mnt]
+                try:
+                    os.makedirs(mnt)
+                except FileExistsError:
+                    if not os.path.isdir(mnt):
+                        raise
+                self._logger.debug("Mounting filesystem: {cmd}".format(cmd=cmd))
+                if self._mapper != "fake":
+                    subprocess.check_call(cmd)
+                with self._lock:
+                    self._mounts[mnt] = mapper
+        except Exception:
+            # Do not leave the partitions mapped if nothing is mounted, a
+            # sibling may be mounting from the mapping on another thread
+            with self._lock:
+                self._pending -= 1
+                if not self._mounts and not self._pending:
+                    self.ulosetup()
+            raise
+
+        with self._lock:
+            self._pending -= 1
+
+
+    def umount(self, mounts=None, trim=True):
+        """\
+        Umount the filesystems, discarding their unused blocks first if trim
+        is set so the freed space is not left allocated in the image.
+        """
         if mounts:
             mounts = [mounts]
         else:
@@ -248,13 +641,23 @@ class disk(object):
         for mount in mounts:
             mnt = os.path.join(self._subvol.path, "mnt", mount[1:])
             if mnt in self._mounts:
+                if trim and self._mapper != "fake":
+                    with self._lock:
+                        if self._allocated is None:
+                            self._allocated = export.allocation(self.image)[0]
+                    trimmed = export.fstrim(mnt)
+                    if trimmed is not None:
+                        self._trimmed[mount] = trimmed
                 cmd = ["umount", mnt]
                 self._logger.debug("Umounting filesystem: {cmd}".format(cmd=cmd))
-                subprocess.check_call(cmd)
-                del(self._mounts[mnt])
+                if self._mapper != "fake":
+                    subprocess.check_call(cmd)
+                with self._lock:
+                    del(self._mounts[mnt])
 
-        if not len(self._mounts.keys()):
-            self.ulosetup()
+        with self._lock:
+            if not len(self._mounts.keys()) and not self._pending:
+                self.ulosetup()
 
 
     def fstab(self):
@@ -10,22 +10,39 @@ PYTHONPATH="${PP}" exec /usr/bin/env python3 ${0}
 ":"""
 
 LOG_LEVEL = "DEBUG"
-BTRFS = "/export/workspace"
 
 import logging
+import shutil
+import tempfile
 import time
 import unittest
 import yaml
 
-from vmconstruct.btrfs import subvolume
+from vmconstruct.btrfs import directory
 from vmconstruct.disks import disk, disks
+from vmconstruct.disks.cache_tests import suite as cache_suite
+from vmconstruct.disks.export_tests import suite as export_suite
+from vmconstruct.disks.mounttree_tests import suite as mounttree_suite
 from vmconstruct.disks.partition_tests import suite as partition_suite
+from vmconstruct.disks.loop_tests import suite as loop_suite
+from vmconstruct.disks.probe_tests import suite as probe_suite
+from vmconstruct.disks.reader_tests import suite as reader_suite
+from vmconstruct.disks.rootdir_tests import suite as rootdir_suite
+from vmconstruct.disks.usage_tests import suite as usage_suite
 
 
 def suite():
     pkgTS = unittest.TestSuite()
 
     pkgTS.addTest(partition_suite())
+    pkgTS.addTest(reader_suite())
+    pkgTS.addTest(rootdir_suite())
+    pkgTS.addTest(probe_suite())
+    pkgTS.addTest(loop_suite())
+    pkgTS.addTest(usage_suite())
+    pkgTS.addTest(export_suite())
+    pkgTS.addTest(cache_suite())
+    pkgTS.addTest(mounttree_suite())
 
     pkgTS.addTest(DisksUT("emptyGptDisk"))
     pkgTS.addTest(DisksUT("onePartGptDisk"))
@@ -45,13 +62,20 @@ class DisksUT(unittest.TestCase):
         self.logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
         self.logger.setLevel(getattr(logging, LOG_LEVEL))
 
-        rootvol = subvolume(BTRFS)
+        # The disk images do not need a btrfs workspace
+        self.tdir = tempfile.mkdtemp()
+        rootvol = directory(self.tdir)
         testvol = rootvol.create("_tests")
         self.disksvol = testvol.create("disks")
 
 
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tdir)
+
+
     def emptyGptDisk(self):
-        diskdfn = yaml.load("""\
+        diskdfn = yaml.safe_load("""\
   label: gpt
   partitions:
 """)
@@ -59,7 +83,7 @@ class DisksUT(unittest.TestCase):
 
 
     def onePartGptDisk(self):
-        diskdfn = yaml.load("""\
+        diskdfn = yaml.safe_load("""\
   label: gpt
   partitions:
     1:
@@ -71,7 +95,7 @@ class DisksUT(unittest.TestCase):
 
 
     def formatGptDisk(self):
-        diskdfn = yaml.load("""\
+        diskdfn = yaml.safe_load("""\
   label: gpt
   partitions:
     1:
@@ -87,7 +111,7 @@ class DisksUT(unittest.TestCase):
         d.format()
 
     def mountGptDisk(self):
-        diskdfn = yaml.load("""\
+        diskdfn = yaml.safe_load("""\
   label: gpt
   partitions:
     1:
@@ -107,7 +131,7 @@ class DisksUT(unittest.TestCase):
 
 
     def format2GptDisks(self):
-        disksdfn = yaml.load("""\
+        disksdfn = yaml.safe_load("""\
 test1:
   label: gpt
   partitions:
@@ -140,7 +164,7 @@ test2:
 
 
     def mount2GptDisks(self):
-        disksdfn = yaml.load("""\
+        disksdfn = yaml.safe_load("""\
 test1:
   label: gpt
   partitions:
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.cache
+    :platform: Unix
+    :synopsis: vmconstruct cache of freshly formatted disk images
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Many vmdefs share the same disk layout so the image of a freshly
+formatted disk is kept in a cache keyed by the partition extents, the
+mkfs command of each partition and the version of the tool which
+formats it.  A disk with the same key is cloned from the cache, with a
+reflink where the filesystem supports it, instead of being formatted.
+The clone is given its own partition table and the filesystem UUIDs are
+regenerated so no two disks share them.
+
+The cache is the _diskcache directory of the workspace.  An image which
+has not been used for MAXAGE seconds, for example one formatted before
+an upgrade of the mkfs tools, is deleted when the cache is pruned before
+each solidify.  The directory can also be deleted at any time when no
+build is running.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import struct
+import subprocess
+import threading
+import time
+import uuid
+
+
+_logger = logging.getLogger(__name__)
+
+# Change to invalidate every cached image when the format of the key or
+# the images changes
+VERSION = 1
+
+# The filesystems whose UUID can be regenerated in a clone
+FILESYSTEMS = ["ext2", "ext3", "ext4", "btrfs", "xfs", "swap", "esp", "vfat"]
+
+# The command printing the version of the tool formatting each filesystem
+FORMATTERS = {
+    "ext2": ["mke2fs", "-V"],
+    "ext3": ["mke2fs", "-V"],
+    "ext4": ["mke2fs", "-V"],
+    "btrfs": ["mkfs.btrfs", "--version"],
+    "xfs": ["mkfs.xfs", "-V"],
+    "swap": ["mkswap", "--version"],
+    "esp": ["mkfs.fat", "--help"],
+    "vfat": ["mkfs.fat", "--help"]
+}
+
+# Images unused for this many seconds are deleted by prune()
+MAXAGE = 30 * 86400
+
+_versions = {}
+_versionsLock = threading.Lock()
+
+
+def version(filesystem):
+    """\
+    Return the first line of the version output of the tool which formats
+    filesystem, or None if it cannot be run.  Each tool is only run once.
+    """
+    cmd = FORMATTERS[filesystem]
+    with _versionsLock:
+        if cmd[0] not in _versions:
+            try:
+                out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode(encoding="UTF-8")
+                _versions[cmd[0]] = (out.strip().splitlines() or [None])[0]
+            except OSError:
+                _versions[cmd[0]] = None
+            _logger.debug("Formatter {c} is {v}".format(c=cmd[0], v=_versions[cmd[0]]))
+
+        return(_versions[cmd[0]])
+
+
+def key(pt, commands, filesystems):
+    """\
+    Return the cache key for a partition table, a dictionary of the
+    partition index to the mkfs command, without the device, which is run
+    for it and a dictionary of the partition index to the filesystem.
+    """
+    defn = {
+        "version": VERSION,
+        "label": pt.__class__.__name__,
+        "sector_size": pt.sector_size,
+        "size": pt.diskSize(),
+        "partitions": dict([(str(k), [offset, length, commands[k], version(filesystems[k])]) for (k, (offset, length)) in pt.extents().items()])
+    }
+
+    return(hashlib.sha256(json.dumps(defn, sort_keys=True).encode("UTF-8")).hexdigest())
+
+
+def _path(cachedir, key):
+    return(os.path.join(cachedir, "{k}.img".format(k=key)))
+
+
+def clone(src, dest):
+    """\
+    Copy src to dest sharing the extents if the filesystem supports reflinks
+    and keeping the holes otherwise.  dest is replaced atomically.
+    """
+    tmp = "{d}.{p}.tmp".format(d=dest, p=os.getpid())
+    cmd = ["cp", "--reflink=auto", "--sparse=always", src, tmp]
+    _logger.debug("Cloning image: {cmd}".format(cmd=cmd))
+    try:
+        subprocess.check_call(cmd)
+        os.rename(tmp, dest)
+    except Exception:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def lookup(cachedir, key):
+    """\
+    :returns: The path of the cached image for key or None.
+    """
+    path = _path(cachedir, key)
+    if not os.path.isfile(path):
+        return(None)
+
+    # The modification time records the last use for prune()
+    os.utime(path)
+    return(path)
+
+
+def store(cachedir, key, image):
+    """\
+    Add a freshly formatted image to the cache.  Several builds can store
+    the same key at once, the last one wins.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+    clone(image, _path(cachedir, key))
+    _logger.info("Cached {i} as {k}".format(i=image, k=key))
+
+
+def prune(cachedir, maxage=MAXAGE):
+    """\
+    Delete the cached images which have not been used for maxage seconds
+    and the temporary files of clones which did not finish.
+
+    :returns: The names of the files deleted.
+    """
+    if not os.path.isdir(cachedir):
+        return([])
+
+    pruned = []
+    now = time.time()
+    for name in sorted(os.listdir(cachedir)):
+        path = os.path.join(cachedir, name)
+        try:
+            if now - os.stat(path).st_mtime > maxage:
+                os.unlink(path)
+                pruned.append(name)
+        except FileNotFoundError:
+            # Pruned by a concurrent build
+            pass
+    if pruned:
+        _logger.info("Pruned {n} unused images from {c}".format(n=len(pruned), c=cachedir))
+
+    return(pruned)
+
+
+def _vfat(mapper, volid):
+    """\
+    Write the volume id to the boot sector of a FAT filesystem and to the
+    backup boot sector of FAT32.
+    """
+    with open(mapper, "rb+") as fp:
+        sb = fp.read(512)
+        if sb[0x52:0x57] == b"FAT32":
+            (sector_size, backup) = (struct.unpack_from("<H", sb, 0x0b)[0], struct.unpack_from("<H", sb, 0x32)[0])
+            offsets = [0x43] + ([backup * sector_size + 0x43] if backup else [])
+        elif sb[0x36:0x39] == b"FAT":
+            offsets = [0x27]
+        else:
+            raise Exception("{m} does not have a FAT filesystem".format(m=mapper))
+
+        for offset in offsets:
+            fp.seek(offset)
+            fp.write(struct.pack("<I", volid))
+
+
+def regenerate(mapper, filesystem):
+    """\
+    Give the filesystem on mapper a new random UUID.
+    """
+    fsuuid = str(uuid.uuid4())
+    if filesystem in ["ext2", "ext3", "ext4"]:
+        cmd = ["tune2fs", "-U", fsuuid, mapper]
+    elif filesystem == "btrfs":
+        cmd = ["btrfstune", "-f", "-U", fsuuid, mapper]
+    elif filesystem == "xfs":
+        cmd = ["xfs_admin", "-U", fsuuid, mapper]
+    elif filesystem == "swap":
+        cmd = ["swaplabel", "-U", fsuuid, mapper]
+    elif filesystem in ["esp", "vfat"]:
+        _vfat(mapper, random.getrandbits(32))
+        return
+    else:
+        raise Exception("Unable to regenerate the UUID of a {f} filesystem".format(f=filesystem))
+
+    _logger.debug("Regenerating filesystem UUID: {cmd}".format(cmd=cmd))
+    _logger.debug(subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(encoding="UTF-8"))
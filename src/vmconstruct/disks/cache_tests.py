@@ -0,0 +1,201 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+import types
+import unittest
+
+from vmconstruct.disks import cache, disk, loop, probe, reader
+
+
+def suite():
+    cacheTS = unittest.TestSuite()
+    cacheTS.addTest(CacheUT("key"))
+    cacheTS.addTest(CacheUT("key_version"))
+    cacheTS.addTest(CacheUT("store"))
+    cacheTS.addTest(CacheUT("prune"))
+    cacheTS.addTest(CacheUT("vfat"))
+    cacheTS.addTest(CacheUT("uncacheable"))
+    cacheTS.addTest(CacheUT("format"))
+
+    return(cacheTS)
+
+
+
+class CacheUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tdir, "_diskcache")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _disk(self, name, filesystem="ext4", size=8):
+        subvol = types.SimpleNamespace(path=os.path.join(self.tdir, name))
+        defn = {"label": "gpt", "mapper": "loop", "partitions": {1: {"size": size, "filesystem": filesystem, "partcode": "linux/filesystem"}, 2: {"size": 8, "filesystem": "swap"}}}
+        return(disk(subvol, "xvda", defn, cachedir=self.cachedir))
+
+
+    def key(self):
+        self.logger.info("The key depends on the layout and filesystems only")
+
+        key = self._disk("a")._cacheKey()
+        self.assertEqual(self._disk("b")._cacheKey(), key)
+        self.assertNotEqual(self._disk("c", filesystem="ext3")._cacheKey(), key)
+        self.assertNotEqual(self._disk("d", size=16)._cacheKey(), key)
+
+
+    def key_version(self):
+        self.logger.info("The key changes with the version of the formatter")
+
+        d = self._disk("a")
+        key = d._cacheKey()
+        self.assertEqual(cache.version("ext4"), cache._versions["mke2fs"])
+        saved = dict(cache._versions)
+        try:
+            cache._versions["mke2fs"] = "mke2fs 0.0 (upgraded)"
+            self.assertNotEqual(d._cacheKey(), key)
+        finally:
+            cache._versions.clear()
+            cache._versions.update(saved)
+        self.assertEqual(d._cacheKey(), key)
+
+
+    def prune(self):
+        self.logger.info("Images which have not been used are pruned")
+
+        d = self._disk("a")
+        key = d._cacheKey()
+        d._store()
+        stale = os.path.join(self.cachedir, "0" * 64 + ".img")
+        shutil.copy(d.image, stale)
+        past = time.time() - cache.MAXAGE - 60
+        for path in [stale, cache._path(self.cachedir, key)]:
+            os.utime(path, (past, past))
+
+        # A lookup is a use
+        self.assertIsNotNone(cache.lookup(self.cachedir, key))
+        self.assertEqual(cache.prune(self.cachedir), [os.path.basename(stale)])
+        self.assertEqual(os.listdir(self.cachedir), [os.path.basename(cache._path(self.cachedir, key))])
+        self.assertEqual(cache.prune(os.path.join(self.tdir, "missing")), [])
+
+
+    def store(self):
+        self.logger.info("A stored image is found and cloned with its holes")
+
+        d = self._disk("a")
+        key = d._cacheKey()
+        self.assertIsNone(cache.lookup(self.cachedir, key))
+        with open(d.image, "rb+") as fp:
+            fp.seek(1048576)
+            fp.write(b"formatted")
+        d._store()
+        self.assertIsNotNone(cache.lookup(self.cachedir, key))
+
+        e = self._disk("b")
+        guid = reader.reader(e.image).guid
+        self.assertTrue(e._clone())
+        with open(e.image, "rb") as fp:
+            fp.seek(1048576)
+            self.assertEqual(fp.read(9), b"formatted")
+        # the clone keeps its own partition table
+        table = reader.reader(e.image)
+        self.assertEqual(table.guid, guid)
+        self.assertEqual(table.verify(), [])
+        self.assertEqual(os.listdir(os.path.dirname(e.image)), ["xvda.img"])
+
+
+    def vfat(self):
+        self.logger.info("The volume id of a FAT32 filesystem and its backup is replaced")
+
+        sb = bytearray(512 * 8)
+        struct.pack_into("<H", sb, 0x0b, 512)
+        struct.pack_into("<H", sb, 0x32, 6)
+        sb[0x52:0x57] = b"FAT32"
+        sb[510:512] = b"\x55\xaa"
+        sb[6 * 512:7 * 512] = sb[0:512]
+        image = os.path.join(self.tdir, "esp.img")
+        with open(image, "wb") as fp:
+            fp.write(sb)
+
+        cache._vfat(image, 0x12345678)
+        self.assertEqual(probe.probe(image)["UUID"], "1234-5678")
+        with open(image, "rb") as fp:
+            fp.seek(6 * 512)
+            self.assertEqual(probe.superblock(fp.read(512))["UUID"], "1234-5678")
+
+
+    def uncacheable(self):
+        self.logger.info("A disk is not cached without a cache or with an unknown filesystem")
+
+        self.assertIsNone(self._disk("a", filesystem="zfs")._cacheKey())
+        self.cachedir = None
+        self.assertIsNone(self._disk("b")._cacheKey())
+
+
+    def format(self):
+        self.logger.info("A cloned disk has new filesystem UUIDs")
+
+        if os.geteuid() != 0 or not os.path.exists(loop.LOOP_CONTROL):
+            self.skipTest("loop devices need root and {c}".format(c=loop.LOOP_CONTROL))
+        for tool in ["mkfs.ext4", "tune2fs", "swaplabel", "e2fsck"]:
+            if not shutil.which(tool):
+                self.skipTest("{t} is not available".format(t=tool))
+
+        d = self._disk("a")
+        d.format()
+        key = d._cacheKey()
+        self.assertIsNotNone(cache.lookup(self.cachedir, key))
+
+        e = self._disk("b")
+        e._mkfs = lambda k, mapper: self.fail("partition {k} was formatted".format(k=k))
+        e.format()
+        self.assertEqual(len(e._lo), 0)
+        for (k, p) in e.partitions():
+            self.assertNotEqual(p.flags["UUID"], d._parts[k].flags["UUID"])
+        self.assertNotEqual(reader.reader(e.image).guid, reader.reader(d.image).guid)
+
+        (offset, length) = e._pt.extents()[1]
+        fsimage = os.path.join(self.tdir, "fs.img")
+        with open(e.image, "rb") as src, open(fsimage, "wb") as dst:
+            src.seek(offset)
+            dst.write(src.read(length))
+        self.assertEqual(probe.probe(fsimage), {"TYPE": "ext4", "UUID": e._parts[1].flags["UUID"]})
+        subprocess.check_output(["e2fsck", "-fn", fsimage], stderr=subprocess.STDOUT)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.export
+    :platform: Unix
+    :synopsis: Sparse aware disk image export
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Convert the raw sparse disk images to formats suitable for shipping
+without reading or compressing the holes.  Before export the space freed
+by the filesystems is discarded and the all-zero regions of the image are
+turned back into holes so they are not shipped either.
+"""
+
+import logging
+import os
+import re
+import subprocess
+import time
+
+from .. import helpers
+
+
+_logger = logging.getLogger(__name__)
+
+# The supported export formats and the file extension they are given
+FORMATS = {
+    "qcow2": "qcow2",
+    "zstd": "img.tar.zst"
+}
+
+
+def allocation(image):
+    """\
+    Return a tuple of (data bytes, apparent size) for the image using
+    SEEK_DATA/SEEK_HOLE.
+    """
+    with open(image, "rb") as fp:
+        data = sum([length for (offset, length) in helpers.datasegments(fp.fileno())])
+        return((data, os.fstat(fp.fileno()).st_size))
+
+
+def fstrim(mnt):
+    """\
+    Discard the unused blocks of the filesystem mounted at mnt.  Through a
+    loop device the discards punch holes in the image file.
+
+    :returns: The bytes trimmed or None if the filesystem or device does
+              not support discard.
+    """
+    # Blocks freed in a transaction which is not committed are not trimmed
+    os.sync()
+    cmd = ["fstrim", "-v", mnt]
+    _logger.debug("Trimming filesystem: {cmd}".format(cmd=cmd))
+    try:
+        out = subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(encoding="UTF-8")
+    except subprocess.CalledProcessError as e:
+        _logger.warning("Unable to trim {m}: {o}".format(m=mnt, o=e.output.decode(encoding="UTF-8").strip()))
+        return(None)
+
+    m = re.search("\\(([0-9]+) bytes\\) trimmed", out)
+    return(int(m.group(1)) if m else 0)
+
+
+def sparsify(image):
+    """\
+    Punch holes in the all-zero regions of the image.
+
+    :returns: The bytes of the image which are no longer allocated.
+    """
+    (before, size) = allocation(image)
+    cmd = ["fallocate", "--dig-holes", image]
+    _logger.debug("Punching holes in image: {cmd}".format(cmd=cmd))
+    subprocess.check_call(cmd)
+    (after, size) = allocation(image)
+    _logger.info("Sparsified {i}: {r} bytes reclaimed, {a} bytes of data in {s} bytes".format(i=image, r=before - after, a=after, s=size))
+
+    return(before - after)
+
+
+def qcow2(image, dest, backing=None):
+    """\
+    Convert the raw image to qcow2.  If backing is given only the clusters
+    which differ from the backing file are written.  qemu-img skips the
+    holes in the raw image.
+    """
+    cmd = ["qemu-img", "convert", "-q", "-O", "qcow2"]
+    if backing:
+        cmd += ["-B", backing, "-F", "qcow2"]
+    cmd += [image, dest]
+    _logger.debug("Exporting qcow2 image: {cmd}".format(cmd=cmd))
+    subprocess.check_call(cmd)
+
+
+def zstd(image, dest):
+    """\
+    Compress the raw image to a sparse tar archive with zstd.  tar finds
+    the holes with SEEK_DATA/SEEK_HOLE so only data regions are read and
+    compressed, extracting with tar restores a sparse image.
+    """
+    tar = ["tar", "--sparse", "--hole-detection=seek", "-C", os.path.dirname(image), "-cf", "-", os.path.basename(image)]
+    zst = ["zstd", "-q", "-f", "-T0", "-o", dest]
+    _logger.debug("Exporting compressed image: {tar} | {zst}".format(tar=tar, zst=zst))
+    p1 = subprocess.Popen(tar, stdout=subprocess.PIPE)
+    try:
+        subprocess.check_call(zst, stdin=p1.stdout)
+    finally:
+        p1.stdout.close()
+        if p1.wait():
+            raise subprocess.CalledProcessError(p1.returncode, tar)
+
+
+def export(image, destdir, name, formats, backing=False):
+    """\
+    Export the raw image to destdir in each of the requested formats.  The
+    exports are named <name>-<timestamp>.<ext> and <name>.<ext> is a symlink
+    to the latest.  If backing is set the previous qcow2 export of the same
+    name is used as the backing file for the new one.
+
+    :returns: A dictionary of format to exported file path.
+    """
+    try:
+        os.makedirs(destdir)
+    except FileExistsError:
+        if not os.path.isdir(destdir):
+            raise
+
+    (data, size) = allocation(image)
+    _logger.info("Exporting {i}: {d} bytes of data in {s} bytes".format(i=image, d=data, s=size))
+
+    stamp = time.strftime("%Y%m%d%H%M%S")
+    exported = {}
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise Exception("Unsupported export format {f}".format(f=fmt))
+
+        latest = os.path.join(destdir, "{n}.{e}".format(n=name, e=FORMATS[fmt]))
+        dest = os.path.join(destdir, "{n}-{s}.{e}".format(n=name, s=stamp, e=FORMATS[fmt]))
+        seq = 0
+        while os.path.exists(dest):
+            # More than one export in the same second
+            seq += 1
+            dest = os.path.join(destdir, "{n}-{s}.{q}.{e}".format(n=name, s=stamp, q=seq, e=FORMATS[fmt]))
+        if fmt == "qcow2":
+            previous = os.path.realpath(latest) if backing and os.path.exists(latest) else None
+            qcow2(image, dest, backing=previous)
+        elif fmt == "zstd":
+            zstd(image, dest)
+
+        # Point the latest link at the new export
+        tmplink = latest + ".tmp"
+        try:
+            # Left behind by an export which was interrupted
+            os.unlink(tmplink)
+        except FileNotFoundError:
+            pass
+        os.symlink(os.path.basename(dest), tmplink)
+        os.rename(tmplink, latest)
+        exported[fmt] = dest
+
+    return(exported)
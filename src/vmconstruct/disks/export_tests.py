@@ -0,0 +1,186 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from vmconstruct.disks import export
+
+
+def suite():
+    exportTS = unittest.TestSuite()
+    exportTS.addTest(ExportUT("sparsify"))
+    exportTS.addTest(ExportUT("fstrim_unsupported"))
+    exportTS.addTest(ExportUT("zstd"))
+    exportTS.addTest(ExportUT("qcow2_backing"))
+    exportTS.addTest(ExportUT("stale_link"))
+    exportTS.addTest(ExportUT("unsupported"))
+
+    return(exportTS)
+
+
+
+class ExportUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tdir, "disk.img")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _sparse(self):
+        """\
+        Create an 8Mb image with data at the start and 4Mb in.
+        """
+        data = os.urandom(65536)
+        with open(self.image, "wb") as fp:
+            fp.truncate(8 * 1048576)
+            fp.write(data)
+            fp.seek(4 * 1048576)
+            fp.write(data)
+
+        return(data)
+
+
+    def sparsify(self):
+        self.logger.info("The all-zero regions of an image become holes")
+
+        if not shutil.which("fallocate"):
+            self.skipTest("fallocate is not available")
+
+        data = os.urandom(65536)
+        with open(self.image, "wb") as fp:
+            fp.write(data)
+            fp.write(bytes(4 * 1048576))
+            fp.write(data)
+            os.fsync(fp.fileno())
+        (before, size) = export.allocation(self.image)
+        self.assertEqual(before, size)
+
+        reclaimed = export.sparsify(self.image)
+        self.assertGreaterEqual(reclaimed, 4 * 1048576 - 65536)
+        self.assertEqual(export.allocation(self.image), (before - reclaimed, size))
+        with open(self.image, "rb") as fp:
+            self.assertEqual(fp.read(65536), data)
+            self.assertEqual(fp.read(4 * 1048576), bytes(4 * 1048576))
+            self.assertEqual(fp.read(), data)
+
+        # nothing is left to reclaim
+        self.assertEqual(export.sparsify(self.image), 0)
+
+
+    def fstrim_unsupported(self):
+        self.logger.info("A mount point which cannot be trimmed is reported")
+
+        if not shutil.which("fstrim"):
+            self.skipTest("fstrim is not available")
+
+        self.assertIsNone(export.fstrim(os.path.join(self.tdir, "missing")))
+
+
+    def zstd(self):
+        self.logger.info("A zstd export extracts to the same sparse image")
+
+        for tool in ["tar", "zstd"]:
+            if not shutil.which(tool):
+                self.skipTest("{t} is not available".format(t=tool))
+
+        self._sparse()
+        destdir = os.path.join(self.tdir, "exports")
+        exported = export.export(self.image, destdir, "disk", ["zstd"])
+        self.assertEqual(list(exported), ["zstd"])
+        self.assertTrue(os.path.basename(exported["zstd"]).startswith("disk-"))
+        self.assertEqual(os.readlink(os.path.join(destdir, "disk.img.tar.zst")), os.path.basename(exported["zstd"]))
+
+        extracted = os.path.join(self.tdir, "extracted")
+        os.mkdir(extracted)
+        subprocess.check_call(["tar", "--use-compress-program=zstd", "-C", extracted, "-xf", exported["zstd"]])
+        copy = os.path.join(extracted, os.path.basename(self.image))
+        with open(self.image, "rb") as ifp, open(copy, "rb") as cfp:
+            self.assertEqual(ifp.read(), cfp.read())
+        (data, size) = export.allocation(copy)
+        self.assertEqual(size, 8 * 1048576)
+        self.assertLess(data, size)
+
+        # A second export moves the latest link
+        again = export.export(self.image, destdir, "disk", ["zstd"])
+        self.assertNotEqual(again["zstd"], exported["zstd"])
+        self.assertEqual(os.readlink(os.path.join(destdir, "disk.img.tar.zst")), os.path.basename(again["zstd"]))
+
+
+    def qcow2_backing(self):
+        self.logger.info("A qcow2 export is backed by the previous export")
+
+        if not shutil.which("qemu-img"):
+            self.skipTest("qemu-img is not available")
+
+        self._sparse()
+        destdir = os.path.join(self.tdir, "exports")
+        first = export.export(self.image, destdir, "disk", ["qcow2"], backing=True)["qcow2"]
+        second = export.export(self.image, destdir, "disk", ["qcow2"], backing=True)["qcow2"]
+        self.assertEqual(os.path.realpath(os.path.join(destdir, "disk.qcow2")), second)
+
+        info = [json.loads(subprocess.check_output(["qemu-img", "info", "--output=json", q])) for q in [first, second]]
+        self.assertNotIn("backing-filename", info[0])
+        self.assertEqual(info[1]["backing-filename"], first)
+        self.assertEqual(info[1]["virtual-size"], 8 * 1048576)
+        subprocess.check_call(["qemu-img", "compare", "-q", self.image, second])
+
+
+    def stale_link(self):
+        self.logger.info("A link left by an interrupted export is replaced")
+
+        if not shutil.which("zstd"):
+            self.skipTest("zstd is not available")
+
+        self._sparse()
+        destdir = os.path.join(self.tdir, "exports")
+        os.mkdir(destdir)
+        os.symlink("disk-interrupted.img.tar.zst", os.path.join(destdir, "disk.img.tar.zst.tmp"))
+        exported = export.export(self.image, destdir, "disk", ["zstd"])
+        self.assertEqual(os.readlink(os.path.join(destdir, "disk.img.tar.zst")), os.path.basename(exported["zstd"]))
+        self.assertFalse(os.path.lexists(os.path.join(destdir, "disk.img.tar.zst.tmp")))
+
+
+    def unsupported(self):
+        self.logger.info("An unknown export format is rejected")
+
+        self._sparse()
+        with self.assertRaises(Exception):
+            export.export(self.image, os.path.join(self.tdir, "exports"), "disk", ["vmdk"])
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
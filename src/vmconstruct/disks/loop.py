@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.loop
+    :platform: Unix
+    :synopsis: vmconstruct loop devices through the loop-control ioctls
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Attach image files to loop devices directly with the kernel ioctls
+instead of through kpartx and device-mapper.  A partition is either
+given its own loop device limited to its offset and size, or the whole
+image is attached with partition scanning.  Neither needs udev so many
+images can be attached in parallel.
+
+The allocator is safe to use from several threads and processes: a free
+device is claimed by configuring it and if another process configured
+it first the next free device is tried.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import stat
+import struct
+import threading
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+LOOP_CONTROL = "/dev/loop-control"
+LOOP_MAJOR = 7
+
+# <linux/loop.h>
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_BLOCK_SIZE = 0x4C09
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_PARTSCAN = 8
+
+# struct loop_info64: device, inode, rdevice, offset, sizelimit, number,
+# encrypt type, encrypt key size, flags, file name, crypt name, key, init
+_LOOP_INFO64 = struct.Struct("<QQQQQIIII64s64s32s2Q")
+# struct loop_config: fd, block size, loop_info64, reserved
+_LOOP_CONFIG = struct.Struct("<II{n}s64s".format(n=_LOOP_INFO64.size))
+
+# Serialise the allocation in this process, other processes are handled by
+# retrying when a device is claimed first
+_lock = threading.Lock()
+# Partition device nodes made by us which are removed on detach
+_nodes = set()
+
+
+def _node(path, dev):
+    """\
+    Make the device node if /dev is not managed by devtmpfs or udev.
+
+    :returns: True if the node was made.
+    """
+    try:
+        st = os.stat(path)
+        if stat.S_ISBLK(st.st_mode) and st.st_rdev == dev:
+            return(False)
+        # left over from a device which has gone
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    try:
+        os.mknod(path, 0o660 | stat.S_IFBLK, dev)
+    except FileExistsError:
+        # made by devtmpfs or udev in the meantime
+        return(False)
+
+    return(True)
+
+
+def _configure(fd, imagefd, image, offset, sizelimit, flags, block_size):
+    info = _LOOP_INFO64.pack(0, 0, 0, offset, sizelimit, 0, 0, 0, flags, os.fsencode(image)[:63], b"", b"", 0, 0)
+    try:
+        fcntl.ioctl(fd, LOOP_CONFIGURE, _LOOP_CONFIG.pack(imagefd, block_size, info, b""))
+    except OSError as e:
+        if e.errno not in [errno.EINVAL, errno.ENOTTY]:
+            raise
+        # Kernels before 5.8 have no LOOP_CONFIGURE
+        fcntl.ioctl(fd, LOOP_SET_FD, imagefd)
+        try:
+            fcntl.ioctl(fd, LOOP_SET_STATUS64, info)
+            if block_size:
+                fcntl.ioctl(fd, LOOP_SET_BLOCK_SIZE, block_size)
+        except OSError:
+            fcntl.ioctl(fd, LOOP_CLR_FD)
+            raise
+
+
+def attach(image, offset=0, sizelimit=0, block_size=0, partscan=False, readonly=False, retries=64):
+    """\
+    Attach image to a free loop device.
+
+    :param offset: The byte offset in the image the device starts at.
+    :param sizelimit: The size of the device in bytes or 0 for the rest of
+                      the image.
+    :param block_size: The logical block size of the device or 0 for the
+                       default of 512 bytes.
+    :param partscan: Make the kernel scan the partition table.
+    :returns: The path of the loop device.
+    """
+    flags = (LO_FLAGS_PARTSCAN if partscan else 0) | (LO_FLAGS_READ_ONLY if readonly else 0)
+    imagefd = os.open(image, os.O_RDONLY if readonly else os.O_RDWR)
+    try:
+        ctlfd = os.open(LOOP_CONTROL, os.O_RDWR)
+        try:
+            for attempt in range(retries):
+                with _lock:
+                    n = fcntl.ioctl(ctlfd, LOOP_CTL_GET_FREE)
+                    path = "/dev/loop{n}".format(n=n)
+                    _node(path, os.makedev(LOOP_MAJOR, n))
+                    fd = os.open(path, os.O_RDWR)
+                    try:
+                        _configure(fd, imagefd, image, offset, sizelimit, flags, block_size)
+                        _logger.debug("Attached {i} at {o} ({s} bytes) to {p}".format(i=image, o=offset, s=sizelimit, p=path))
+                        return(path)
+                    except OSError as e:
+                        if e.errno != errno.EBUSY:
+                            raise
+                        # Another process claimed the device after GET_FREE
+                        _logger.debug("{p} was claimed first, retrying".format(p=path))
+                    finally:
+                        os.close(fd)
+        finally:
+            os.close(ctlfd)
+    finally:
+        os.close(imagefd)
+
+    raise Exception("No free loop device for {i} after {r} attempts".format(i=image, r=retries))
+
+
+def partitions(path, indexes, timeout=10):
+    """\
+    Return a dictionary of partition index to device path for a loop
+    device attached with partscan, waiting for the kernel to create them.
+    """
+    name = os.path.basename(path)
+    devices = {}
+    deadline = time.monotonic() + timeout
+    for k in indexes:
+        sysdev = "/sys/block/{n}/{n}p{k}/dev".format(n=name, k=k)
+        while not os.path.exists(sysdev):
+            if time.monotonic() > deadline:
+                raise Exception("Partition {k} of {p} did not appear".format(k=k, p=path))
+            time.sleep(0.01)
+        with open(sysdev, "rt") as fp:
+            (major, minor) = [int(x) for x in fp.read().strip().split(":")]
+        devices[k] = "{p}p{k}".format(p=path, k=k)
+        with _lock:
+            if _node(devices[k], os.makedev(major, minor)):
+                _nodes.add(devices[k])
+
+    return(devices)
+
+
+def detach(path):
+    """\
+    Detach the loop device at path.  If it is still open the kernel
+    detaches it when it is closed.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, LOOP_CLR_FD)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            raise
+        # Not attached
+    finally:
+        os.close(fd)
+
+    with _lock:
+        for node in [n for n in _nodes if n.startswith(path+"p")]:
+            _nodes.discard(node)
+            try:
+                os.unlink(node)
+            except FileNotFoundError:
+                pass
+
+    _logger.debug("Detached {p}".format(p=path))
@@ -0,0 +1,192 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import concurrent.futures
+import logging
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from vmconstruct.disks import disk, disks, loop
+
+
+def suite():
+    loopTS = unittest.TestSuite()
+    loopTS.addTest(LoopUT("offset"))
+    loopTS.addTest(LoopUT("parallel"))
+    loopTS.addTest(LoopUT("partscan"))
+    loopTS.addTest(LoopUT("format"))
+    loopTS.addTest(LoopUT("trim"))
+    loopTS.addTest(LoopUT("mounted"))
+
+    return(loopTS)
+
+
+
+class LoopUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        if os.geteuid() != 0 or not os.path.exists(loop.LOOP_CONTROL):
+            self.skipTest("loop devices need root and {c}".format(c=loop.LOOP_CONTROL))
+        self.tdir = tempfile.mkdtemp()
+        self.image = os.path.join(self.tdir, "disk.img")
+        with open(self.image, "wb") as fp:
+            fp.truncate(16 * 1048576)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _sysfs(self, dev, name):
+        with open("/sys/block/{d}/{n}".format(d=os.path.basename(dev), n=name), "rt") as fp:
+            return(fp.read().strip())
+
+
+    def offset(self):
+        self.logger.info("A loop device limited to an extent of the image")
+
+        with open(self.image, "rb+") as fp:
+            fp.seek(2 * 1048576)
+            fp.write(b"partition data")
+
+        dev = loop.attach(self.image, 2 * 1048576, 4 * 1048576)
+        try:
+            self.assertEqual(self._sysfs(dev, "loop/offset"), str(2 * 1048576))
+            self.assertEqual(int(self._sysfs(dev, "size")) * 512, 4 * 1048576)
+            with open(dev, "rb") as fp:
+                self.assertEqual(fp.read(14), b"partition data")
+        finally:
+            loop.detach(dev)
+
+
+    def parallel(self):
+        self.logger.info("Loop devices allocated concurrently are all different")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            futures = [executor.submit(loop.attach, self.image, x * 1048576, 1048576) for x in range(8)]
+            devs = [f.result() for f in futures]
+        try:
+            self.assertEqual(len(set(devs)), 8)
+            self.assertEqual(sorted([int(self._sysfs(d, "loop/offset")) for d in devs]), [x * 1048576 for x in range(8)])
+        finally:
+            for dev in devs:
+                loop.detach(dev)
+
+
+    def _disk(self, mapper, filesystem):
+        subvol = types.SimpleNamespace(path=self.tdir)
+        return(disk(subvol, "xvda", {"label": "gpt", "mapper": mapper, "partitions": {1: {"size": 8, "filesystem": filesystem}, 2: {"size": 8, "filesystem": filesystem}}}))
+
+
+    def partscan(self):
+        self.logger.info("The kernel partitions of a loop device")
+
+        d = self._disk("partscan", "ext4")
+        dev = loop.attach(d.image, partscan=True)
+        try:
+            loop.partitions(dev, [1, 2], timeout=2)
+        except Exception:
+            self.skipTest("the kernel does not support the partition table")
+        finally:
+            loop.detach(dev)
+
+        with d._lo:
+            self.assertEqual(sorted(d._lo.elements), [1, 2])
+            for (k, (mapper, dev)) in d._lo.elements.items():
+                self.assertEqual(mapper, "{d}p{k}".format(d=dev, k=k))
+                with open(mapper, "rb") as fp:
+                    self.assertEqual(fp.seek(0, os.SEEK_END), 8 * 1048576)
+        self.assertEqual(len(d._lo), 0)
+        self.assertFalse(os.path.exists(mapper))
+
+
+    def format(self):
+        self.logger.info("Formatting through per partition loop devices")
+
+        if not shutil.which("mkfs.ext4"):
+            self.skipTest("mkfs.ext4 is not available")
+
+        d = self._disk("loop", "ext4")
+        d.format()
+        uuids = [p.flags["UUID"] for (k, p) in d.partitions()]
+        self.assertEqual(len(set(uuids)), 2)
+        self.assertEqual(len(d._lo), 0)
+
+
+    def trim(self):
+        self.logger.info("The space freed in a filesystem is reclaimed from the image")
+
+        if not shutil.which("mkfs.ext4") or not shutil.which("fstrim"):
+            self.skipTest("mkfs.ext4 or fstrim is not available")
+
+        subvol = types.SimpleNamespace(path=self.tdir)
+        d = disk(subvol, "xvda", {"label": "gpt", "mapper": "loop", "partitions": {1: {"size": 12, "filesystem": "ext4", "mount": "/"}}})
+        d.format()
+        d.mount()
+        try:
+            scratch = os.path.join(self.tdir, "mnt", "scratch")
+            with open(scratch, "wb") as fp:
+                fp.write(os.urandom(4 * 1048576))
+                os.fsync(fp.fileno())
+            os.unlink(scratch)
+        finally:
+            d.umount()
+        self.assertEqual(len(d._lo), 0)
+
+        sparsified = d.sparsify()
+        self.assertEqual(list(sparsified["trimmed"]), ["/"])
+        self.assertGreaterEqual(sparsified["reclaimed"], 4 * 1048576)
+
+
+    def mounted(self):
+        self.logger.info("The mount points of several disks are mounted as one tree")
+
+        if not shutil.which("mkfs.ext4"):
+            self.skipTest("mkfs.ext4 is not available")
+
+        subvol = types.SimpleNamespace(path=self.tdir)
+        ext4 = {"size": 8, "filesystem": "ext4"}
+        d = disks(subvol, {
+            "xvda": {"label": "gpt", "mapper": "loop", "partitions": {1: dict(ext4, mount="/"), 2: dict(ext4, mount="/var")}},
+            "xvdb": {"label": "gpt", "mapper": "loop", "partitions": {1: dict(ext4, mount="/home"), 2: dict(ext4, mount="/var/log")}}
+        })
+        d.format()
+        tree = d.mounted()
+        with tree as mntpoint:
+            self.assertEqual(mntpoint, os.path.join(self.tdir, "mnt"))
+            for mount in ["/", "/var", "/home", "/var/log"]:
+                self.assertTrue(os.path.ismount(os.path.join(mntpoint, mount[1:])))
+        self.assertEqual(sorted(tree.timings["umount"]), ["/", "/home", "/var", "/var/log"])
+        self.assertFalse(os.path.ismount(mntpoint))
+        self.assertEqual([len(v._lo) for v in d._disks.values()], [0, 0])
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.mounttree
+    :platform: Unix
+    :synopsis: vmconstruct parallel and transactional mounting
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Mount a tree of filesystems with sibling subtrees mounted in parallel as
+soon as their parent is mounted.  If a mount fails everything which was
+mounted is umounted again, children before their parent, so nothing is
+left behind for the next build.  Each mount and umount is timed.
+"""
+
+import concurrent.futures
+import logging
+import os
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _parent(mount, mounts):
+    """\
+    Return the closest mount point in mounts above mount or None.
+    """
+    while mount != "/":
+        mount = os.path.dirname(mount)
+        if mount in mounts:
+            return(mount)
+
+    return(None)
+
+
+
+class mounttree(object):
+    """\
+    A context manager which mounts the tree on entry and umounts it on exit.
+
+        with mounttree(root, {"/": disk1, "/home": disk2}) as mntpoint:
+            ...
+
+    The mounts are a dictionary of mount point to an object with mount(mp)
+    and umount(mp) methods, such as a disk.  After use timings holds the
+    seconds taken by each mount and umount.
+    """
+    def __init__(self, root, mounts, workers=None):
+        """\
+        The constructor.
+
+        :param root: The path the tree is mounted at, returned on entry.
+        :type root: str.
+        :param mounts: A dictionary of mount point to the object which
+                       mounts and umounts it.
+        :type mounts: dict.
+        :param workers: The number of mounts run at once.
+        :type workers: int.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._root = root
+        self._mounts = mounts
+        self._workers = workers
+        self._mounted = []
+        self.timings = {"mount": {}, "umount": {}}
+
+
+    def __enter__(self):
+        self._logger.debug("__enter__ context manager")
+        self.mount()
+        return(self._root)
+
+
+    def __exit__(self, *exc_info):
+        self._logger.debug("__exit__ context manager")
+        self.umount()
+
+        return(False)
+
+
+    @property
+    def mounted(self):
+        """\
+        The mount points which are mounted in the order they were mounted.
+        """
+        return(list(self._mounted))
+
+
+    def _timed(self, action, mount):
+        start = time.monotonic()
+        getattr(self._mounts[mount], action)(mount)
+        self.timings[action][mount] = time.monotonic() - start
+
+
+    def _schedule(self, action, mounts, after, stop=True):
+        """\
+        Run action on each of mounts once every mount point in after[mount]
+        has succeeded.  If stop is set nothing new is started after a
+        failure, those running are waited for.
+
+        :returns: A tuple of the mount points which succeeded in the order
+                  they finished and the first exception or None.
+        """
+        waiting = dict([(m, set(after[m])) for m in mounts])
+        (done, error) = ([], None)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            running = {}
+            while waiting or running:
+                if error is None or not stop:
+                    for m in sorted([m for (m, deps) in waiting.items() if not deps]):
+                        del(waiting[m])
+                        running[executor.submit(self._timed, action, m)] = m
+                if not running:
+                    break
+                (finished, _) = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in finished:
+                    m = running.pop(f)
+                    try:
+                        f.result()
+                    except Exception as e:
+                        self._logger.error("Failed to {a} {m}: {e}".format(a=action, m=m, e=e))
+                        error = error or e
+                        continue
+                    done.append(m)
+                    for deps in waiting.values():
+                        deps.discard(m)
+
+        return((done, error))
+
+
+    def mount(self):
+        """\
+        Mount the tree.  If a mount fails the mounts made are undone and the
+        exception is raised.
+        """
+        mounts = sorted(self._mounts)
+        parents = dict([(m, [p for p in [_parent(m, self._mounts)] if p]) for m in mounts])
+        (self._mounted, error) = self._schedule("mount", mounts, parents)
+        if error is not None:
+            self._logger.info("Unwinding {n} mounts after failure".format(n=len(self._mounted)))
+            try:
+                self.umount()
+            except Exception as e:
+                self._logger.error("Failed to unwind the mounts: {e}".format(e=e))
+            raise error
+
+
+    def umount(self):
+        """\
+        Umount everything which was mounted, each mount point after the
+        mount points below it.  A mount point which fails to umount keeps
+        its parents mounted and the exception is raised.
+        """
+        mounted = list(self._mounted)
+        children = dict([(m, [c for c in mounted if _parent(c, mounted) == m]) for m in mounted])
+        (done, error) = self._schedule("umount", mounted, children, stop=False)
+        self._mounted = [m for m in self._mounted if m not in done]
+        if error is not None:
+            raise error
@@ -0,0 +1,224 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from vmconstruct.btrfs import directory
+from vmconstruct.disks import disk
+from vmconstruct.disks.mounttree import mounttree
+
+
+def suite():
+    mounttreeTS = unittest.TestSuite()
+    mounttreeTS.addTest(MounttreeUT("order"))
+    mounttreeTS.addTest(MounttreeUT("parallel"))
+    mounttreeTS.addTest(MounttreeUT("unwind"))
+    mounttreeTS.addTest(MounttreeUT("umount_failure"))
+    mounttreeTS.addTest(MounttreeUT("sibling_failure"))
+
+    return(mounttreeTS)
+
+
+
+class _recorder(object):
+    """\
+    Record the mounts and umounts, failing those in fail.
+    """
+    def __init__(self, fail=None, barrier=None):
+        self.events = []
+        self.fail = fail or []
+        self.barrier = barrier
+        self._lock = threading.Lock()
+
+
+    def mount(self, mount):
+        if self.barrier and mount in self.barrier[1]:
+            self.barrier[0].wait()
+        if ("mount", mount) in self.fail:
+            raise Exception("mount {m} failed".format(m=mount))
+        with self._lock:
+            self.events.append(("mount", mount))
+
+
+    def umount(self, mount):
+        if ("umount", mount) in self.fail:
+            raise Exception("umount {m} failed".format(m=mount))
+        with self._lock:
+            self.events.append(("umount", mount))
+
+
+
+class _interleave(object):
+    """\
+    Stand in for a disk in the tree so the mount of "/var" holds the
+    partition mapping while the mount of "/home" fails.
+    """
+    class _losetup(disk._losetup):
+        def __init__(self, d, interleave):
+            disk._losetup.__init__(self, d.id, d)
+            self._interleave = interleave
+
+
+        def __getitem__(self, k):
+            mapping = disk._losetup.__getitem__(self, k)
+            if self._disk._parts[k].mount == "/var":
+                self._interleave.taken.set()
+                self._interleave.failed.wait(5)
+                self._interleave.mapped = len(self.elements)
+            else:
+                self._interleave.taken.wait(5)
+            return(mapping)
+
+
+    def __init__(self, d):
+        self.disk = d
+        self.taken = threading.Event()
+        self.failed = threading.Event()
+        self.mapped = None
+        d._lo = self._losetup(d, self)
+
+
+    def mount(self, mount):
+        try:
+            self.disk.mount(mount)
+        finally:
+            if mount == "/home":
+                self.failed.set()
+
+
+    def umount(self, mount):
+        self.disk.umount(mount, trim=False)
+
+
+
+class MounttreeUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def _tree(self, recorder, workers=None):
+        mounts = ["/", "/boot", "/boot/efi", "/var", "/var/lib/docker", "/home"]
+        return(mounttree("/mnt", dict([(m, recorder) for m in mounts]), workers=workers))
+
+
+    def _before(self, events, first, second):
+        self.assertLess(events.index(first), events.index(second))
+
+
+    def order(self):
+        self.logger.info("A parent is mounted before and umounted after its children")
+
+        r = _recorder()
+        tree = self._tree(r)
+        with tree as mntpoint:
+            self.assertEqual(mntpoint, "/mnt")
+            self.assertEqual(len(r.events), 6)
+            self.assertEqual(sorted(tree.mounted), sorted(tree.timings["mount"]))
+        self.assertEqual(tree.mounted, [])
+        self.assertEqual(len(r.events), 12)
+        self.assertEqual(sorted(tree.timings["umount"]), sorted(tree.timings["mount"]))
+
+        for (parent, child) in [("/", "/boot"), ("/boot", "/boot/efi"), ("/", "/var"), ("/var", "/var/lib/docker"), ("/", "/home")]:
+            self._before(r.events, ("mount", parent), ("mount", child))
+            self._before(r.events, ("umount", child), ("umount", parent))
+
+
+    def parallel(self):
+        self.logger.info("Siblings are mounted at the same time")
+
+        # each of the siblings waits for the others so they must run at once
+        r = _recorder(barrier=(threading.Barrier(3, timeout=5), ["/boot", "/var", "/home"]))
+        with self._tree(r, workers=4):
+            pass
+        self.assertEqual(len(r.events), 12)
+
+
+    def unwind(self):
+        self.logger.info("A failed mount umounts everything that was mounted")
+
+        r = _recorder(fail=[("mount", "/var")])
+        tree = self._tree(r, workers=1)
+        with self.assertRaisesRegex(Exception, "mount /var failed"):
+            with tree:
+                self.fail("the tree was entered")
+
+        mounted = [m for (a, m) in r.events if a == "mount"]
+        umounted = [m for (a, m) in r.events if a == "umount"]
+        self.assertNotIn("/var/lib/docker", mounted)
+        self.assertEqual(sorted(mounted), sorted(umounted))
+        self.assertEqual(umounted[-1], "/")
+        self.assertEqual(tree.mounted, [])
+
+
+    def umount_failure(self):
+        self.logger.info("A failed umount keeps the parents mounted")
+
+        r = _recorder(fail=[("umount", "/boot/efi")])
+        tree = self._tree(r)
+        with self.assertRaisesRegex(Exception, "umount /boot/efi failed"):
+            with tree:
+                pass
+
+        self.assertEqual(sorted(tree.mounted), ["/", "/boot", "/boot/efi"])
+        umounted = [m for (a, m) in r.events if a == "umount"]
+        self.assertEqual(sorted(umounted), ["/home", "/var", "/var/lib/docker"])
+
+
+    def sibling_failure(self):
+        self.logger.info("A failed mount keeps the mapping a sibling mount on the same disk is using")
+
+        tdir = tempfile.mkdtemp()
+        try:
+            defn = {
+                "mapper": "fake",
+                "partitions": {
+                    1: {"mount": "/var", "size": 8, "filesystem": "ext4"},
+                    2: {"mount": "/home", "size": 8, "filesystem": "ext4"}
+                }
+            }
+            d = disk(directory(tdir), "xvda", defn)
+            os.makedirs(os.path.join(tdir, "mnt"))
+            # /home cannot be mounted on a file
+            open(os.path.join(tdir, "mnt", "home"), "wb").close()
+
+            interleave = _interleave(d)
+            tree = mounttree(os.path.join(tdir, "mnt"), {"/var": interleave, "/home": interleave}, workers=2)
+            with self.assertRaises(FileExistsError):
+                with tree:
+                    self.fail("the tree was entered")
+
+            self.assertEqual(interleave.mapped, 2)
+            self.assertEqual(tree.mounted, [])
+            self.assertEqual((d._mounts, d._pending, d._lo.elements), ({}, 0, {}))
+        finally:
+            shutil.rmtree(tdir)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
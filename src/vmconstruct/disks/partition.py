@@ -1,18 +1,21 @@
 # -*- coding: utf-8 -*-
 import abc
 import logging
+import random
+import struct
 import uuid
 from binascii import crc32
 from collections import namedtuple
-from random import choice
 from sparse_list import SparseList
 
 
-# There really should be no need to change these unless trying to generate something unusual.  Not well
-# tested with non default values!
-MBR_SECTOR_SIZE = 512		# size for calculation when generating a mbr partition table
+# There really should be no need to change these unless trying to generate something unusual.  The
+# sector size and alignment can be chosen per disk.
+MBR_SECTOR_SIZE = 512		# default sector size when generating a mbr partition table
 
-GPT_SECTOR_SIZE = 512		# size for calculation when generating a guid partition table
+GPT_SECTOR_SIZE = 512		# default sector size when generating a guid partition table
+SECTOR_SIZES = [512, 4096]	# logical sector sizes that can be used (512 byte or 4K native)
+ALIGNMENT = 1048576		# default alignment in bytes of partition starts and sizes
 GPT_PTE_SIZE = 128		# size of a gpt partition entry (128 is usual)
 GPT_PTE_ENTS = 128		# number of entries in the gpt pte array (128 is usual)
 
@@ -21,13 +24,15 @@ TODO:
 
 correctly generate chs values in mbr for small disks
 gpt update first usable / last usable sector in header
-map well known mbr types to a table
-map will known gpt type uuid to a table
-generate a random uuid for gpt header
 """
 
 
 _partitionTypes = []
+# Indexes of the registered types, a later registration of the same key replaces an earlier one
+_byGPTCode = {}
+_byMBRCode = {}
+_byCode = {}
+_byUUID = {}
 
 class partitionType(object):
     _filesystem2fscode = {
@@ -39,41 +44,49 @@ class partitionType(object):
         "xfs": "linux/filesystem"
     }
 
-    def __init__(self, gptCode, uuidStr, os, code, type, fsnames=[]):
+    def __init__(self, gptCode, uuidStr, os, code, type, fsnames=[], register=True):
         self._gptCode = gptCode
-        self._mbrCode = (gptCode >> 8) if not ((gptCode | 0xff00) ^ 0xff00) else -1
+        self._mbrCode = (gptCode >> 8) if gptCode is not None and not ((gptCode | 0xff00) ^ 0xff00) else -1
         self._uuid = uuid.UUID("{{{uuid}}}".format(uuid=uuidStr))
         self._code = code
         self._type = type
 
-        _partitionTypes.append(self)
+        if register:
+            _partitionTypes.append(self)
+            _byGPTCode[gptCode] = self
+            _byCode[code] = self
+            _byUUID[self._uuid] = self
+            if self._mbrCode > 0:
+                _byMBRCode[self._mbrCode] = self
 
 
     @classmethod
     def resolveGPTEntry(self, fscode):
         """\
-        Return a uuid object for use in the partition table.
+        Return the partitionType for use in the partition table.  The fscode
+        may be a gpt short code, a mbr code, our text code, a filesystem name
+        or a type uuid.
         """
+        if isinstance(fscode, int):
+            entry = _byGPTCode.get(fscode, None) or _byMBRCode.get(fscode, None)
+        else:
+            entry = _byCode.get(fscode, None)
+            if entry is None and fscode in self._filesystem2fscode:
+                entry = _byCode[self._filesystem2fscode[fscode]]
+        if entry is not None:
+            return(entry)
 
         # try parsing the code to a uuid, works even if the
         # uuid is not registered, e.g. for some unknown type.
         try:
-            return(uuid.UUID("{{{s}}}".format(s=fscode)))
+            typeuuid = uuid.UUID("{{{s}}}".format(s=fscode))
         except ValueError:
-            pass
-
-        # try getting the uuid by matching gpt short code and
-        # our text code.
-        l = [x for x in _partitionTypes if x._gptCode == fscode]
-        if l: return(l.pop())
-
-        l = [x for x in _partitionTypes if x._code == fscode]
-        if l: return(l.pop())
+            raise Exception("Unknown Code: {fscode}".format(fscode=fscode))
 
-        if fscode in self._filesystem2fscode:
-            return(self.resolveGPTEntry(self._filesystem2fscode[fscode]))
+        if typeuuid in _byUUID:
+            return(_byUUID[typeuuid])
 
-        raise Exception("Unknown Code: {fscode}".format(fscode=fscode))
+        return(partitionType(None, str(typeuuid), None, str(typeuuid), "Unknown", register=False))
 
 
     @classmethod
@@ -83,17 +96,18 @@ class partitionType(object):
 
     @classmethod
     def resolveMBRCode(self, fscode):
+        """\
+        Return the mbr partition type byte for a mbr code, gpt short code,
+        our text code or a filesystem name.
+        """
         if isinstance(fscode, int) and fscode in range(256):
             return(fscode)
 
-        # try our text code
-        l = [x._uuid for x in _partitionTypes if x._code == fscode]
-        if l: return(l.pop())
+        entry = self.resolveGPTEntry(fscode)
+        if entry._mbrCode < 0:
+            raise Exception("Code {fscode} has no mbr equivalent".format(fscode=fscode))
 
-        if fscode in self._filesystem2fscode:
-            return(self.resolveMBRCode(self._filesystem2fscode[fscode]))
-
-        raise Exception("Unknown Code: {fscode}".format(fscode=fscode))
+        return(entry._mbrCode)
 
 
 # Well know guid partition table pte guids (http://en.wikipedia.org/wiki/GUID_Partition_Table)
@@ -283,6 +297,13 @@ class PartitionTooLarge(Exception):
 
 
 
+class InvalidGeometry(Exception):
+    """\
+    Raise if the sector size or alignment of the disk is not supported.
+    """
+
+
+
 class partition(namedtuple("partition", "size filesystem mount label flags")):
     """\
     A class representing a partition on the disk.
@@ -302,8 +323,33 @@ class partition(namedtuple("partition", "size filesystem mount label flags")):
 
 
 class _partition(metaclass=abc.ABCMeta):
-    def __init__(self):
+    _SECTOR_SIZE = 512
+
+    def __init__(self, seed=None, sector_size=None, alignment=ALIGNMENT):
+        """\
+        The constructor.
+
+        :param seed: Seed for the disk signature and uuids so that the same
+                     partition table is generated each time, or None for
+                     random values.
+        :param sector_size: The logical sector size of the disk, one of
+                            SECTOR_SIZES, or None for the table type default.
+        :type sector_size: int.
+        :param alignment: The bytes partition starts and sizes are rounded up
+                          to, e.g. a RAID stripe or SSD erase block size.  It
+                          must be a multiple of the sector size.
+        :type alignment: int.
+        """
         self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self._random = random.Random(seed)
+
+        self._sector_size = self._SECTOR_SIZE if sector_size is None else sector_size
+        self._alignment = alignment
+        if self._sector_size not in SECTOR_SIZES:
+            raise InvalidGeometry("Sector size {s} is not one of {l}".format(s=self._sector_size, l=SECTOR_SIZES))
+        if not isinstance(alignment, int) or alignment < self._sector_size or alignment % self._sector_size:
+            raise InvalidGeometry("Alignment {a} is not a multiple of the {s} byte sector size".format(a=alignment, s=self._sector_size))
+
         self._logger.debug("Building empty partition table")
         self._init()
 
@@ -341,6 +387,57 @@ class _partition(metaclass=abc.ABCMeta):
         pass
 
 
+    @abc.abstractmethod
+    def _sizes(self):
+        """\
+        Return a list of (index, size in Mb) for the defined partitions in
+        index order.
+        """
+        pass
+
+
+    @property
+    def sector_size(self):
+        return(self._sector_size)
+
+
+    @property
+    def alignment(self):
+        return(self._alignment)
+
+
+    def _align(self, nbytes):
+        """\
+        Round nbytes up to the alignment.
+        """
+        return(-(-nbytes // self._alignment) * self._alignment)
+
+
+    def _firstStart(self):
+        """\
+        The byte offset of the first partition, 1Mb (sector 2048 with 512
+        byte sectors) rounded up to the alignment.
+        """
+        return(self._align(1048576))
+
+
+    def extents(self):
+        """\
+        Return a dictionary of partition index to (offset, length) in bytes
+        for each defined partition in the disk image.  The partitions follow
+        each other in index order from the first aligned start and their
+        sizes are rounded up to the alignment.
+        """
+        extents = {}
+        start = self._firstStart()
+        for (index, sizemb) in self._sizes():
+            length = self._align(sizemb * 1048576)
+            extents[index] = (start, length)
+            start += length
+
+        return(extents)
+
+
     def makeDisk(self, file):
         """\
         Create a suitably sized sparse file and then write the partition table.
@@ -355,6 +452,7 @@ class _partition(metaclass=abc.ABCMeta):
 
 class mbr(_partition):
     # http://en.wikipedia.org/wiki/Master_boot_record
+    _SECTOR_SIZE = MBR_SECTOR_SIZE
 
     def _init(self):
         # PTE information
@@ -365,10 +463,10 @@ class mbr(_partition):
         # Binary representation
         self._pt = bytearray(b"\0"*512)		# The mbr is 512 bytes regardless of sector size
         # disk signature
-        self._pt[440] = choice(range(0, 256))
-        self._pt[441] = choice(range(0, 256))
-        self._pt[442] = choice(range(0, 256))
-        self._pt[443] = choice(range(0, 256))
+        self._pt[440] = self._random.randrange(256)
+        self._pt[441] = self._random.randrange(256)
+        self._pt[442] = self._random.randrange(256)
+        self._pt[443] = self._random.randrange(256)
         # boot signature
         self._pt[510] = 0x55
         self._pt[511] = 0xaa
@@ -381,6 +479,7 @@ class mbr(_partition):
         if index not in range(1, 5):
             raise InvalidPartitionNumber()
 
+        fscode = partitionType.resolveMBRCode(fscode)
         try:
             original_entry = self._partitions[index - 1]
             original_bootable = self._bootable
@@ -407,106 +506,83 @@ class mbr(_partition):
 
     def diskSize(self):
         """\
-        Iterate over the partition table and calculate the disk size.
+        The end of the last partition.
         """
-        # The 0-2047s = 1Mb
-        size = 1
-        for (sizemb, filesystem) in self._partitions:
-            size += sizemb if sizemb else 0
+        extents = self.extents()
+        if not extents:
+            return(self._firstStart())
+
+        return(max([offset + length for (offset, length) in extents.values()]))
+
 
-        return(size*1048576)
+    def _sizes(self):
+        return([(index + 1, self._partitions[index][0]) for index in range(0, 4) if self._partitions[index][0]])
 
 
     def _buildPartitions(self):
         """\
-        Refresh the partition table sizes.  We deal with 512 byte sectors but align for 4k sectors.
+        Refresh the partition table sizes in units of the sector size.
         """
-        # Where the first partition will start
-        next_start = 2048
+        extents = self.extents()
 
         self._logger.debug("Building partitions with: {p}".format(p=self._partitions))
 
         for index in range(0, 4):
             (sizemb, filesystem) = self._partitions[index]
 
-            if filesystem == 0xee and len(self._partitions) == 1:
-                # a protective mbr for a gpt
-                next_start = 1
-
             offset = 446 + (index * 16)				# start position of this pte
 
             if not sizemb:
                 self._logger.debug("Zeroing PTE for partition {p}".format(p=(index+1)))
-                for zero in range(0, 16):
-                    self._pt[offset + zero] = 0
-            else:
-                if index == self._bootable:
-                    self._pt[offset + 0x00] = 0x80			# partition type (0x80 = bootable)
-                else:
-                    self._pt[offset + 0x00] = 0x00
-
-                self._pt[offset + 0x01] = 254				# chs start address (indicate lba)
-                self._pt[offset + 0x02] = 255
-                self._pt[offset + 0x03] = 255
+                self._pt[offset:offset+16] = bytes(16)
+                continue
 
-                self._pt[offset + 0x04] = filesystem			# fs type
-
-                self._pt[offset + 0x05] = self._pt[offset + 0x01]	# chs end address
-                self._pt[offset + 0x06] = self._pt[offset + 0x02]
-                self._pt[offset + 0x07] = self._pt[offset + 0x03]
-
-                if next_start > (2**32 - 1):
-                    raise PartitionTooLarge("The start sector is greater than 2^32-1")
-                self._pt[offset + 0x08] = (next_start & 0xff)
-                self._pt[offset + 0x09] = (next_start >> 8) & 0xff
-                self._pt[offset + 0x0a] = (next_start >> 16) & 0xff
-                self._pt[offset + 0x0b] = (next_start >> 24) & 0xff
-
-                # We'll work in 512 byte sectors but make sure we align to 4k byte
-                # (1048576 / 4096) * 8 = number of sectors
-                sector_count = (sizemb * 2048)
-                if sector_count > (2**32 - 1):
-                    raise PartitionTooLarge("The partition size is more than 2^32-1 sectors")
+            if filesystem == 0xee and len(self._partitions) == 1:
+                # a protective mbr for a gpt starts immediately after the mbr
+                (next_start, sector_count) = (1, (sizemb * 1048576) // self._sector_size)
+            else:
+                (next_start, sector_count) = [x // self._sector_size for x in extents[index + 1]]
 
-                self._pt[offset + 0x0c] = sector_count & 0xff
-                self._pt[offset + 0x0d] = (sector_count >> 8) & 0xff
-                self._pt[offset + 0x0e] = (sector_count >> 16) & 0xff
-                self._pt[offset + 0x0f] = (sector_count >> 24) & 0xff
+            if next_start > (2**32 - 1):
+                raise PartitionTooLarge("The start sector is greater than 2^32-1")
+            if sector_count > (2**32 - 1):
+                raise PartitionTooLarge("The partition size is more than 2^32-1 sectors")
 
-                next_start += sector_count
+            # bootable flag (0x80 = bootable), chs start address (indicate lba),
+            # fs type, chs end address, start lba, number of sectors
+            self._pt[offset:offset+16] = struct.pack("<B3sB3sII", 0x80 if index == self._bootable else 0x00,
+                bytes([254, 255, 255]), filesystem, bytes([254, 255, 255]), next_start, sector_count)
 
 
 
 class gpt(_partition):
     # http://en.wikipedia.org/wiki/GUID_Partition_Table
+    _SECTOR_SIZE = GPT_SECTOR_SIZE
+
+    # Header fields up to the header crc32 (0x5c bytes, LE):
+    # signature, revision, header size, header crc32, reserved, this LBA,
+    # other LBA, first usable LBA, last usable LBA, disk guid, pte array LBA,
+    # number of ptes, pte size, pte array crc32
+    _HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+    # Partition entry: type guid, unique guid, first LBA, last LBA (inclusive),
+    # attribute flags, name (UTF-16-LE)
+    _PTE = struct.Struct("<16s16sQQQ72s")
 
     def _init(self):
-        self._partitions = SparseList(0, (None, None, None))
-        self._ptes = bytearray(b'\0'*(GPT_PTE_SIZE * GPT_PTE_ENTS))
+        # index -> [sizemb, type uuid, name, unique uuid], only defined entries are held
+        self._entries = {}
+        # running total of the aligned partition sizes so diskSize does not scan the entries
+        self._allocated = 0
+        self._guid = self._uuid()
+        # the binary tables are only built by write() after a change
+        self._tables = None
 
-        # Binary representation
-        self._ptpri = bytearray(b"\0"*GPT_SECTOR_SIZE)
-        # "EFI PART" signature
-        self._ptpri[0x00] = 0x45 ; self._ptpri[0x01] = 0x46 ; self._ptpri[0x02] = 0x49 ; self._ptpri[0x03] = 0x20
-        self._ptpri[0x04] = 0x50 ; self._ptpri[0x05] = 0x41 ; self._ptpri[0x06] = 0x52 ; self._ptpri[0x07] = 0x54
-        # Revision
-        self._ptpri[0x08] = 0x00 ; self._ptpri[0x09] = 0x00 ; self._ptpri[0x0a] = 0x01 ; self._ptpri[0x0b] = 0x00
-        # Header size (LE)
-        self._ptpri[0x0c:0x0c+4] = self._lebytes(0x5c, 4)
-        # LBA of this copy (1) (address of other copy generated later) (LE)
-        self._ptpri[0x18:0x18+8] = self._lebytes(1, 8)
-        # First usable LBA for partitions (LE)
-        self._ptpri[0x28:0x28+8] = self._lebytes(2+self._pteSectors(), 8)
-        # Disk GUID
-        self._ptpri[0x38:0x38+16] = uuid.uuid4().bytes_le
-        # Starting LBA of PTE list (2 for primary copy) (LE)
-        self._ptpri[0x48:0x48+8] = self._lebytes(2, 8)
-        # Number of PTE entries in array (128) (LE) (not number of defined partitions)
-        self._ptpri[0x50:0x50+4] = self._lebytes(GPT_PTE_ENTS, 4)
-        # Size of PTE (128) (LE)
-        self._ptpri[0x54:0x54+4] = self._lebytes(GPT_PTE_SIZE, 4)
-
-        self._updatePts()
+
+    def _uuid(self):
+        """\
+        Generate a random (version 4) uuid from the table's random source.
+        """
+        return(uuid.UUID(int=self._random.getrandbits(128), version=4))
 
 
     def _pteSectors(self):
@@ -516,108 +592,86 @@ class gpt(_partition):
         GPT_PTE_RESERVATION = 16384	# 16384 is the minimum value, GPT_PTE_SIZE * GPT_PTE_ENTS default values
         pte_bytes = max(GPT_PTE_RESERVATION, (GPT_PTE_SIZE * GPT_PTE_ENTS))
 
-        self._logger.debug("The partition table requires {x} {size} byte sectors".format(x=(-(-pte_bytes // GPT_SECTOR_SIZE)), size=GPT_SECTOR_SIZE))
-
-        return(-(-pte_bytes // GPT_SECTOR_SIZE))
+        return(-(-pte_bytes // self._sector_size))
 
 
-    def _lebytes(self, val, len=4):
+    def _buildTables(self):
         """\
-        Calculate the given value as a little endian ordered byte array of the requested size
+        Generate the primary header, the pte array and the secondary header
+        from the partition entries.
         """
-        bytes = []
-        for byte in range(len):
-            bytes.append((val >> (byte * 8)) & 0xff)
+        if self._tables is not None:
+            return(self._tables)
 
-        return(bytes)
+        self._logger.debug("Building guid partition table with {n} partitions".format(n=len(self._entries)))
 
+        # generate pte bytes, partitions follow each other in index order
+        ptes = bytearray(GPT_PTE_SIZE * GPT_PTE_ENTS)
+        for (index, (start, length)) in self.extents().items():
+            (sizemb, typeuuid, name, guid) = self._entries[index]
+            start_sector = start // self._sector_size
+            self._PTE.pack_into(ptes, (index - 1) * GPT_PTE_SIZE, typeuuid.bytes_le, guid.bytes_le,
+                start_sector, start_sector + (length // self._sector_size) - 1, 0, name.encode("UTF-16-LE")[:72])
 
-    def _updatePts(self):
-        """\
-        Recalculate secondary header location in primary then make a copy of the primary gpt header
-        and update necessary fields.
-        """
-
-        # Update LBA of other header copy in primary header (LE) (the final sector should contain the backup header)
-        secondaryLBAAddress = (self.diskSize() // GPT_SECTOR_SIZE) - 1
-        self._ptpri[0x20:0x20+8] = self._lebytes(secondaryLBAAddress, 8)
-
-        # Blank CRC bytes ready to recalculate them
-        self._ptpri[0x10:0x10+4] = self._lebytes(0, 4)
-
-        # generate pte bytes
-        start_sector = 2048 # assuming 512 byte sectors, need to adjust for 4096
-        for pte in range(GPT_PTE_ENTS):
-            (sizemb, filesystem, name) = self._partitions[pte]
-            offset = pte * GPT_PTE_SIZE
-            if sizemb:
-                # partition type guid
-                self._ptes[offset:offset+16] = partitionType.resolveGPTCode(filesystem).bytes_le
-                # unique partition uid
-                self._ptes[offset+0x10:offset+0x10+16] = uuid.uuid4().bytes_le
-                # start lba address (LE)
-                self._ptes[offset+0x20:offset+0x20+8] = self._lebytes(start_sector, 8)
-                # end lba address (inclusive) (LE)
-                pte_sectors = (sizemb * 1048576) // GPT_SECTOR_SIZE
-                self._ptes[offset+0x28:offset+0x28+8] = self._lebytes(start_sector + pte_sectors - 1, 8)
-                # attribute flags
-                # partition name
-                nmenc = name.encode("UTF-16-LE") + b'\0'*72
-                self._ptes[offset+0x38:offset+0x38+72] = nmenc[:72]
-
-                # work out next starting point
-                start_sector += pte_sectors
-
-        # generate pte crc32 and copy into header
-        self._ptpri[0x58:0x58+4] = self._lebytes(crc32(self._ptes), 4)
-
-        # Copy the primary header to the secondary
-        self._ptsec = self._ptpri[:]
-
-        # in the copy switch the location address around
-        for byte in range(8):
-            self._ptsec[0x18+byte], self._ptsec[0x20+byte] = self._ptsec[0x20+byte], self._ptsec[0x18+byte]
-
-        # in the copy set the location of the secondary pte array
-        disk_sectors = self.diskSize()  // GPT_SECTOR_SIZE
+        # the secondary pte array is immediately before the secondary header in the last sector
+        disk_sectors = self.diskSize() // self._sector_size
         pte_sectors = self._pteSectors()
         pte_sec_lba = disk_sectors - (pte_sectors + 1)
-        self._ptsec[0x48:0x48+8] = self._lebytes(pte_sec_lba, 8)
+        pte_crc = crc32(ptes)
+
+        def header(this_lba, other_lba, pte_lba):
+            fields = [b"EFI PART", 0x00010000, self._HEADER.size, 0, 0, this_lba, other_lba,
+                2 + pte_sectors, pte_sec_lba - 1, self._guid.bytes_le, pte_lba, GPT_PTE_ENTS, GPT_PTE_SIZE, pte_crc]
+            fields[3] = crc32(self._HEADER.pack(*fields))
+            hdr = bytearray(self._sector_size)
+            self._HEADER.pack_into(hdr, 0, *fields)
+            return(hdr)
 
-        # insert last usable lba address
-        self._ptpri[0x30:0x30+8] = self._lebytes(pte_sec_lba-1, 8)
-        self._ptsec[0x30:0x30+8] = self._lebytes(pte_sec_lba-1, 8)
+        ptpri = header(1, disk_sectors - 1, 2)
+        ptsec = header(disk_sectors - 1, 1, pte_sec_lba)
 
-        # calculate crcs and sub in
-        pri_crc = crc32(self._ptpri[:0x5c])
-        sec_crc = crc32(self._ptsec[:0x5c])
-        for byte in range(4):
-            self._ptpri[0x10+byte] = (pri_crc >> (byte * 8)) & 0xff
-            self._ptsec[0x10+byte] = (sec_crc >> (byte * 8)) & 0xff
+        self._tables = (ptpri, ptes, ptsec)
+        return(self._tables)
 
 
     def addPartition(self, index, sizemb, fscode, name=None, flags=[]):
-        if index > GPT_PTE_ENTS:
+        if index not in range(1, GPT_PTE_ENTS + 1):
             raise InvalidPartitionNumber("Only configured to support {n} partitions".format(n=GPT_PTE_ENTS))
 
+        entry = partitionType.resolveGPTEntry(fscode)
         if not name:
-            name = partitionType.resolveGPTEntry(fscode)._type
+            name = entry._type
+
+        # the unique guid is kept if the partition is redefined
+        previous = self._entries.get(index, None)
+        if previous:
+            self._allocated -= self._align(previous[0] * 1048576)
+            guid = previous[3]
+        else:
+            guid = self._uuid()
 
-        self._partitions[index-1] = (sizemb, fscode, name)
-        self._updatePts()
+        if sizemb:
+            self._entries[index] = (sizemb, entry._uuid, name, guid)
+            self._allocated += self._align(sizemb * 1048576)
+        elif previous:
+            del(self._entries[index])
+        self._tables = None
 
 
     def write(self, file):
+        (ptpri, ptes, ptsec) = self._buildTables()
+        diskBytes = self.diskSize()
+
         # Generate the protective mbr
-        protective_mbr = mbr()
+        protective_mbr = mbr(sector_size=self._sector_size)
         try:
             # If the disk is too large to be represented by an mbr partition then limit
             # it to the maximum representable size.
-            # -1 to account for the 2048s start position of first pte
-            protective_mbr.addPartition(1, (self.diskSize() // 1048576) - 1, 0xee)
+            # -1 to account for the 1Mb start position of first pte
+            protective_mbr.addPartition(1, (diskBytes // 1048576) - 1, 0xee)
         except PartitionTooLarge:
-            # maximum size that can be represented by (2**32 - 1) sectors: ((2**32 - 1) * 512) / 1024
-            protective_mbr.addPartition(1, 2147483647, 0xee)
+            # maximum size that can be represented by (2**32 - 1) sectors
+            protective_mbr.addPartition(1, ((2**32 - 1) * self._sector_size) // 1048576, 0xee)
         # Zero the mbr disk signature
         protective_mbr._pt[440:440+4] = [0]*4
         # Tickle the chs h value to 255 for partition 1
@@ -629,29 +683,24 @@ class gpt(_partition):
 
         with open(file, "rb+") as fp:
             # write the primary header after the protective mbr at LBA 1
-            fp.seek(GPT_SECTOR_SIZE)
-            fp.write(self._ptpri)
+            fp.seek(self._sector_size)
+            fp.write(ptpri)
             # write the primary copy of the pte array at LBA 2
-            fp.write(self._ptes)
+            fp.write(ptes)
             # write the secondary header at LBA -1
-            fp.seek(self.diskSize() - GPT_SECTOR_SIZE)
-            fp.write(self._ptsec)
+            fp.seek(diskBytes - self._sector_size)
+            fp.write(ptsec)
             # write the secondary copy of the pte array at LBA -n
-            fp.seek(self.diskSize() - ((self._pteSectors() + 1) * GPT_SECTOR_SIZE))
-            fp.write(self._ptes)
+            fp.seek(diskBytes - ((self._pteSectors() + 1) * self._sector_size))
+            fp.write(ptes)
 
 
-    def diskSize(self):
-        # The 0-2047s = 1Mb, gpt copy at end of disk = 1Mb
-        size = 2
-        for (sizemb, filesystem, name) in self._partitions:
-            size += sizemb if sizemb else 0
+    def _sizes(self):
+        return([(index, self._entries[index][0]) for index in sorted(self._entries)])
 
-        if size < 16:
-            diskBytes = 16 * 1048576
-        else:
-            diskBytes = size * 1048576
 
-        self._logger.debug("Disk size is {b} bytes ({s} {size} byte sectors)".format(b=diskBytes, s=(diskBytes // GPT_SECTOR_SIZE), size=GPT_SECTOR_SIZE))
+    def diskSize(self):
+        # The first 1Mb (aligned), gpt copy at end of disk = 1Mb
+        diskBytes = self._firstStart() + self._allocated + 1048576
 
-        return(diskBytes)
+        return(max(diskBytes, 16 * 1048576))
@@ -0,0 +1,52 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}" "$@"
+":"""
+
+"""\
+Time the generation of many multi-partition guid partition tables.
+
+    partition_bench.py [tables] [partitions]
+"""
+
+import sys
+import time
+
+from vmconstruct.disks.partition import gpt
+
+
+def bench(tables, partitions):
+    """\
+    Build tables partition tables with partitions entries each and return
+    the seconds taken to add the partitions and to build the binary tables.
+    """
+    added = built = 0
+    for t in range(tables):
+        start = time.perf_counter()
+        pt = gpt(seed=t)
+        for index in range(1, partitions + 1):
+            pt.addPartition(index, 16 * index, "linux/filesystem", "part{i}".format(i=index))
+        middle = time.perf_counter()
+        pt._buildTables()
+        end = time.perf_counter()
+
+        added += middle - start
+        built += end - middle
+
+    return((added, built))
+
+
+
+if __name__ == "__main__":
+    tables = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    partitions = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    (added, built) = bench(tables, partitions)
+    print("{t} tables of {p} partitions: add {a:.3f}s, build {b:.3f}s, {r:.0f} tables/s".format(
+        t=tables, p=partitions, a=added, b=built, r=tables / (added + built)))
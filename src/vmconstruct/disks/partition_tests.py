@@ -12,10 +12,15 @@ PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
 LOG_LEVEL = "DEBUG"
 
 import logging
+import os
+import struct
+import tempfile
 import unittest
+import uuid
+from binascii import crc32
 from random import choice
 
-from vmconstruct.disks.partition import gpt, mbr, PartitionTooLarge, InvalidPartitionNumber
+from vmconstruct.disks.partition import gpt, mbr, partitionType, PartitionTooLarge, InvalidPartitionNumber, InvalidGeometry
 
 
 def suite():
@@ -26,11 +31,22 @@ def suite():
     partitionTS.addTest(PartitionUT("mbr_13part"))
     partitionTS.addTest(PartitionUT("mbr_toolarge"))
     partitionTS.addTest(PartitionUT("mbr_toooffset"))
+    partitionTS.addTest(PartitionUT("mbr_fscode"))
+    partitionTS.addTest(PartitionUT("mbr_4k"))
 
     partitionTS.addTest(PartitionUT("gpt_empty"))
     partitionTS.addTest(PartitionUT("gpt_1part"))
     partitionTS.addTest(PartitionUT("gpt_nparts"))
     partitionTS.addTest(PartitionUT("gpt_badpart"))
+    partitionTS.addTest(PartitionUT("gpt_guids"))
+    partitionTS.addTest(PartitionUT("gpt_seed"))
+    partitionTS.addTest(PartitionUT("gpt_layout"))
+    partitionTS.addTest(PartitionUT("gpt_4k"))
+    partitionTS.addTest(PartitionUT("gpt_aligned"))
+    partitionTS.addTest(PartitionUT("geometry_invalid"))
+
+    partitionTS.addTest(PartitionUT("types_resolve"))
+    partitionTS.addTest(PartitionUT("types_unknown"))
 
     return(partitionTS)
 
@@ -108,6 +124,30 @@ class PartitionUT(unittest.TestCase):
         self.assertRaises(PartitionTooLarge, pt.addPartition, 3, 64*1024, 0x83)
 
 
+    def mbr_fscode(self):
+        self.logger.info("Testing mbr partition types given by name")
+
+        pt = mbr()
+        pt.addPartition(1, 8, "ext4")
+        pt.addPartition(2, 8, "swap")
+        pt.addPartition(3, 8, 0x0c)
+        self.assertEqual([pt._pt[446 + 4], pt._pt[462 + 4], pt._pt[478 + 4]], [0x83, 0x82, 0x0c])
+        self.assertRaises(Exception, pt.addPartition, 4, 8, "esp-nonexistent")
+
+
+    def mbr_4k(self):
+        self.logger.info("Testing a mbr partition table with 4096 byte sectors")
+
+        pt = mbr(sector_size=4096)
+        pt.addPartition(1, 8, "ext4")
+        pt.addPartition(2, 16, "ext4")
+        self.assertEqual(struct.unpack("<II", pt._pt[446+8:446+16]), (256, 2048))
+        self.assertEqual(struct.unpack("<II", pt._pt[462+8:462+16]), (256 + 2048, 4096))
+        self.assertEqual(pt.diskSize(), 25 * 1048576)
+        # the limit of 2^32-1 sectors is 16Tb with 4096 byte sectors
+        pt.addPartition(3, 3*1024*1024, 0x83)
+
+
     def gpt_empty(self):
         pt = gpt()
 
@@ -143,7 +183,7 @@ class PartitionUT(unittest.TestCase):
         testfile = "/tmp/gpt_nparts.img"
 
         pt = gpt()
-        for x in range(choice(range(1, 129))):
+        for x in range(1, choice(range(1, 129)) + 1):
             pt.addPartition(x, 16, "linux/filesystem", "a test name")
         pt.makeDisk(testfile)
 
@@ -159,11 +199,184 @@ class PartitionUT(unittest.TestCase):
 
         pt = gpt()
         self.assertRaises(InvalidPartitionNumber, pt.addPartition, 129, 512, "linux/filesystem", "a test name")
+        self.assertRaises(InvalidPartitionNumber, pt.addPartition, 0, 512, "linux/filesystem", "a test name")
         pt.makeDisk(testfile)
 
         self.logger.info("Review the result with another paritioning tool to confirm the result")
 
 
+    def _gptRead(self, testfile, ss=512):
+        """\
+        Return the primary header fields, the secondary header fields and
+        the raw pte array of a gpt disk.
+        """
+        with open(testfile, "rb") as fp:
+            fp.seek(ss)
+            primary = list(struct.unpack("<8sIIIIQQQQ16sQIII", fp.read(92)))
+            fp.seek(primary[10] * ss)
+            ptes = fp.read(primary[11] * primary[12])
+            fp.seek(primary[6] * ss)
+            secondary = list(struct.unpack("<8sIIIIQQQQ16sQIII", fp.read(92)))
+
+        return(primary, secondary, ptes)
+
+
+    def _gptGuids(self, testfile):
+        (primary, secondary, ptes) = self._gptRead(testfile)
+        return([uuid.UUID(bytes_le=ptes[x*128+16:x*128+32]) for x in range(primary[11]) if any(ptes[x*128:x*128+16])])
+
+
+    def gpt_guids(self):
+        self.logger.info("Partition guids do not change when another partition is added")
+
+        testfile = tempfile.mktemp()
+        try:
+            pt = gpt()
+            pt.addPartition(1, 8, "esp")
+            pt.addPartition(2, 16, "linux/filesystem")
+            pt.makeDisk(testfile)
+            before = self._gptGuids(testfile)
+
+            pt.addPartition(3, 16, "linux/swap")
+            pt.makeDisk(testfile)
+            after = self._gptGuids(testfile)
+
+            self.assertEqual(len(before), 2)
+            self.assertEqual(after[:2], before)
+            self.assertEqual(len(set(after)), 3)
+        finally:
+            os.unlink(testfile)
+
+
+    def gpt_seed(self):
+        self.logger.info("A seeded table is the same each time it is generated")
+
+        tables = []
+        for x in range(3):
+            pt = gpt(seed=x // 2)
+            pt.addPartition(1, 8, "esp")
+            pt.addPartition(2, 16, "linux/filesystem")
+            tables.append(pt._buildTables())
+
+        self.assertEqual(tables[0], tables[1])
+        self.assertNotEqual(tables[1], tables[2])
+
+
+    def gpt_layout(self):
+        self.logger.info("The headers, crcs and entries are consistent")
+
+        testfile = tempfile.mktemp()
+        try:
+            pt = gpt()
+            pt.addPartition(2, 16, "linux/filesystem", "root")
+            pt.addPartition(1, 8, "esp")
+            pt.makeDisk(testfile)
+            (primary, secondary, ptes) = self._gptRead(testfile)
+        finally:
+            os.unlink(testfile)
+
+        size = pt.diskSize()
+        self.assertEqual(size, 26 * 1048576)
+        self.assertEqual(primary[0], b"EFI PART")
+        for hdr in [primary, secondary]:
+            crc = hdr[3]
+            hdr[3] = 0
+            self.assertEqual(crc32(struct.pack("<8sIIIIQQQQ16sQIII", *hdr)), crc)
+            self.assertEqual(hdr[13], crc32(ptes))
+        self.assertEqual((primary[5], primary[6]), (1, size // 512 - 1))
+        self.assertEqual((secondary[5], secondary[6]), (size // 512 - 1, 1))
+        self.assertEqual(secondary[10], size // 512 - 33)
+        self.assertEqual(primary[7:10], secondary[7:10])
+
+        (esp_start, esp_end) = struct.unpack("<QQ", ptes[32:48])
+        (root_start, root_end) = struct.unpack("<QQ", ptes[128+32:128+48])
+        self.assertEqual((esp_start, esp_end), (2048, 2048 + 8 * 2048 - 1))
+        self.assertEqual((root_start, root_end), (esp_end + 1, esp_end + 16 * 2048))
+        self.assertEqual(ptes[128+56:128+64].decode("UTF-16-LE"), "root")
+        self.assertEqual(pt.extents(), {1: (2048 * 512, 8 * 1048576), 2: ((2048 + 8 * 2048) * 512, 16 * 1048576)})
+
+
+
+    def gpt_4k(self):
+        self.logger.info("Testing a guid partition table with 4096 byte sectors")
+
+        testfile = tempfile.mktemp()
+        try:
+            pt = gpt(sector_size=4096)
+            pt.addPartition(1, 8, "esp")
+            pt.makeDisk(testfile)
+            (primary, secondary, ptes) = self._gptRead(testfile, 4096)
+            with open(testfile, "rb") as fp:
+                fp.seek(446)
+                protective = struct.unpack("<B3sB3sII", fp.read(16))
+        finally:
+            os.unlink(testfile)
+
+        size = pt.diskSize()
+        self.assertEqual(primary[0], b"EFI PART")
+        self.assertEqual((primary[5], primary[6]), (1, size // 4096 - 1))
+        # 16384 bytes of ptes is 4 sectors
+        self.assertEqual((primary[7], primary[10]), (6, 2))
+        self.assertEqual(secondary[10], size // 4096 - 5)
+        self.assertEqual(struct.unpack("<QQ", ptes[32:48]), (256, 256 + 2048 - 1))
+        self.assertEqual((protective[2], protective[4]), (0xee, 1))
+
+
+    def gpt_aligned(self):
+        self.logger.info("Testing partitions aligned to a 3Mb raid stripe")
+
+        pt = gpt(alignment=3 * 1048576)
+        pt.addPartition(1, 8, "esp")
+        pt.addPartition(2, 16, "linux/filesystem")
+        pt.addPartition(2, 20, "linux/filesystem")
+        extents = pt.extents()
+        self.assertEqual(extents, {1: (3 * 1048576, 9 * 1048576), 2: (12 * 1048576, 21 * 1048576)})
+        self.assertEqual(pt.diskSize(), 34 * 1048576)
+        for (offset, length) in extents.values():
+            self.assertEqual(offset % (3 * 1048576), 0)
+            self.assertEqual(length % (3 * 1048576), 0)
+
+
+    def geometry_invalid(self):
+        self.logger.info("Unsupported sector sizes and alignments are rejected")
+
+        self.assertRaises(InvalidGeometry, gpt, sector_size=1024)
+        self.assertRaises(InvalidGeometry, mbr, sector_size=520)
+        self.assertRaises(InvalidGeometry, gpt, sector_size=4096, alignment=512)
+        self.assertRaises(InvalidGeometry, gpt, alignment=1000)
+        self.assertRaises(InvalidGeometry, gpt, alignment=0)
+
+
+    def types_resolve(self):
+        self.logger.info("Partition types resolve by every kind of code")
+
+        esp = partitionType.resolveGPTEntry("esp")
+        self.assertEqual(str(esp._uuid), "c12a7328-f81f-11d2-ba4b-00a0c93ec93b")
+        self.assertIs(partitionType.resolveGPTEntry(0xef00), esp)
+        self.assertIs(partitionType.resolveGPTEntry("C12A7328-F81F-11D2-BA4B-00A0C93EC93B"), esp)
+        self.assertIs(partitionType.resolveGPTEntry("ext4"), partitionType.resolveGPTEntry("linux/filesystem"))
+        self.assertIs(partitionType.resolveGPTEntry(0x83), partitionType.resolveGPTEntry(0x8300))
+        # 0xbf01 is registered for Apple ZFS and then Solaris /usr
+        self.assertEqual(partitionType.resolveGPTEntry(0xbf01)._code, "solaris//usr")
+
+        self.assertEqual(partitionType.resolveMBRCode("linux/filesystem"), 0x83)
+        self.assertEqual(partitionType.resolveMBRCode("swap"), 0x82)
+        self.assertEqual(partitionType.resolveMBRCode(0xee), 0xee)
+        self.assertEqual(partitionType.resolveMBRCode(0x8e00), 0x8e)
+
+
+    def types_unknown(self):
+        self.logger.info("Unknown partition types")
+
+        other = partitionType.resolveGPTEntry("01234567-89ab-cdef-0123-456789abcdef")
+        self.assertEqual(str(other._uuid), "01234567-89ab-cdef-0123-456789abcdef")
+        self.assertIsNot(partitionType.resolveGPTEntry("01234567-89ab-cdef-0123-456789abcdef"), other)
+        self.assertRaises(Exception, partitionType.resolveGPTEntry, "linux/unknown")
+        self.assertRaises(Exception, partitionType.resolveGPTEntry, 0x1234)
+        # the linux reserved type has no mbr equivalent
+        self.assertRaises(Exception, partitionType.resolveMBRCode, "linux/reserved")
+
+
 
 if __name__ == "__main__":
     logger = logging.getLogger()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.probe
+    :platform: Unix
+    :synopsis: vmconstruct filesystem superblock probe
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Identify the filesystem on a device or image by reading its superblock
+in-process instead of running blkid for every partition.  The result has
+the TYPE, UUID and LABEL keys of `blkid -o export` with the same value
+formats.  Only the filesystems vmconstruct creates are recognised, blkid
+is used for anything else.
+"""
+
+import logging
+import struct
+import subprocess
+import uuid
+
+
+_logger = logging.getLogger(__name__)
+
+# Bytes read from the start of the device, enough for the btrfs superblock
+PROBE_BYTES = 0x10000 + 4096
+
+# ext2/3/4 feature flags which decide the type reported, as blkid does a
+# feature ext3 does not support makes it ext4
+_EXT3_COMPAT = 0x0004			# has_journal
+_EXT3_INCOMPAT = 0x0002 | 0x0004 | 0x0010	# filetype, recover, meta_bg
+_EXT3_RO_COMPAT = 0x0001 | 0x0002 | 0x0004	# sparse_super, large_file, btree_dir
+
+
+def _label(raw):
+    return(raw.split(b"\0", 1)[0].decode("UTF-8", errors="replace"))
+
+
+def _ext(sb):
+    if len(sb) < 0x500 or sb[0x438:0x43a] != b"\x53\xef":
+        return(None)
+
+    (compat, incompat, ro_compat) = struct.unpack_from("<III", sb, 0x45c)
+    if incompat & ~_EXT3_INCOMPAT or ro_compat & ~_EXT3_RO_COMPAT:
+        fstype = "ext4"
+    elif compat & _EXT3_COMPAT:
+        fstype = "ext3"
+    else:
+        fstype = "ext2"
+
+    return({"TYPE": fstype, "UUID": str(uuid.UUID(bytes=sb[0x468:0x478])), "LABEL": _label(sb[0x478:0x488])})
+
+
+def _btrfs(sb):
+    if len(sb) < 0x10000 + 0x22b or sb[0x10040:0x10048] != b"_BHRfS_M":
+        return(None)
+
+    return({"TYPE": "btrfs", "UUID": str(uuid.UUID(bytes=sb[0x10020:0x10030])), "LABEL": _label(sb[0x1012b:0x1022b])})
+
+
+def _xfs(sb):
+    if sb[0:4] != b"XFSB":
+        return(None)
+
+    return({"TYPE": "xfs", "UUID": str(uuid.UUID(bytes=sb[32:48])), "LABEL": _label(sb[108:120])})
+
+
+def _swap(sb):
+    # The signature is at the end of the first page
+    for pagesize in [4096, 8192, 16384, 65536]:
+        if sb[pagesize - 10:pagesize] in [b"SWAPSPACE2", b"SWAP-SPACE"]:
+            return({"TYPE": "swap", "UUID": str(uuid.UUID(bytes=sb[1036:1052])), "LABEL": _label(sb[1052:1068])})
+
+    return(None)
+
+
+def _vfat(sb):
+    if sb[510:512] != b"\x55\xaa" or struct.unpack_from("<H", sb, 0x0b)[0] not in [512, 1024, 2048, 4096]:
+        return(None)
+
+    if sb[0x52:0x57] == b"FAT32":
+        (volid, label) = (struct.unpack_from("<I", sb, 0x43)[0], sb[0x47:0x52])
+    elif sb[0x36:0x39] == b"FAT":
+        (volid, label) = (struct.unpack_from("<I", sb, 0x27)[0], sb[0x2b:0x36])
+    else:
+        return(None)
+
+    label = label.decode("ascii", errors="replace").rstrip()
+    return({"TYPE": "vfat", "UUID": "{h:04X}-{l:04X}".format(h=volid >> 16, l=volid & 0xffff), "LABEL": "" if label == "NO NAME" else label})
+
+
+def superblock(data):
+    """\
+    Identify the filesystem from the first PROBE_BYTES of the device.
+
+    :returns: A dictionary of TYPE, UUID and LABEL or None if the
+              filesystem is not recognised.
+    """
+    # vfat last, its boot sector signature is the same as a mbr
+    for fs in [_ext, _btrfs, _xfs, _swap, _vfat]:
+        found = fs(data)
+        if found:
+            if not found["LABEL"]:
+                del(found["LABEL"])
+            return(found)
+
+    return(None)
+
+
+def blkid(path, offset=0):
+    """\
+    Identify the filesystem on path with blkid.
+    """
+    cmd = ["blkid", "-p", "-O", str(offset), "-o", "export", path] if offset else ["blkid", "-o", "export", path]
+    found = {}
+    for line in subprocess.check_output(cmd).decode(encoding="UTF-8").splitlines():
+        (var, val) = line.split("=", 1)
+        found[var] = val
+
+    return(found)
+
+
+def probe(path, offset=0):
+    """\
+    Identify the filesystem on path, a device or an image with the
+    filesystem at offset, falling back to blkid for a filesystem which is
+    not recognised.
+
+    :returns: A dictionary of at least TYPE and UUID.
+    """
+    with open(path, "rb") as fp:
+        fp.seek(offset)
+        found = superblock(fp.read(PROBE_BYTES))
+
+    if found is None:
+        _logger.debug("Unrecognised filesystem on {p} at {o}, using blkid".format(p=path, o=offset))
+        found = blkid(path, offset)
+
+    return(found)
@@ -0,0 +1,189 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import uuid
+
+from vmconstruct.btrfs import directory
+from vmconstruct.disks import disk, probe
+
+
+FSUUID = uuid.UUID("0f2b4e6a-1c3d-4e5f-8a9b-0c1d2e3f4a5b")
+
+
+def suite():
+    probeTS = unittest.TestSuite()
+    probeTS.addTest(ProbeUT("ext"))
+    probeTS.addTest(ProbeUT("btrfs"))
+    probeTS.addTest(ProbeUT("xfs"))
+    probeTS.addTest(ProbeUT("swap"))
+    probeTS.addTest(ProbeUT("vfat"))
+    probeTS.addTest(ProbeUT("unknown"))
+    probeTS.addTest(ProbeUT("offset"))
+    probeTS.addTest(ProbeUT("mkfs"))
+    probeTS.addTest(ProbeUT("fake"))
+
+    return(probeTS)
+
+
+
+class ProbeUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _sb(self, *fields):
+        """\
+        A zeroed device start with the (offset, bytes) fields set.
+        """
+        sb = bytearray(probe.PROBE_BYTES)
+        for (offset, data) in fields:
+            sb[offset:offset+len(data)] = data
+
+        return(bytes(sb))
+
+
+    def ext(self):
+        self.logger.info("The ext type depends on the journal and features")
+
+        fields = [(0x438, b"\x53\xef"), (0x468, FSUUID.bytes), (0x478, b"root")]
+        self.assertEqual(probe.superblock(self._sb(*fields)), {"TYPE": "ext2", "UUID": str(FSUUID), "LABEL": "root"})
+        self.assertEqual(probe.superblock(self._sb(*fields, (0x45c, struct.pack("<I", 0x4))))["TYPE"], "ext3")
+        self.assertEqual(probe.superblock(self._sb(*fields, (0x45c, struct.pack("<II", 0x4, 0x42))))["TYPE"], "ext4")
+
+
+    def btrfs(self):
+        self.logger.info("A btrfs superblock at 64k")
+
+        sb = self._sb((0x10040, b"_BHRfS_M"), (0x10020, FSUUID.bytes), (0x1012b, b"dmukd0 /"))
+        self.assertEqual(probe.superblock(sb), {"TYPE": "btrfs", "UUID": str(FSUUID), "LABEL": "dmukd0 /"})
+
+
+    def xfs(self):
+        self.logger.info("A xfs superblock without a label")
+
+        sb = self._sb((0, b"XFSB"), (32, FSUUID.bytes))
+        self.assertEqual(probe.superblock(sb), {"TYPE": "xfs", "UUID": str(FSUUID)})
+
+
+    def swap(self):
+        self.logger.info("A swap signature at the end of the first page")
+
+        sb = self._sb((4086, b"SWAPSPACE2"), (1036, FSUUID.bytes), (1052, b"swap0"))
+        self.assertEqual(probe.superblock(sb), {"TYPE": "swap", "UUID": str(FSUUID), "LABEL": "swap0"})
+
+
+    def vfat(self):
+        self.logger.info("FAT32 and FAT16 boot sectors")
+
+        common = [(510, b"\x55\xaa"), (0x0b, struct.pack("<H", 512))]
+        fat32 = self._sb(*common, (0x52, b"FAT32   "), (0x43, struct.pack("<I", 0x1234abcd)), (0x47, b"EFI_SYSTEM "))
+        self.assertEqual(probe.superblock(fat32), {"TYPE": "vfat", "UUID": "1234-ABCD", "LABEL": "EFI_SYSTEM"})
+        fat16 = self._sb(*common, (0x36, b"FAT16   "), (0x27, struct.pack("<I", 0xbeef)), (0x2b, b"NO NAME    "))
+        self.assertEqual(probe.superblock(fat16), {"TYPE": "vfat", "UUID": "0000-BEEF"})
+        # a mbr has the same signature
+        self.assertEqual(probe.superblock(self._sb((510, b"\x55\xaa"))), None)
+
+
+    def unknown(self):
+        self.logger.info("An unknown filesystem is passed to blkid")
+
+        self.assertEqual(probe.superblock(self._sb()), None)
+        image = os.path.join(self.tdir, "zero.img")
+        with open(image, "wb") as fp:
+            fp.truncate(1048576)
+        # blkid finds nothing either
+        self.assertRaises(subprocess.CalledProcessError, probe.probe, image)
+
+
+    def offset(self):
+        self.logger.info("A filesystem inside a disk image")
+
+        image = os.path.join(self.tdir, "disk.img")
+        with open(image, "wb") as fp:
+            fp.truncate(4 * 1048576)
+            fp.seek(1048576)
+            fp.write(self._sb((0, b"XFSB"), (32, FSUUID.bytes), (108, b"boot")))
+        self.assertEqual(probe.probe(image, 1048576), {"TYPE": "xfs", "UUID": str(FSUUID), "LABEL": "boot"})
+
+
+    def mkfs(self):
+        self.logger.info("The probe agrees with blkid for filesystems mkfs creates")
+
+        made = 0
+        for (fs, cmd) in [("ext2", ["mkfs.ext2", "-q", "-L", "l"]), ("ext3", ["mkfs.ext3", "-q"]), ("ext4", ["mkfs.ext4", "-q", "-L", "root"]),
+                          ("btrfs", ["mkfs.btrfs", "-q", "-L", "root"]), ("xfs", ["mkfs.xfs", "-q"]), ("swap", ["mkswap", "-L", "swap"]),
+                          ("vfat", ["mkfs.vfat", "-F", "32", "-n", "EFI_SYSTEM"])]:
+            if not shutil.which(cmd[0]):
+                continue
+            image = os.path.join(self.tdir, fs+".img")
+            with open(image, "wb") as fp:
+                fp.truncate(320 * 1048576)
+            subprocess.check_call(cmd + [image], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            with open(image, "rb") as fp:
+                found = probe.superblock(fp.read(probe.PROBE_BYTES))
+            expected = probe.blkid(image)
+            self.assertEqual(found, dict([(k, expected[k]) for k in ["TYPE", "UUID", "LABEL"] if k in expected]))
+            made += 1
+
+        if not made:
+            self.skipTest("no mkfs commands are available")
+
+
+    def fake(self):
+        self.logger.info("A fake disk formatted in parallel gets one new UUID per partition")
+
+        partitions = dict([(k, {"size": 8, "filesystem": fs}) for (k, fs) in enumerate(["esp", "ext4", "ext4", "xfs", "swap", "btrfs"], 1)])
+        d = disk(directory(self.tdir), "xvda", {"mapper": "fake", "partitions": partitions})
+        d.assignUUIDs()
+        before = dict([(k, p.flags["UUID"]) for (k, p) in d.partitions()])
+
+        with self.assertLogs("vmconstruct.disks", level="DEBUG") as cm:
+            d.format(workers=6)
+        self.assertEqual([r for r in cm.records if r.levelno >= logging.ERROR], [])
+
+        after = dict([(k, p.flags["UUID"]) for (k, p) in d.partitions()])
+        self.assertEqual(sorted(after), sorted(before))
+        self.assertEqual(len(set(after.values())), len(after))
+        self.assertFalse(set(after.values()) & set(before.values()))
+        self.assertRegex(after[1], "^[0-9A-F]{4}-[0-9A-F]{4}$")
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.reader
+    :platform: Unix
+    :synopsis: vmconstruct partition table reader and verifier
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Read the mbr or guid partition table of a disk image without mapping it
+with the kernel and verify it.  Only the table sectors are read so even
+a multi-Tb sparse image is checked in a few small reads and no root
+privileges are needed.
+"""
+
+import logging
+import os
+import struct
+import uuid
+from binascii import crc32
+
+from . import partition
+
+
+# The fields of a mbr partition entry: bootable flag, chs start, type,
+# chs end, start lba, number of sectors
+_MBR_PTE = struct.Struct("<B3sB3sII")
+_MBR_EXTENDED = [0x05, 0x0f, 0x85]
+
+
+
+class InvalidPartitionTable(Exception):
+    """\
+    Raise if an image does not contain a partition table that can be read.
+    """
+    pass
+
+
+
+class reader(object):
+    """\
+    The partition table of a disk image.
+
+    After construction these attributes describe the table:
+
+        label: "mbr" or "gpt"
+        sector_size: the logical sector size the table was found with
+        size: the size of the image in bytes
+        guid: the gpt disk guid or the mbr disk signature
+        partitions: a dictionary of index to partition.partition objects,
+                    the size is in Mb and the flags hold the byte offset
+                    and length, the partition uuid and attributes.
+    """
+    def __init__(self, image, sector_size=None):
+        """\
+        The constructor.
+
+        :param image: The disk image to read.
+        :type image: str.
+        :param sector_size: The logical sector size or None to try each of
+                            partition.SECTOR_SIZES for a gpt.
+        :type sector_size: int.
+        :raises: InvalidPartitionTable if there is no mbr boot signature.
+        """
+        self._logger = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        self.image = image
+        self.partitions = {}
+        self.errors = []
+
+        with open(image, "rb") as fp:
+            self.size = os.fstat(fp.fileno()).st_size
+            mbr = self._read(fp, 0, 512)
+            if mbr[510:512] != b"\x55\xaa":
+                raise InvalidPartitionTable("{i} has no mbr boot signature".format(i=image))
+
+            for ss in [sector_size] if sector_size else partition.SECTOR_SIZES:
+                if self._read(fp, ss, 8) == b"EFI PART":
+                    self.label = "gpt"
+                    self.sector_size = ss
+                    self._readGPT(fp, mbr)
+                    break
+            else:
+                self.label = "mbr"
+                self.sector_size = sector_size or partition.MBR_SECTOR_SIZE
+                self._readMBR(mbr)
+
+
+    def _read(self, fp, offset, length):
+        fp.seek(offset)
+        return(fp.read(length))
+
+
+    def _error(self, msg):
+        self._logger.debug("{i}: {m}".format(i=self.image, m=msg))
+        self.errors.append(msg)
+
+
+    def _code(self, code):
+        """\
+        Return our text code for a partition type or the raw type if it is
+        not registered.
+        """
+        try:
+            return(partition.partitionType.resolveGPTEntry(code)._code)
+        except Exception:
+            return(code)
+
+
+    def _add(self, index, start, sectors, code, name, flags):
+        offset = start * self.sector_size
+        length = sectors * self.sector_size
+        flags.update({"offset": offset, "length": length})
+        self.partitions[index] = partition.partition(length // 1048576, self._code(code), None, name, flags)
+
+
+    def _readMBR(self, mbr):
+        self.guid = mbr[440:444].hex()
+        for index in range(0, 4):
+            (bootable, _, code, _, start, sectors) = _MBR_PTE.unpack_from(mbr, 446 + index * 16)
+            if not code and not sectors:
+                continue
+            if code in _MBR_EXTENDED:
+                self._error("partition {i} is an extended partition, logical partitions are not read".format(i=index + 1))
+            self._add(index + 1, start, sectors, code, None, {"bootable": bootable == 0x80})
+
+
+    def _header(self, fp, lba):
+        """\
+        Read and check the gpt header at lba.
+
+        :returns: A list of the header fields or None if it is not valid.
+        """
+        hdr = self._read(fp, lba * self.sector_size, partition.gpt._HEADER.size)
+        if len(hdr) < partition.gpt._HEADER.size or hdr[:8] != b"EFI PART":
+            self._error("no gpt header at lba {l}".format(l=lba))
+            return(None)
+
+        fields = list(partition.gpt._HEADER.unpack(hdr))
+        crc = fields[3]
+        fields[3] = 0
+        if fields[2] != partition.gpt._HEADER.size:
+            self._error("gpt header at lba {l} has size {s}".format(l=lba, s=fields[2]))
+        elif crc32(partition.gpt._HEADER.pack(*fields)) != crc:
+            self._error("gpt header at lba {l} has a bad crc32".format(l=lba))
+        if fields[5] != lba:
+            self._error("gpt header at lba {l} records its lba as {r}".format(l=lba, r=fields[5]))
+
+        return(fields)
+
+
+    def _ptes(self, fp, hdr, which):
+        if hdr[12] < partition.gpt._PTE.size or hdr[11] * hdr[12] > 1048576:
+            self._error("{w} gpt partition entries of {n} x {s} bytes are not plausible".format(w=which, n=hdr[11], s=hdr[12]))
+            return(b"")
+
+        ptes = self._read(fp, hdr[10] * self.sector_size, hdr[11] * hdr[12])
+        if crc32(ptes) != hdr[13]:
+            self._error("{w} gpt partition entries have a bad crc32".format(w=which))
+
+        return(ptes)
+
+
+    def _readGPT(self, fp, mbr):
+        codes = [_MBR_PTE.unpack_from(mbr, 446 + index * 16)[2] for index in range(0, 4)]
+        if 0xee not in codes:
+            self._error("there is no protective mbr partition")
+
+        primary = self._header(fp, 1)
+        self.guid = str(uuid.UUID(bytes_le=primary[9]))
+        ptes = self._ptes(fp, primary, "primary")
+        self._usable = (primary[7], primary[8])
+
+        last_lba = self.size // self.sector_size - 1
+        if primary[6] != last_lba:
+            self._error("the backup gpt header is at lba {b} not the last lba {l}".format(b=primary[6], l=last_lba))
+
+        backup = self._header(fp, primary[6]) if primary[6] * self.sector_size < self.size else None
+        if backup is None:
+            self._error("the backup gpt header is missing")
+        else:
+            if backup[6] != 1:
+                self._error("the backup gpt header records the primary at lba {l}".format(l=backup[6]))
+            # Other than the locations and crc32 the headers are the same
+            for (field, name) in [(7, "first usable lba"), (8, "last usable lba"), (9, "disk guid"), (11, "number of entries"), (12, "entry size"), (13, "entries crc32")]:
+                if primary[field] != backup[field]:
+                    self._error("the primary and backup gpt headers differ in {n}".format(n=name))
+            if self._ptes(fp, backup, "backup") != ptes:
+                self._error("the primary and backup gpt partition entries differ")
+
+        pte = partition.gpt._PTE
+        for index in range(0, primary[11]):
+            entry = ptes[index * primary[12]:index * primary[12] + pte.size]
+            if len(entry) < pte.size or not any(entry[:16]):
+                continue
+            (typeuuid, guid, first, last, attributes, name) = pte.unpack(entry)
+            name = name.decode("UTF-16-LE").split("\0", 1)[0]
+            flags = {"partuuid": str(uuid.UUID(bytes_le=guid)), "attributes": attributes}
+            self._add(index + 1, first, last - first + 1, str(uuid.UUID(bytes_le=typeuuid)), name, flags)
+
+
+    def extents(self):
+        """\
+        Return a dictionary of partition index to (offset, length) in bytes
+        in the same form as partition._partition.extents.
+        """
+        return(dict([(index, (p.flags["offset"], p.flags["length"])) for (index, p) in self.partitions.items()]))
+
+
+    def verify(self, alignment=partition.ALIGNMENT):
+        """\
+        Check the partitions are inside the image, do not overlap and start
+        on the alignment.
+
+        :param alignment: Bytes each partition start must be a multiple of or
+                          None to not check the alignment.
+        :type alignment: int.
+        :returns: The list of problems found reading and checking the table.
+        """
+        errors = list(self.errors)
+
+        if self.label == "gpt":
+            (first, last) = [lba * self.sector_size for lba in self._usable]
+            last += self.sector_size
+        else:
+            (first, last) = (self.sector_size, self.size)
+
+        # the end of the partitions so far and the partition ending last
+        (end, previous) = (0, None)
+        for (offset, length, index) in sorted([(o, l, i) for (i, (o, l)) in self.extents().items()]):
+            if length <= 0:
+                errors.append("partition {i} is empty".format(i=index))
+            if offset < first or offset + length > last:
+                errors.append("partition {i} is outside the usable area".format(i=index))
+            if alignment and offset % alignment:
+                errors.append("partition {i} starting at byte {o} is not aligned to {a}".format(i=index, o=offset, a=alignment))
+            if offset < end:
+                errors.append("partition {i} overlaps partition {p}".format(i=index, p=previous))
+            if offset + length > end:
+                (end, previous) = (offset + length, index)
+
+        return(errors)
@@ -0,0 +1,193 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import tempfile
+import unittest
+
+from vmconstruct.disks.partition import gpt, mbr
+from vmconstruct.disks.reader import reader, InvalidPartitionTable
+
+
+def suite():
+    readerTS = unittest.TestSuite()
+    readerTS.addTest(ReaderUT("gpt_roundtrip"))
+    readerTS.addTest(ReaderUT("gpt_4k"))
+    readerTS.addTest(ReaderUT("gpt_sparse"))
+    readerTS.addTest(ReaderUT("gpt_corrupt"))
+    readerTS.addTest(ReaderUT("gpt_backup"))
+    readerTS.addTest(ReaderUT("mbr_roundtrip"))
+    readerTS.addTest(ReaderUT("mbr_overlap"))
+    readerTS.addTest(ReaderUT("notable"))
+
+    return(readerTS)
+
+
+
+class ReaderUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        (fd, self.image) = tempfile.mkstemp()
+        os.close(fd)
+
+
+    def tearDown(self):
+        os.unlink(self.image)
+
+
+    def _patch(self, offset, data):
+        with open(self.image, "rb+") as fp:
+            fp.seek(offset)
+            fp.write(data)
+
+
+    def gpt_roundtrip(self):
+        self.logger.info("A generated gpt reads back with the same partitions")
+
+        pt = gpt()
+        pt.addPartition(1, 8, "esp", "EFI_SYSTEM")
+        pt.addPartition(3, 16, "linux/filesystem", "root")
+        pt.makeDisk(self.image)
+
+        r = reader(self.image)
+        self.assertEqual((r.label, r.sector_size, r.size), ("gpt", 512, pt.diskSize()))
+        self.assertEqual(r.verify(), [])
+        self.assertEqual(r.extents(), pt.extents())
+        self.assertEqual(sorted(r.partitions), [1, 3])
+        self.assertEqual(r.partitions[1][:4], (8, "esp", None, "EFI_SYSTEM"))
+        self.assertEqual(r.partitions[3].filesystem, "linux/filesystem")
+        self.assertEqual(r.partitions[3].label, "root")
+        self.assertEqual(r.partitions[1].flags["partuuid"], str(pt._entries[1][3]))
+
+
+    def gpt_4k(self):
+        self.logger.info("A 4K sector gpt is found and aligned to a raid stripe")
+
+        pt = gpt(sector_size=4096, alignment=3 * 1048576)
+        pt.addPartition(1, 8, "esp")
+        pt.addPartition(2, 16, "linux/filesystem")
+        pt.makeDisk(self.image)
+
+        r = reader(self.image)
+        self.assertEqual((r.label, r.sector_size), ("gpt", 4096))
+        self.assertEqual(r.extents(), pt.extents())
+        self.assertEqual(r.verify(alignment=3 * 1048576), [])
+
+
+    def gpt_sparse(self):
+        self.logger.info("A 4Tb sparse image is read without reading the partition data")
+
+        pt = gpt()
+        pt.addPartition(1, 4 * 1024 * 1024, "linux/filesystem")
+        pt.makeDisk(self.image)
+        self.assertLess(os.stat(self.image).st_blocks * 512, 1048576)
+
+        r = reader(self.image)
+        self.assertEqual(r.verify(), [])
+        self.assertEqual(r.partitions[1].size, 4 * 1024 * 1024)
+
+
+    def gpt_corrupt(self):
+        self.logger.info("Damaged gpt headers and entries are reported")
+
+        pt = gpt()
+        pt.addPartition(1, 8, "esp")
+        pt.makeDisk(self.image)
+
+        # a byte of the primary partition name and of the backup header guid
+        self._patch(2 * 512 + 0x38, b"X")
+        self._patch(pt.diskSize() - 512 + 0x38, b"X")
+        errors = reader(self.image).verify()
+        self.assertTrue("primary gpt partition entries have a bad crc32" in errors)
+        self.assertTrue("the primary and backup gpt partition entries differ" in errors)
+        self.assertTrue("gpt header at lba {l} has a bad crc32".format(l=pt.diskSize() // 512 - 1) in errors)
+        self.assertTrue("the primary and backup gpt headers differ in disk guid" in errors)
+
+
+    def gpt_backup(self):
+        self.logger.info("An image which has grown is missing the backup header at its end")
+
+        pt = gpt()
+        pt.addPartition(1, 8, "esp")
+        pt.makeDisk(self.image)
+        with open(self.image, "ab") as fp:
+            fp.truncate(pt.diskSize() + 1048576)
+
+        errors = reader(self.image).verify()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith("the backup gpt header is at lba"))
+
+
+    def mbr_roundtrip(self):
+        self.logger.info("A generated mbr reads back with the same partitions")
+
+        pt = mbr()
+        pt.addPartition(1, 8, "ext4", flags=["bootable"])
+        pt.addPartition(2, 16, "swap")
+        pt.makeDisk(self.image)
+
+        r = reader(self.image)
+        self.assertEqual(r.label, "mbr")
+        self.assertEqual(r.verify(), [])
+        self.assertEqual(r.extents(), pt.extents())
+        self.assertEqual(r.partitions[1].filesystem, "linux/filesystem")
+        self.assertEqual(r.partitions[2].filesystem, "linux/swap")
+        self.assertTrue(r.partitions[1].flags["bootable"])
+        self.assertFalse(r.partitions[2].flags["bootable"])
+
+
+    def mbr_overlap(self):
+        self.logger.info("Overlapping, misaligned and oversized partitions are reported")
+
+        pt = mbr()
+        pt.addPartition(1, 8, "ext4")
+        pt.addPartition(2, 8, "ext4")
+        pt.addPartition(3, 8, "ext4")
+        pt.makeDisk(self.image)
+        # move partition 2 back into partition 1 and extend partition 3 beyond the image
+        self._patch(446 + 16 + 8, (2048 + 8 * 2048 - 1).to_bytes(4, "little"))
+        self._patch(446 + 32 + 12, (16 * 2048).to_bytes(4, "little"))
+
+        errors = reader(self.image).verify()
+        self.assertEqual(sorted(errors), [
+            "partition 2 overlaps partition 1",
+            "partition 2 starting at byte {o} is not aligned to 1048576".format(o=(2048 + 8 * 2048 - 1) * 512),
+            "partition 3 is outside the usable area"
+        ])
+
+
+    def notable(self):
+        self.logger.info("An image without a partition table cannot be read")
+
+        with open(self.image, "wb") as fp:
+            fp.truncate(1048576)
+        self.assertRaises(InvalidPartitionTable, reader, self.image)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
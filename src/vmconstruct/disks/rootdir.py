@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.rootdir
+    :platform: Unix
+    :synopsis: Loop free filesystem image construction
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Build the filesystem for a partition as a standalone image file directly
+from a directory tree and then place it at the partition offset in the
+disk image.  No loop devices, device-mapper nodes or mounts are needed.
+"""
+
+import logging
+import os
+import subprocess
+
+from .. import helpers
+
+
+_logger = logging.getLogger(__name__)
+
+
+def mkfs(image, filesystem, sizemb, rootdir=None, fsuuid=None):
+    """\
+    Create image as a sparse file of sizemb and build a filesystem in it
+    populated from rootdir.
+
+    :param image: The path of the filesystem image file to create.
+    :type image: str.
+    :param filesystem: The filesystem as given in the disk definition.
+    :type filesystem: str.
+    :param sizemb: The size of the filesystem in Mb.
+    :type sizemb: int.
+    :param rootdir: A directory with the content for the filesystem or None
+                    for an empty filesystem.
+    :type rootdir: str.
+    :param fsuuid: The filesystem UUID as it will appear in fstab.
+    :type fsuuid: str.
+    """
+    with open(image, "ab") as fp:
+        fp.truncate(0)
+        fp.truncate(sizemb * 1048576)
+
+    env = None
+    post = []
+    if filesystem == "esp":
+        cmd = ["mkfs", "-t", "vfat", "-n", "EFI_SYSTEM", "-F", "32"]
+        if fsuuid:
+            cmd += ["-i", fsuuid.replace("-", "")]
+        cmd += [image]
+        if rootdir and os.listdir(rootdir):
+            env = dict(os.environ, MTOOLS_SKIP_CHECK="1")
+            post.append(["mcopy", "-s", "-p", "-m", "-Q", "-i", image] + [os.path.join(rootdir, e) for e in sorted(os.listdir(rootdir))] + ["::/"])
+    elif filesystem == "swap":
+        cmd = ["mkswap", "-f"] + (["-U", fsuuid] if fsuuid else []) + [image]
+    elif filesystem in ["ext2", "ext3", "ext4"]:
+        cmd = ["mkfs", "-t", filesystem, "-F"] + (["-U", fsuuid] if fsuuid else []) + (["-d", rootdir] if rootdir else []) + [image]
+    elif filesystem == "btrfs":
+        cmd = ["mkfs.btrfs", "-f"] + (["-U", fsuuid] if fsuuid else []) + (["--rootdir", rootdir] if rootdir else []) + [image]
+    else:
+        raise Exception("Filesystem {fs} cannot be built from a directory".format(fs=filesystem))
+
+    for c in [cmd] + post:
+        _logger.debug("Building filesystem image: {cmd}".format(cmd=c))
+        subprocess.check_call(c, env=env)
+
+
+def place(image, diskimage, offset):
+    """\
+    Copy the filesystem image into the disk image at the partition offset.
+    """
+    _logger.debug("Placing {i} in {d} at offset {o}".format(i=image, d=diskimage, o=offset))
+    helpers.copyrange(image, diskimage, offset)
@@ -0,0 +1,150 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from vmconstruct import helpers
+from vmconstruct.disks import rootdir
+from vmconstruct.disks.partition import gpt
+from vmconstruct.disks.reader import reader
+
+
+def suite():
+    rootdirTS = unittest.TestSuite()
+    rootdirTS.addTest(RootdirUT("datasegments"))
+    rootdirTS.addTest(RootdirUT("datasegments_empty"))
+    rootdirTS.addTest(RootdirUT("copyrange"))
+    rootdirTS.addTest(RootdirUT("place"))
+
+    return(rootdirTS)
+
+
+
+class RootdirUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.data = os.urandom(65536)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _sparse(self, name, size, regions):
+        """\
+        Create a sparse file of size with self.data written at each offset
+        in regions.
+        """
+        path = os.path.join(self.tdir, name)
+        with open(path, "wb") as fp:
+            fp.truncate(size)
+            for offset in regions:
+                fp.seek(offset)
+                fp.write(self.data)
+
+        return(path)
+
+
+    def _allocated(self, path):
+        return(os.stat(path).st_blocks * 512)
+
+
+    def datasegments(self):
+        self.logger.info("Only the data regions of a sparse file are found")
+
+        path = self._sparse("fs.img", 8 * 1048576, [1048576, 6 * 1048576])
+        with open(path, "rb") as fp:
+            segments = list(helpers.datasegments(fp.fileno()))
+
+        if len(segments) == 1 and segments[0] == (0, 8 * 1048576):
+            self.skipTest("the filesystem of {t} does not report holes".format(t=self.tdir))
+        self.assertEqual(len(segments), 2)
+        for ((start, length), offset) in zip(segments, [1048576, 6 * 1048576]):
+            # The filesystem reports whole blocks around the data
+            self.assertLessEqual(start, offset)
+            self.assertGreaterEqual(start + length, offset + len(self.data))
+
+
+    def datasegments_empty(self):
+        self.logger.info("A file which is all hole has no data regions")
+
+        path = self._sparse("fs.img", 8 * 1048576, [])
+        with open(path, "rb") as fp:
+            self.assertEqual(list(helpers.datasegments(fp.fileno())), [])
+
+
+    def copyrange(self):
+        self.logger.info("The data of a sparse file is copied at an offset and the holes are kept")
+
+        src = self._sparse("fs.img", 8 * 1048576, [0, 5 * 1048576])
+        dst = self._sparse("disk.img", 16 * 1048576, [])
+        helpers.copyrange(src, dst, 2 * 1048576)
+
+        with open(dst, "rb") as fp:
+            self.assertEqual(fp.read(2 * 1048576), bytes(2 * 1048576))
+            self.assertEqual(fp.read(len(self.data)), self.data)
+            fp.seek(7 * 1048576)
+            self.assertEqual(fp.read(len(self.data)), self.data)
+            self.assertEqual(fp.read(), bytes(16 * 1048576 - 7 * 1048576 - len(self.data)))
+        self.assertEqual(os.path.getsize(dst), 16 * 1048576)
+        self.assertLess(self._allocated(dst), 4 * 1048576)
+
+
+    def place(self):
+        self.logger.info("A filesystem image placed in a partition keeps the partition table intact")
+
+        pt = gpt()
+        pt.addPartition(1, 8, "esp", "EFI_SYSTEM")
+        pt.addPartition(2, 16, "linux/filesystem", "root")
+        diskimage = os.path.join(self.tdir, "disk.img")
+        pt.makeDisk(diskimage)
+
+        (offset, length) = pt.extents()[2]
+        image = self._sparse("fs.img", length, [0, length - len(self.data)])
+        rootdir.place(image, diskimage, offset)
+
+        r = reader(diskimage)
+        self.assertEqual(r.verify(), [])
+        self.assertEqual(r.extents(), pt.extents())
+        self.assertEqual(r.size, pt.diskSize())
+        with open(diskimage, "rb") as fp:
+            fp.seek(offset)
+            self.assertEqual(fp.read(len(self.data)), self.data)
+            self.assertEqual(fp.read(length - 2 * len(self.data)), bytes(length - 2 * len(self.data)))
+            self.assertEqual(fp.read(len(self.data)), self.data)
+            # The partition before is untouched
+            fp.seek(pt.extents()[1][0])
+            self.assertEqual(fp.read(pt.extents()[1][1]), bytes(pt.extents()[1][1]))
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
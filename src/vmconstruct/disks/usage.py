@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""\
+.. module:: vmconstruct.disks.usage
+    :platform: Unix
+    :synopsis: vmconstruct partition sizes from the origin content
+
+.. moduleauthor:: James Dingwall <james@dingwall.me.uk>
+
+Measure how much of the origin tree belongs to each mount point so that
+a partition can be given `size: auto` (just large enough) or
+`size: auto+20%` (with 20% free space) instead of a fixed size in Mb.
+The tree is walked by a pool of threads and files with several hard
+links are only counted once.
+"""
+
+import logging
+import os
+import queue
+import re
+import stat
+import threading
+
+
+_logger = logging.getLogger(__name__)
+
+AUTO_RE = re.compile("^auto(?:\\+([0-9]+)%)?$")
+
+BLOCK = 4096			# allocation unit each file and directory is rounded up to
+INODE = 256			# metadata bytes for each inode
+METADATA = 10			# percentage added for the filesystem metadata, journal and reserve
+# The smallest filesystem mkfs will make in Mb
+MINIMUM = {
+    "btrfs": 128,
+    "xfs": 300,
+    "esp": 33,
+    "vfat": 33
+}
+DEFAULT_MINIMUM = 8
+
+
+def isauto(size):
+    return(isinstance(size, str) and AUTO_RE.match(size) is not None)
+
+
+def usage(root, mounts, workers=8):
+    """\
+    Walk the tree at root and return a dictionary of the bytes used below
+    each of the mount points, which are absolute paths in the tree.  A file
+    belongs to the deepest mount point it is under.  The walk does not
+    cross into other filesystems.
+    """
+    rootdev = os.lstat(root).st_dev
+    mounts = dict([(m.rstrip("/") or "/", m) for m in mounts])
+    totals = dict([(m, 0) for m in mounts.values()])
+    if "/" not in mounts:
+        # Content which is on no mount point is not counted
+        mounts["/"] = None
+
+    seen = set()
+    lock = threading.Lock()
+    dirs = queue.Queue()
+    errors = []
+
+    def walk():
+        while True:
+            item = dirs.get()
+            if item is None:
+                return
+            (path, rel, mount) = item
+            try:
+                used = 0
+                with os.scandir(path) as it:
+                    for entry in it:
+                        st = entry.stat(follow_symlinks=False)
+                        if st.st_dev != rootdev:
+                            continue
+                        if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                            with lock:
+                                if (st.st_dev, st.st_ino) in seen:
+                                    continue
+                                seen.add((st.st_dev, st.st_ino))
+                        used += INODE + -(-st.st_size // BLOCK) * BLOCK
+                        if stat.S_ISDIR(st.st_mode):
+                            erel = rel.rstrip("/") + "/" + entry.name
+                            dirs.put((entry.path, erel, mounts.get(erel, mount)))
+                if mount is not None:
+                    with lock:
+                        totals[mount] += used
+            except Exception as e:
+                errors.append(e)
+            finally:
+                dirs.task_done()
+
+    dirs.put((root, "/", mounts["/"]))
+    threads = [threading.Thread(target=walk, daemon=True) for w in range(workers)]
+    for t in threads:
+        t.start()
+    dirs.join()
+    for t in threads:
+        dirs.put(None)
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+    return(totals)
+
+
+def size(size, used, filesystem):
+    """\
+    Return the partition size in Mb for an auto size, or the size if it is
+    not auto, with used bytes of content.
+    """
+    if not isauto(size):
+        return(size)
+
+    headroom = int(AUTO_RE.match(size).group(1) or 0)
+    sizemb = -(-(used * (100 + METADATA) * (100 + headroom)) // (100 * 100 * 1048576))
+
+    return(max(sizemb, MINIMUM.get(filesystem, DEFAULT_MINIMUM)))
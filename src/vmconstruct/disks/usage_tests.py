@@ -0,0 +1,148 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/../.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from vmconstruct.disks import disks, usage
+
+
+def suite():
+    usageTS = unittest.TestSuite()
+    usageTS.addTest(UsageUT("walk"))
+    usageTS.addTest(UsageUT("hardlinks"))
+    usageTS.addTest(UsageUT("size"))
+    usageTS.addTest(UsageUT("autosize"))
+    usageTS.addTest(UsageUT("autosize_nomount"))
+
+    return(usageTS)
+
+
+
+class UsageUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.origin = os.path.join(self.tdir, "origin")
+        for (path, size) in [("etc/hostname", 10), ("usr/bin/tool", 3 * 4096 + 1), ("boot/vmlinuz", 8192), ("boot/efi/EFI/grubx64.efi", 100)]:
+            os.makedirs(os.path.dirname(os.path.join(self.origin, path)), exist_ok=True)
+            with open(os.path.join(self.origin, path), "wb") as fp:
+                fp.truncate(size)
+        os.symlink("/usr/bin/tool", os.path.join(self.origin, "etc/tool"))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _used(self, *paths):
+        """\
+        The usage of the paths in the origin as the walk counts it.
+        """
+        return(sum([usage.INODE + -(-os.lstat(os.path.join(self.origin, p)).st_size // usage.BLOCK) * usage.BLOCK for p in paths]))
+
+
+    def walk(self):
+        self.logger.info("Each file is counted on the deepest mount point it is under")
+
+        used = usage.usage(self.origin, ["/", "/boot", "/boot/efi"], workers=4)
+        # a mount point directory itself belongs to the filesystem it is in
+        self.assertEqual(used["/boot/efi"], self._used("boot/efi/EFI", "boot/efi/EFI/grubx64.efi"))
+        self.assertEqual(used["/boot"], self._used("boot/vmlinuz", "boot/efi"))
+        self.assertEqual(used["/"], self._used("etc", "etc/hostname", "etc/tool", "usr", "usr/bin", "usr/bin/tool", "boot"))
+
+        # without a mount for / only the mounted subtrees are counted
+        self.assertEqual(usage.usage(self.origin, ["/boot/"]), {"/boot/": used["/boot"] + used["/boot/efi"]})
+
+
+    def hardlinks(self):
+        self.logger.info("A file with several links is counted once")
+
+        before = usage.usage(self.origin, ["/"])["/"]
+        for n in range(10):
+            os.link(os.path.join(self.origin, "usr/bin/tool"), os.path.join(self.origin, "usr/bin/tool{n}".format(n=n)))
+        self.assertEqual(usage.usage(self.origin, ["/"])["/"], before)
+
+
+    def size(self):
+        self.logger.info("Auto sizes add metadata, headroom and respect the minimum")
+
+        self.assertEqual(usage.size(512, 0, "ext4"), 512)
+        self.assertEqual(usage.size("auto", 100 * 1048576, "ext4"), 110)
+        self.assertEqual(usage.size("auto+20%", 100 * 1048576, "ext4"), 132)
+        self.assertEqual(usage.size("auto", 1048576, "ext4"), usage.DEFAULT_MINIMUM)
+        self.assertEqual(usage.size("auto+50%", 1048576, "btrfs"), 128)
+        self.assertFalse(usage.isauto("auto+"))
+        self.assertFalse(usage.isauto(16))
+
+
+    def _disksyml(self):
+        return({
+            "xvda": {"label": "gpt", "partitions": {
+                1: {"mount": "/boot/efi", "size": 33, "filesystem": "esp"},
+                2: {"mount": "/boot", "size": "auto+100%", "filesystem": "ext4"}
+            }},
+            "xvdb": {"label": "gpt", "partitions": {
+                1: {"mount": "/", "size": "auto", "filesystem": "ext4"},
+                2: {"mount": "swap", "size": 16, "filesystem": "swap"}
+            }}
+        })
+
+
+    def autosize(self):
+        self.logger.info("Auto partition sizes are resolved from the origin")
+
+        # 200Mb of content on /
+        with open(os.path.join(self.origin, "usr/bin/big"), "wb") as fp:
+            fp.truncate(200 * 1048576)
+        disksyml = self._disksyml()
+        original = copy.deepcopy(disksyml)
+        d = disks(types.SimpleNamespace(path=self.tdir), disksyml, origin=self.origin)
+
+        self.assertEqual(disksyml, original)
+        self.assertEqual(d._disks["xvda"]._pt.extents()[1][1], 33 * 1048576)
+        self.assertEqual(d._disks["xvda"]._pt.extents()[2][1], usage.DEFAULT_MINIMUM * 1048576)
+        root = d._disks["xvdb"]._pt.extents()[1][1] // 1048576
+        self.assertTrue(220 <= root <= 221)
+
+
+    def autosize_nomount(self):
+        self.logger.info("An auto size needs a mount point and the origin")
+
+        disksyml = self._disksyml()
+        self.assertRaises(Exception, disks, types.SimpleNamespace(path=self.tdir), disksyml)
+        disksyml["xvdb"]["partitions"][2]["size"] = "auto"
+        self.assertRaises(Exception, disks, types.SimpleNamespace(path=self.tdir), disksyml, self.origin)
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
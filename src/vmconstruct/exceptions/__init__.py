@@ -15,8 +15,11 @@ __all__ = [
     "VMCBaseError",
     "VMCPhaseError",
     "VMCTemplateChecksumError",
+    "VMCArtifactChecksumError",
     "VMCImageNotReadyError",
-    "VMCImageDatedError"
+    "VMCImageDatedError",
+    "VMCTimeoutError",
+    "VMCCheckError"
 ]
 
 
@@ -40,6 +43,13 @@ class VMCTemplateChecksumError(VMCBaseError):
     """
 
 
+class VMCArtifactChecksumError(VMCBaseError):
+    """\
+    This exception is raised when a payload artifact does not have the
+    sha256 declared for it.
+    """
+
+
 class VMCImageNotReadyError(VMCBaseError):
     """\
     Raise if a request to clone the image is made but the image build has not completed.
@@ -51,3 +61,15 @@ class VMCImageDatedError(VMCBaseError):
     Raise if a child image is out of date wrt to the parent
     """
 
+
+class VMCTimeoutError(VMCBaseError):
+    """\
+    Raise if a command does not finish within its time limit.
+    """
+
+
+class VMCCheckError(VMCBaseError):
+    """\
+    Raise if the configuration, a vmdef or a template fails the checks
+    made before a build.
+    """
@@ -11,7 +11,13 @@
 
 __all__ = []
 
+import errno
+import hashlib
 import logging
+import mmap
+import os
+import re
+import stat
 import tabulate
 
 
@@ -73,3 +79,107 @@ def fstab(fstab, mounts):
             orderedlines.append(tabu.pop(0))
 
     return("\n".join(orderedlines))
+
+
+
+def datasegments(fd):
+    """\
+    Generate (offset, length) tuples for the regions of the open file which
+    contain data.  Holes are found with SEEK_DATA/SEEK_HOLE so they are never
+    read.
+    """
+    size = os.fstat(fd).st_size
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # No more data after offset
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield((start, end - start))
+        offset = end
+
+
+def copyrange(src, dst, offset=0):
+    """\
+    Copy the data regions of the file src into the file dst starting at byte
+    offset.  The holes in src are not copied so dst stays sparse.  Where
+    possible copy_file_range is used so the kernel can share extents.
+    """
+    with open(src, "rb") as sfp, open(dst, "rb+") as dfp:
+        sfd = sfp.fileno()
+        dfd = dfp.fileno()
+        for (start, length) in datasegments(sfd):
+            copied = 0
+            while copied < length:
+                try:
+                    n = os.copy_file_range(sfd, dfd, length - copied, start + copied, offset + start + copied)
+                except (AttributeError, OSError) as e:
+                    if isinstance(e, OSError) and e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                        raise
+                    # Fall back to a userspace copy
+                    data = os.pread(sfd, min(length - copied, 16 * 1048576), start + copied)
+                    n = os.pwrite(dfd, data, offset + start + copied)
+                if not n:
+                    raise IOError("short copy from {s} at {o}".format(s=src, o=start + copied))
+                copied += n
+
+
+def treedigest(*paths):
+    """\
+    Return a sha256 hex digest over the names, modes and content of the
+    directory trees at paths.  A path which does not exist only contributes
+    its name so the digest still changes if it is created.
+    """
+    s256 = hashlib.sha256()
+    for path in paths:
+        s256.update(path.encode("utf-8") + b"\0")
+        for (root, dirs, files) in os.walk(path):
+            dirs.sort()
+            for name in sorted(dirs + files):
+                entry = os.path.join(root, name)
+                st = os.lstat(entry)
+                s256.update("{p}\0{m:o}\0".format(p=os.path.relpath(entry, path), m=st.st_mode).encode("utf-8"))
+                if stat.S_ISLNK(st.st_mode):
+                    s256.update(os.readlink(entry).encode("utf-8"))
+                elif stat.S_ISREG(st.st_mode):
+                    with open(entry, "rb") as fp:
+                        while True:
+                            data = fp.read(16 * 4096)
+                            if not data:
+                                break
+                            s256.update(data)
+
+    return(s256.hexdigest())
+
+
+def sha256file(path):
+    """\
+    Return the sha256 hex digest of the file at path.  The file is mapped
+    in to memory rather than read through a buffer.
+    """
+    s256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        if os.fstat(fp.fileno()).st_size:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                s256.update(mm)
+
+    return(s256.hexdigest())
+
+
+def ismount(path):
+    """\
+    Return True if path is a mount point.  Unlike os.path.ismount this
+    also finds a bind mount of a directory from the same filesystem.
+    """
+    path = os.path.realpath(path)
+    with open("/proc/self/mountinfo", "rt") as fp:
+        for line in fp:
+            mountpoint = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), line.split()[4])
+            if mountpoint == path:
+                return(True)
+
+    return(False)
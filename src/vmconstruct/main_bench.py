@@ -0,0 +1,49 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}" "$@"
+":"""
+
+"""\
+Time the orchestration of a build plan of many vmdefs with the directory
+workspace and the recording executor, so only the overhead of vmconstruct
+itself and the simulated command durations are measured.
+
+    main_bench.py [vmdefs] [seconds per package install]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vmconstruct.main_tests import buildplan, run
+
+
+def bench(vmdefs, install):
+    """\
+    Build the plan of vmdefs images and return the seconds taken.
+    """
+    tdir = tempfile.mkdtemp()
+    try:
+        config = buildplan(tdir, vmdefs=vmdefs, durations={"apt-get -y install": install})
+        start = time.perf_counter()
+        run(config, os.path.join(tdir, "vmc.log"), "-n")
+        return(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(tdir)
+
+
+
+if __name__ == "__main__":
+    vmdefs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    install = float(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    elapsed = bench(vmdefs, install)
+    print("{v} vmdefs: {e:.3f}s, {r:.3f}s per vmdef".format(v=vmdefs, e=elapsed, r=elapsed / vmdefs))
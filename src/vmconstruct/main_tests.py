@@ -0,0 +1,275 @@
+#!/bin/bash
+# -*- coding: utf-8 -*-
+
+""":"
+if [ "$(dirname ${0})" = "." ] ; then
+    PP="$(pwd)/.."
+fi
+
+PYTHONPATH="${PP}" exec /usr/bin/env python3 "${0}"
+":"""
+
+LOG_LEVEL = "DEBUG"
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import yaml
+
+import vmconstruct
+from vmconstruct import btrfs
+
+
+HOSTNAME_TPL = """\\
+<%def name="install(i)"><%
+    i["filename"] = "/etc/hostname"
+%></%def>\\
+${vmyml.get("data", {}).get("hostname", "ubuntu")}
+"""
+
+
+def buildplan(tdir, vmdefs=2, durations=None, layers=False):
+    """\\
+    Write a configuration to build vmdefs images, each with a template, a
+    payload, packages and a hdd, with the directory workspace and the
+    recording executor under tdir.  If layers is set each build step is
+    snapshotted.
+
+    :returns: The path of the configuration file.
+    """
+    tpl = os.path.join(tdir, "tpl", "ubuntu", "_all", "_all", "etc")
+    os.makedirs(tpl)
+    with open(os.path.join(tpl, "hostname.tpl"), "wt") as fp:
+        fp.write(HOSTNAME_TPL)
+
+    payload = os.path.join(tdir, "payloads", "hello")
+    os.makedirs(payload)
+    with open(os.path.join(payload, "pre"), "wt") as fp:
+        fp.write("#!/bin/sh\necho hello\n")
+    os.chmod(os.path.join(payload, "pre"), 0o755)
+    with open(os.path.join(payload, "payload.yml"), "wt") as fp:
+        yaml.safe_dump({"staging": "bind", "limits": {"timeout": 60}}, fp)
+
+    os.makedirs(os.path.join(tdir, "vmdefs"))
+    names = ["vm{n}".format(n=n) for n in range(vmdefs)]
+    for name in names:
+        vmyml = {
+            "dist": "ubuntu",
+            "release": "focal",
+            "settings": {"onexist": "rebuild", "payloads": [payload]},
+            "packages": ["nginx", "less"],
+            "disks": {
+                "rootfs": {"type": "squash", "path": "/"},
+                "hddimg": {
+                    "type": "hdd",
+                    "xvda": {
+                        "label": "gpt",
+                        "partitions": {
+                            1: {"mount": "/", "size": 64, "filesystem": "ext4"},
+                            2: {"mount": "/var", "size": 32, "filesystem": "xfs"},
+                            3: {"mount": "swap", "size": 8, "filesystem": "swap"}
+                        }
+                    }
+                }
+            },
+            "data": {"hostname": name}
+        }
+        with open(os.path.join(tdir, "vmdefs", name+".yml"), "wt") as fp:
+            yaml.safe_dump(vmyml, fp)
+
+    ymlcfg = {
+        "workspace": {
+            "rootpath": os.path.join(tdir, "workspace"),
+            "backend": "directory",
+            "executor": "recorder",
+            "durations": durations or {}
+        },
+        "build": {
+            "basereleases": {"ubuntu": ["focal"]},
+            "updates": {"ubuntu": {"_all": {"packages": ["vim"]}}},
+            "basetemplates": [os.path.join(tdir, "tpl")],
+            "vmdefs": names,
+            "layers": layers
+        },
+        "global": {"paths": {"vmdefs": os.path.join(tdir, "vmdefs")}},
+        "ubuntu": {"archive": None}
+    }
+    config = os.path.join(tdir, "vmc.yml")
+    with open(config, "wt") as fp:
+        yaml.safe_dump(ymlcfg, fp)
+
+    return(config)
+
+
+def run(config, log, *args):
+    """\\
+    Run main with the configuration, removing the log handlers it adds.
+    """
+    logger = logging.getLogger()
+    (handlers, level) = (list(logger.handlers), logger.level)
+    try:
+        vmconstruct.main(["build", "-c", config, "-l", log, "-d", "CRITICAL"] + list(args))
+    finally:
+        for handler in [h for h in logger.handlers if h not in handlers]:
+            logger.removeHandler(handler)
+            handler.close()
+        logger.setLevel(level)
+
+
+
+def suite():
+    mainTS = unittest.TestSuite()
+    mainTS.addTest(MainUT("directory"))
+    mainTS.addTest(MainUT("build"))
+    mainTS.addTest(MainUT("rebuild"))
+    mainTS.addTest(MainUT("resume"))
+    mainTS.addTest(MainUT("executor_unknown"))
+
+    return(mainTS)
+
+
+
+class MainUT(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(getattr(logging, LOG_LEVEL))
+
+
+    def setUp(self):
+        self.tdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.tdir, "vmc.log")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tdir)
+
+
+    def _status(self, *path):
+        with open(os.path.join(self.tdir, "workspace", *path, "status.json"), "rt") as fp:
+            return(json.load(fp))
+
+
+    def directory(self):
+        self.logger.info("Directory subvolumes behave as btrfs subvolumes")
+
+        root = btrfs.directory(self.tdir)
+        parent = root.create("parent")
+        child = parent.create("child")
+        self.assertEqual(parent.create("child"), child)
+        self.assertRaises(OSError, parent.create, "child", eexist=True)
+        os.mkdir(os.path.join(parent.path, "plain"))
+        self.assertRaises(OSError, parent.create, "plain")
+        self.assertEqual(parent.list(), [child])
+        self.assertEqual(child.rootpath, self.tdir)
+
+        with open(os.path.join(parent.path, "file"), "wt") as fp:
+            fp.write("content")
+        with open(os.path.join(child.path, "file"), "wt") as fp:
+            fp.write("content")
+        snapshot = parent.snapshot("snapshot")
+        with open(os.path.join(snapshot.path, "file"), "rt") as fp:
+            self.assertEqual(fp.read(), "content")
+        # as with btrfs a nested subvolume is empty in the snapshot
+        self.assertEqual(os.listdir(os.path.join(snapshot.path, "child")), [])
+        self.assertRaises(OSError, parent.snapshot, "snapshot")
+
+        self.assertRaises(OSError, parent.delete)
+        parent.delete(recursive=True)
+        self.assertFalse(os.path.exists(parent.path))
+        self.assertEqual(root.list(), [snapshot])
+
+
+    def build(self):
+        self.logger.info("A build plan runs without root, btrfs or chroot")
+
+        config = buildplan(self.tdir, vmdefs=2)
+        start = time.monotonic()
+        run(config, self.log)
+        self.logger.info("Built 2 vmdefs in {s:.3f}s".format(s=time.monotonic() - start))
+
+        self.assertEqual(self._status("ubuntu", "focal", "_update")["progress"]["status"], "complete")
+        for name in ["vm0", "vm1"]:
+            vm = os.path.join(self.tdir, "workspace", "ubuntu", "focal", name)
+            with open(os.path.join(vm, "origin", "etc", "hostname"), "rt") as fp:
+                self.assertEqual(fp.read().strip(), name)
+            self.assertTrue(os.path.isfile(os.path.join(vm, "rootfs.squashfs")))
+            self.assertTrue(os.path.isfile(os.path.join(vm, "hddimg", "disks", "xvda.img")))
+            with open(os.path.join(vm, "hddimg", "mnt", "etc", "fstab"), "rt") as fp:
+                fstab = fp.read()
+            for mount in ["/", "/var", "swap"]:
+                self.assertRegex(fstab, "UUID=[-0-9a-f]+ +{m} ".format(m=mount))
+
+            activity = self._status("ubuntu", "focal", name)["activity"]
+            chroot = [a["data"] for a in activity if a["activity"] == "chroot"]
+            self.assertIn(["apt-get", "-y", "install", "nginx"], chroot)
+            self.assertEqual(len([c for c in chroot if c[:2] == ["sh", "-c"] and c[2].endswith("exec ./pre")]), 1)
+            self.assertEqual([a["data"]["returncode"] for a in activity if a["activity"] == "usage"], [0])
+            self.assertEqual(sorted([a["activity"] for a in activity if a["activity"] in ["mount", "sparsify"]]), ["mount", "sparsify"])
+
+
+    def rebuild(self):
+        self.logger.info("An existing workspace is rebuilt")
+
+        config = buildplan(self.tdir, vmdefs=1)
+        run(config, self.log)
+        uuid = self._status("ubuntu", "focal", "vm0")["uuid"]
+        run(config, self.log, "-n")
+        self.assertNotEqual(self._status("ubuntu", "focal", "vm0")["uuid"], uuid)
+
+
+    def resume(self):
+        self.logger.info("A rebuild with layers resumes from the last layer")
+
+        config = buildplan(self.tdir, vmdefs=1, layers=True)
+        run(config, self.log)
+        status = self._status("ubuntu", "focal", "vm0")
+        steps = [l["step"] for l in status["layers"]]
+        payload = os.path.join(self.tdir, "payloads", "hello")
+        self.assertEqual(steps, ["templates PRE", "payload pre "+payload, "install", "payload post "+payload, "templates POST"])
+        store = os.path.join(self.tdir, "workspace", "ubuntu", "focal", "_layers", "vm0")
+        self.assertEqual(len(os.listdir(store)), len(steps) + 1)
+
+        # Without a bootstrap the base is unchanged so every step is skipped
+        run(config, self.log, "-q", "-n")
+        vm = os.path.join(self.tdir, "workspace", "ubuntu", "focal", "vm0")
+        # The image is restored from the last layer of the first build
+        resumed = self._status("ubuntu", "focal", "vm0")
+        self.assertEqual(resumed["uuid"], status["uuid"])
+        self.assertEqual(resumed["layers"], status["layers"])
+        with open(os.path.join(vm, "origin", "etc", "hostname"), "rt") as fp:
+            self.assertEqual(fp.read().strip(), "vm0")
+        self.assertTrue(os.path.isfile(os.path.join(vm, "hddimg", "disks", "xvda.img")))
+
+
+    def executor_unknown(self):
+        self.logger.info("An unknown executor is rejected rather than running the commands")
+
+        config = buildplan(self.tdir, vmdefs=1)
+        with open(config, "rt") as fp:
+            ymlcfg = yaml.safe_load(fp)
+        ymlcfg["workspace"]["executor"] = "dryrun"
+        with open(config, "wt") as fp:
+            yaml.safe_dump(ymlcfg, fp)
+
+        with self.assertRaises(SystemExit) as cm:
+            run(config, self.log, "-n")
+        self.assertEqual(cm.exception.code, 1)
+        self.assertFalse(os.path.exists(os.path.join(self.tdir, "workspace", "ubuntu")))
+
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger()
+    formatter = logging.Formatter('%(asctime)s: [%(levelname)s]%(name)s - %(message)s')
+    stderr_log_handler = logging.StreamHandler()
+    stderr_log_handler.setFormatter(formatter)
+    logger.addHandler(stderr_log_handler)
+    logger.setLevel(getattr(logging, "INFO"))
+
+    runner = unittest.TextTestRunner()
+    runner.run(suite())
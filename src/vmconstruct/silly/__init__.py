@@ -26,14 +26,18 @@ class cowstatus(object):
         toilet = ["/usr/bin/toilet", "-f", "term", "--metal"]
         cowsay = ["/usr/games/cowsay", "-n"]
 
-        with tempfile.TemporaryFile() as tfp:
-            tfp.write(msg.encode("UTF-8"))
-            tfp.seek(0)
-            p1 = subprocess.Popen(figlet, stdin=tfp, stdout=subprocess.PIPE)
-
-        p2 = subprocess.Popen(toilet, stdin=p1.stdout, stdout=subprocess.PIPE)
-        p3 = subprocess.Popen(cowsay, stdin=p2.stdout, stdout=subprocess.PIPE)
-        print(p3.communicate()[0].decode("UTF-8"))
+        try:
+            with tempfile.TemporaryFile() as tfp:
+                tfp.write(msg.encode("UTF-8"))
+                tfp.seek(0)
+                p1 = subprocess.Popen(figlet, stdin=tfp, stdout=subprocess.PIPE)
+
+            p2 = subprocess.Popen(toilet, stdin=p1.stdout, stdout=subprocess.PIPE)
+            p3 = subprocess.Popen(cowsay, stdin=p2.stdout, stdout=subprocess.PIPE)
+            print(p3.communicate()[0].decode("UTF-8"))
+        except FileNotFoundError:
+            # Not so silly without figlet, toilet and cowsay
+            print(msg)
 
 
 if __name__ == "__main__":